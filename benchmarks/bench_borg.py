@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import platform
+import random
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'src'))
+
+from gi.repository import GLib
+
+from bsrv import Cache, Config, History, Job, Logger
+
+PASSPHRASE = 'bench'
+
+
+def file_path(data_dir: str, k: int) -> str:
+    return os.path.join(data_dir, 'd{:03d}'.format(k // 1000), 'f{:06d}'.format(k))
+
+
+def write_file(path: str, size: int, rnd: random.Random, compressibility: float):
+    # The compressible part is zeros, the rest random bytes, which also defeats deduplication between files
+    zeros = int(size * compressibility)
+    with open(path, 'wb') as f:
+        f.write(rnd.randbytes(size - zeros) + bytes(zeros))
+
+
+def create_dataset(data_dir: str, args, rnd: random.Random):
+    for k in range(args.files):
+        path = file_path(data_dir, k)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_file(path, args.file_size, rnd, args.compressibility)
+
+
+def apply_churn(data_dir: str, args, rnd: random.Random) -> int:
+    changed = rnd.sample(range(args.files), int(args.files * args.churn))
+    for k in changed:
+        write_file(file_path(data_dir, k), args.file_size, rnd, args.compressibility)
+    return len(changed)
+
+
+def borg_env(repo: str, base_dir: str) -> dict:
+    return dict(os.environ, BORG_REPO=repo, BORG_PASSPHRASE=PASSPHRASE, BORG_BASE_DIR=base_dir,
+                BORG_RELOCATED_REPO_ACCESS_IS_OK='yes', BORG_UNKNOWN_UNENCRYPTED_REPO_ACCESS_IS_OK='yes')
+
+
+def write_config(work_dir: str, data_dir: str, args) -> str:
+    lines = [
+        '[logging]',
+        'target: file',
+        'path: {}'.format(os.path.join(work_dir, 'bsrvd.log')),
+        'log_level: {}'.format(args.log_level),
+        '[borg]',
+        'binary: {}'.format(args.borg),
+        'base_dir: {}'.format(os.path.join(work_dir, 'base')),
+        'mount_dir: {}'.format(os.path.join(work_dir, 'mnt')),
+        '[:bench]',
+        'borg_repo: {}'.format(os.path.join(work_dir, 'repo')),
+        'borg_passphrase: {}'.format(PASSPHRASE),
+        'borg_create_args: {}'.format(' '.join(args.create_args + [data_dir])),
+        'borg_prune_args: {}'.format(' '.join(args.prune_args)),
+        # Runs follow each other within the same second
+        'borg_archive_name_template: %Y-%m-%d_%H-%M-%S-%f',
+        'schedule: @every 1d',
+    ]
+    path = os.path.join(work_dir, 'bsrvd.conf')
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return path
+
+
+def run_job(job: 'Job') -> dict:
+    # Full Job.run cycle on the main loop, like bsrvd does it
+    loop = GLib.MainLoop()
+    result = {}
+
+    def on_finished(successful: bool):
+        result['total_s'] = time.perf_counter() - t0
+        result['successful'] = successful
+        loop.quit()
+
+    t0 = time.perf_counter()
+    job.run(on_finished=on_finished, on_progress=lambda progress: None)
+    loop.run()
+
+    run = History.get(job.name, limit=1)[0]
+    usage = run['usage'] or {}
+    result['create_s'] = run['create_duration']
+    result['prune_s'] = run['prune_duration']
+    result['nfiles'] = run['nfiles']
+    result['original_size'] = run['original_size']
+    # Everything bsrv does around the two borg processes: spawning, output handling, history, cache and metrics
+    borg_s = sum(usage.get(key, {}).get('wall_time', 0.0) for key in ['create', 'prune'])
+    result['overhead_s'] = result['total_s'] - borg_s if usage else None
+    return result
+
+
+def run_raw(args, data_dir: str, env: dict, k: int) -> dict:
+    # The same borg commands without bsrv, output is read but not processed
+    archive = '::raw-{}-{}'.format(k, time.time_ns())
+    t0 = time.perf_counter()
+    subprocess.run([args.borg, 'create', '--log-json', '--progress', '--json', archive] + args.create_args +
+                   [data_dir], env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    t1 = time.perf_counter()
+    subprocess.run([args.borg, 'prune', '--log-json', '--list', '--glob-archives', 'raw-*'] + args.prune_args, env=env,
+                   stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    t2 = time.perf_counter()
+    return {'create_s': t1 - t0, 'prune_s': t2 - t1, 'total_s': t2 - t0}
+
+
+def median(values: list):
+    values = sorted(v for v in values if v is not None)
+    return values[len(values) // 2] if values else None
+
+
+def summarize(runs: list) -> dict:
+    summary = {key: median([run.get(key) for run in runs])
+               for key in ['total_s', 'create_s', 'prune_s', 'overhead_s']}
+    summary['files_per_s'] = median([run['nfiles'] / run['create_s'] for run in runs
+                                     if run.get('nfiles') and run.get('create_s')])
+    summary['mb_per_s'] = median([run['original_size'] / run['create_s'] / 1e6 for run in runs
+                                  if run.get('original_size') and run.get('create_s')])
+    return summary
+
+
+def bench(args) -> dict:
+    rnd = random.Random(args.seed)
+    with tempfile.TemporaryDirectory(prefix='bsrv-bench-borg-', dir=args.dir) as work_dir:
+        data_dir = os.path.join(work_dir, 'data')
+        base_dir = os.path.join(work_dir, 'base')
+        os.makedirs(base_dir)
+        create_dataset(data_dir, args, rnd)
+
+        Logger.initialize()
+        Config.initialize(write_config(work_dir, data_dir, args))
+        Logger.configure()
+        Cache.initialize()
+        History.initialize()
+        job = Job.from_bsrvd_config(':bench')
+        if not job or not job.runnable:
+            raise RuntimeError('Job could not be loaded, see {}'.format(os.path.join(work_dir, 'bsrvd.log')))
+
+        env = borg_env(job.borg_repo, job.borg_base_dir)
+        subprocess.run([args.borg, 'init', '--encryption', args.encryption], env=env, stdout=subprocess.DEVNULL,
+                       check=True)
+
+        # The first run stores the whole dataset, the following ones only the churn
+        initial = run_job(job)
+        runs, raw_runs = [], []
+        for k in range(args.runs):
+            changed = apply_churn(data_dir, args, rnd)
+            run = run_job(job)
+            run['changed_files'] = changed
+            runs.append(run)
+            if not args.no_raw:
+                apply_churn(data_dir, args, rnd)
+                raw_runs.append(run_raw(args, data_dir, env, k))
+
+        result = {
+            'initial': initial,
+            'incremental': summarize(runs),
+            'failed_runs': sum(not run['successful'] for run in [initial] + runs),
+            'runs': runs
+        }
+        if raw_runs:
+            result['raw'] = {key: median([run[key] for run in raw_runs]) for key in ['total_s', 'create_s', 'prune_s']}
+            result['bsrv_minus_raw_s'] = result['incremental']['total_s'] - result['raw']['total_s']
+        return result
+
+
+def borg_version(borg: str) -> str:
+    try:
+        return subprocess.check_output([borg, '--version'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=BENCH_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of Job.run against a local borg repository')
+    parser.add_argument('--borg', default='borg', help='borg binary.')
+    parser.add_argument('--files', type=int, default=10000, help='Number of files in the dataset.')
+    parser.add_argument('--file-size', type=int, default=16384, help='Size of each file in bytes.')
+    parser.add_argument('--compressibility', type=float, default=0.5, help='Fraction of zeros in each file.')
+    parser.add_argument('--churn', type=float, default=0.05, help='Fraction of files rewritten before each run.')
+    parser.add_argument('--runs', type=int, default=5, help='Incremental runs after the initial one.')
+    parser.add_argument('--encryption', default='none', help='Encryption mode of the repository.')
+    parser.add_argument('--create-args', default='--compression lz4',
+                        help='Additional arguments of borg create, the dataset is appended.')
+    parser.add_argument('--prune-args', default='--keep-last 3', help='Arguments of borg prune.')
+    parser.add_argument('--no-raw', action='store_true', default=False,
+                        help='Do not compare with the same borg commands run without bsrv.')
+    parser.add_argument('--dir', default=None, help='Directory for the dataset and repository. Default is TMPDIR.')
+    parser.add_argument('--log-level', default='warning', help='Log level of bsrv.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    parser.add_argument('--json', action='store_true', default=False, help='Output results as JSON')
+    args = parser.parse_args()
+    args.create_args = shlex.split(args.create_args)
+    args.prune_args = shlex.split(args.prune_args)
+
+    result = bench(args)
+
+    if args.json:
+        print(json.dumps({
+            'revision': git_revision(),
+            'borg': borg_version(args.borg),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'parameters': {k: v for k, v in vars(args).items() if k != 'json'},
+            'result': result
+        }))
+    else:
+        def fmt(value, unit=''):
+            return '{:.3f}{}'.format(value, unit) if value is not None else '-'
+
+        for title, run in [('initial', dict(summarize([result['initial']]), **result['initial'])),
+                           ('incremental (median)', result['incremental'])]:
+            print('{:<22} total {}, create {}, prune {}, bsrv overhead {}, {} files/s, {} MB/s'.format(
+                title, fmt(run['total_s'], ' s'), fmt(run['create_s'], ' s'), fmt(run['prune_s'], ' s'),
+                fmt(run['overhead_s'] * 1000 if run['overhead_s'] is not None else None, ' ms'),
+                fmt(run['files_per_s']), fmt(run['mb_per_s'])))
+        if 'raw' in result:
+            print('{:<22} total {}, create {}, prune {}, bsrv - raw {}'.format(
+                'raw borg (median)', fmt(result['raw']['total_s'], ' s'), fmt(result['raw']['create_s'], ' s'),
+                fmt(result['raw']['prune_s'], ' s'), fmt(result['bsrv_minus_raw_s'] * 1000, ' ms')))
+        if result['failed_runs']:
+            print('{} runs failed'.format(result['failed_runs']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import platform
+import random
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+SRC_DIR = os.path.join(BENCH_DIR, '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+from dasbus.error import DBusError
+
+from bsrv import SESSION_BUS, get_dbus_service_identifier
+
+
+def job_name(k: int) -> str:
+    return ':job{:05d}'.format(k)
+
+
+def write_config(work_dir: str, n: int, args) -> str:
+    base_dir = os.path.join(work_dir, 'base')
+    os.makedirs(base_dir)
+    lines = [
+        '[logging]',
+        'target: file',
+        'path: {}'.format(os.path.join(work_dir, 'bsrvd.log')),
+        'log_level: {}'.format(args.log_level),
+        '[borg]',
+        'binary: {}'.format(os.path.join(BENCH_DIR, 'fake_borg.py')),
+        'base_dir: {}'.format(base_dir),
+        'mount_dir: {}'.format(os.path.join(work_dir, 'mnt')),
+        'max_concurrent: {}'.format(args.concurrency),
+    ]
+    for k in range(n):
+        lines += [
+            '[{}]'.format(job_name(k)),
+            'borg_repo: {}'.format(os.path.join(work_dir, 'repo{}'.format(k))),
+            'borg_passphrase: bench',
+            'borg_create_args: /data',
+            'borg_prune_args: --keep-last 3',
+            'schedule: @every 1d',
+            'retry_delay: 1',
+            'retry_max: 1',
+        ]
+    path = os.path.join(work_dir, 'bsrvd.conf')
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    if not args.cold_cache:
+        # Known last archive dates, otherwise startup runs borg list for every job. All jobs are due.
+        with open(os.path.join(base_dir, 'bsrvd.cache'), 'w') as f:
+            json.dump({'job_{}_last_dt'.format(job_name(k)): '2020-01-01T01:00:00' for k in range(n)}, f)
+    return path
+
+
+def get_proxy():
+    return get_dbus_service_identifier(SESSION_BUS).get_proxy()
+
+
+def quantiles(samples: list) -> dict:
+    samples = sorted(samples)
+    if not samples:
+        return {'p50_ms': None, 'p95_ms': None, 'max_ms': None}
+    return {
+        'p50_ms': samples[len(samples) // 2] * 1000,
+        'p95_ms': samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000,
+        'max_ms': samples[-1] * 1000
+    }
+
+
+def dbus_latency(call, names: list, samples: int, seed: int) -> dict:
+    rnd = random.Random(seed)
+    proxy = get_proxy()
+    times = []
+    for _ in range(samples):
+        name = rnd.choice(names)
+        t0 = time.perf_counter()
+        call(proxy, name)
+        times.append(time.perf_counter() - t0)
+    return quantiles(times)
+
+
+def memory(pid: int) -> dict:
+    values = {}
+    with open('/proc/{}/status'.format(pid)) as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ['VmRSS', 'VmHWM']:
+                values[key] = int(value.split()[0]) * 1024
+    return {'rss_bytes': values.get('VmRSS'), 'peak_rss_bytes': values.get('VmHWM')}
+
+
+def count_runs(history_file: str) -> int:
+    try:
+        with sqlite3.connect('file:{}?mode=ro'.format(history_file), uri=True, timeout=5) as db:
+            return db.execute('SELECT COUNT(*) FROM runs').fetchone()[0]
+    except sqlite3.Error:
+        return 0
+
+
+def bench(n: int, args) -> dict:
+    with tempfile.TemporaryDirectory(prefix='bsrv-bench-') as work_dir:
+        config = write_config(work_dir, n, args)
+        env = dict(os.environ,
+                   PYTHONPATH=os.pathsep.join([SRC_DIR] + [p for p in [os.environ.get('PYTHONPATH')] if p]),
+                   FAKE_BORG_LATENCY=str(args.latency),
+                   FAKE_BORG_LIST_LATENCY=str(args.list_latency),
+                   FAKE_BORG_LINES=str(args.lines),
+                   FAKE_BORG_FAILURE_RATE=str(args.failure_rate),
+                   FAKE_BORG_ARCHIVES=str(args.archives))
+        names = [job_name(k) for k in range(n)]
+        result = {'n': n}
+
+        t0 = time.perf_counter()
+        with open(os.path.join(work_dir, 'bsrvd.out'), 'w') as out:
+            daemon = subprocess.Popen([sys.executable, '-m', 'bsrvd', '-c', config, '--session-bus'], env=env,
+                                      stdout=out, stderr=subprocess.STDOUT)
+        try:
+            # Startup: until the DBus interface answers with all jobs registered
+            while True:
+                if daemon.poll() is not None:
+                    raise RuntimeError('bsrvd exited with code {}, see {}'.format(daemon.returncode, work_dir))
+                try:
+                    if len(get_proxy().GetLoadedJobs()) == n:
+                        break
+                except DBusError:
+                    pass
+                if time.perf_counter() - t0 > args.timeout:
+                    raise RuntimeError('bsrvd did not start within {} s'.format(args.timeout))
+                time.sleep(0.02)
+            ready = time.perf_counter()
+            result['startup_s'] = ready - t0
+            result.update({'startup_' + k: v for k, v in memory(daemon.pid).items()})
+
+            # Throughput: all jobs are due at startup, count finished runs until all ran once or the time is up
+            history_file = os.path.join(work_dir, 'base', 'bsrvd.history.sqlite')
+            while True:
+                runs = count_runs(history_file)
+                elapsed = time.perf_counter() - ready
+                if runs >= n or elapsed >= args.duration:
+                    break
+                time.sleep(0.1)
+            result['runs'] = runs
+            result['runs_per_s'] = runs / elapsed
+            result['ideal_runs_per_s'] = args.concurrency / args.latency if args.latency > 0 else None
+
+            # DBus latency while jobs are still running for the larger sizes
+            for key, value in dbus_latency(lambda proxy, name: proxy.GetJobStatus(name), names, args.samples,
+                                           args.seed).items():
+                result['get_job_status_' + key] = value
+            for key, value in dbus_latency(lambda proxy, name: proxy.GetJobInfo(name), names, args.info_samples,
+                                           args.seed).items():
+                result['get_job_info_' + key] = value
+
+            metrics = json.loads(get_proxy().GetMetrics())['histograms']
+            for name, key in [('bsrv_scheduler_launch_lag_seconds', 'launch_lag'),
+                              ('bsrv_scheduler_evaluate_seconds', 'evaluate')]:
+                series = metrics.get(name, [{}])[0]
+                result[key + '_p50_ms'] = series['p50'] * 1000 if 'p50' in series else None
+                result[key + '_p99_ms'] = series['p99'] * 1000 if 'p99' in series else None
+
+            result.update(memory(daemon.pid))
+        finally:
+            # The daemon waits for running jobs on SIGTERM, and quits immediately on a second one
+            daemon.send_signal(signal.SIGTERM)
+            try:
+                daemon.wait(timeout=args.latency * 2 + 10)
+            except subprocess.TimeoutExpired:
+                daemon.send_signal(signal.SIGTERM)
+                try:
+                    daemon.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    daemon.kill()
+                    daemon.wait()
+        return result
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=BENCH_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of bsrvd on the session bus, using a fake borg binary')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 10000], help='Numbers of jobs.')
+    parser.add_argument('--concurrency', type=int, default=8, help='[borg] max_concurrent of the daemon.')
+    parser.add_argument('--latency', type=float, default=0.2, help='Duration of fake borg create in seconds.')
+    parser.add_argument('--list-latency', type=float, default=0.0,
+                        help='Duration of fake borg list and borg info in seconds.')
+    parser.add_argument('--lines', type=int, default=100, help='Progress lines written by fake borg create.')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Probability of fake borg create failing.')
+    parser.add_argument('--archives', type=int, default=10, help='Archives returned by fake borg list.')
+    parser.add_argument('--duration', type=float, default=30.0,
+                        help='Maximum time in seconds to measure throughput per size.')
+    parser.add_argument('--samples', type=int, default=200, help='GetJobStatus calls measured per size.')
+    parser.add_argument('--info-samples', type=int, default=20, help='GetJobInfo calls measured per size.')
+    parser.add_argument('--cold-cache', action='store_true', default=False,
+                        help='Start without cached archive dates, startup then runs borg list for every job.')
+    parser.add_argument('--log-level', default='warning', help='Log level of the daemon.')
+    parser.add_argument('--timeout', type=float, default=600.0, help='Maximum startup time in seconds.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    parser.add_argument('--json', action='store_true', default=False, help='Output results as JSON')
+    args = parser.parse_args()
+
+    if not os.environ.get('DBUS_SESSION_BUS_ADDRESS'):
+        # Run in a private session bus, which also keeps the benchmark away from a running bsrvd
+        os.execvp('dbus-run-session', ['dbus-run-session', '--', sys.executable] + sys.argv)
+
+    results = [bench(n, args) for n in args.sizes]
+
+    if args.json:
+        print(json.dumps({
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'parameters': {k: v for k, v in vars(args).items() if k != 'json'},
+            'results': results
+        }))
+    else:
+        keys = ['startup_s', 'runs_per_s', 'launch_lag_p99_ms', 'get_job_status_p50_ms', 'get_job_status_p95_ms',
+                'get_job_info_p50_ms', 'peak_rss_bytes']
+        print('{:>8} '.format('n') + ' '.join('{:>22}'.format(k) for k in keys))
+        for r in results:
+            print('{:>8} '.format(r['n']) + ' '.join('{:>22.2f}'.format(r[k]) if r[k] is not None else '{:>22}'.format('-')
+                                                    for k in keys))
+
+
+if __name__ == '__main__':
+    main()
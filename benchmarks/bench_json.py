@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+from bsrv import tools
+
+
+def legacy_parse_json(json_source: str):
+    # parse_json before the datetime keys, which tried every string as number and datetime, for comparison
+    def iso2datetime(source: dict):
+        for k, v in source.items():
+            if isinstance(v, list):
+                for a in v:
+                    iso2datetime(a)
+            elif isinstance(v, dict):
+                iso2datetime(v)
+            elif isinstance(v, str) and not v.isdigit():
+                try:
+                    float(v)
+                    continue
+                except ValueError:
+                    pass
+                try:
+                    source[k] = datetime.datetime.fromisoformat(v)
+                except (ValueError, OverflowError):
+                    pass
+        return source
+
+    return iso2datetime(json.loads(json_source))
+
+
+def legacy_gen_json(obj: dict):
+    # Converted datetimes in place, callers had to pass a copy
+    def datetime2iso(obj: dict):
+        for k, v in obj.items():
+            if isinstance(v, list):
+                for a in v:
+                    datetime2iso(a)
+            elif isinstance(v, dict):
+                datetime2iso(v)
+            elif isinstance(v, datetime.datetime):
+                obj[k] = v.isoformat()
+        return obj
+
+    return json.dumps(datetime2iso(obj))
+
+
+def list_payload(n: int, rnd: random.Random) -> str:
+    # Like borg list --json, archive names as created by the default template
+    t = datetime.datetime(2020, 1, 1)
+    archives = []
+    for k in range(n):
+        t += datetime.timedelta(hours=rnd.randint(1, 24), microseconds=rnd.randrange(1000000))
+        name = t.strftime('%Y-%m-%d_%H-%M-%S')
+        archives.append({
+            'archive': name,
+            'barchive': name,
+            'id': '{:064x}'.format(rnd.getrandbits(256)),
+            'name': name,
+            'start': t.isoformat(),
+            'time': (t + datetime.timedelta(seconds=rnd.randint(1, 3600))).isoformat()
+        })
+    return json.dumps({
+        'archives': archives,
+        'encryption': {'mode': 'repokey-blake2'},
+        'repository': {'id': '{:064x}'.format(rnd.getrandbits(256)), 'last_modified': t.isoformat(),
+                       'location': 'ssh://backup@host/./repo'}
+    })
+
+
+def timed(func, reps: int) -> float:
+    # Median in ms
+    durations = []
+    for _ in range(reps):
+        t0 = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - t0)
+    return sorted(durations)[len(durations) // 2] * 1e3
+
+
+def bench(n: int, reps: int, seed: int) -> dict:
+    payload = list_payload(n, random.Random(seed))
+    parsed = tools.parse_json(payload)
+    # legacy_gen_json converts its input, every repetition gets a fresh one
+    copies = iter([tools.parse_json(payload) for _ in range(reps)])
+    result = {
+        'archives': n,
+        'payload_bytes': len(payload),
+        'before': {
+            'parse_ms': timed(lambda: legacy_parse_json(payload), reps),
+            'gen_ms': timed(lambda: legacy_gen_json(next(copies)), reps)
+        }
+    }
+    result['parse_ms'] = timed(lambda: tools.parse_json(payload), reps)
+    # gen_json uses orjson if it is installed
+    orjson = tools.orjson
+    codecs = [('gen_ms', None)] + ([('gen_orjson_ms', orjson)] if orjson is not None else [])
+    try:
+        for key, module in codecs:
+            tools.orjson = module
+            result[key] = timed(lambda: tools.gen_json(parsed), reps)
+    finally:
+        tools.orjson = orjson
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of parse_json and gen_json on borg list output')
+    parser.add_argument('--archives', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='Numbers of archives in the payload.')
+    parser.add_argument('--reps', type=int, default=20, help='Repetitions, the median is reported.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    parser.add_argument('--json', action='store_true', default=False, help='Output results as JSON')
+    args = parser.parse_args()
+
+    results = [bench(n, args.reps, args.seed) for n in args.archives]
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for result in results:
+            print('{} archives ({:.1f} MB):'.format(result['archives'], result['payload_bytes'] / 1e6))
+            print('  parse_json {:8.2f} ms (before {:8.2f} ms)'.format(result['parse_ms'], result['before']['parse_ms']))
+            print('  gen_json   {:8.2f} ms (before {:8.2f} ms), with orjson {}'.format(
+                result['gen_ms'], result['before']['gen_ms'],
+                '{:.2f} ms'.format(result['gen_orjson_ms']) if 'gen_orjson_ms' in result else 'not installed'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+from bsrv.job import Schedule
+
+EXPRESSIONS = {
+    'dense': '* * * * *',
+    'hourly': '0 * * * *',
+    'business_hours': '*/15 8-17 * * 1-5',
+    'monthly': '0 2 1 * *',
+    'sparse_yearly': '30 4 1 1 *',
+    'leap_day': '0 0 29 2 *',
+    'leap_day_or_monday': '0 0 29 2 1',
+    'impossible': '0 0 31 2 *',
+}
+
+
+def bench(name: str, expr: str, reps: int, occurrences: int) -> dict:
+    schedule = Schedule(expr)
+    start = datetime.datetime(2021, 3, 1, 12, 34)
+
+    t0 = time.perf_counter()
+    for _ in range(reps):
+        schedule.next(start)
+    next_us = (time.perf_counter() - t0) / reps * 1e6
+
+    t0 = time.perf_counter()
+    found = list(schedule.upcoming(occurrences, start))
+    iter_us = (time.perf_counter() - t0) / max(1, len(found)) * 1e6
+
+    return {
+        'name': name,
+        'expr': expr,
+        'next_us': next_us,
+        'iter_us_per_occurrence': iter_us,
+        'occurrences': len(found),
+        'last': found[-1].isoformat() if found else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark for bsrv.job.Schedule')
+    parser.add_argument('--reps', type=int, default=2000, help='Calls to Schedule.next per expression.')
+    parser.add_argument('--occurrences', type=int, default=1000, help='Occurrences taken from Schedule.upcoming.')
+    parser.add_argument('--json', action='store_true', default=False, help='Output results as JSON')
+    args = parser.parse_args()
+
+    results = [bench(name, expr, args.reps, args.occurrences) for name, expr in EXPRESSIONS.items()]
+
+    if args.json:
+        print(json.dumps(results))
+    else:
+        print('{:<20} {:<20} {:>12} {:>16} {:>8}  {}'.format('name', 'expr', 'next_us', 'iter_us/occ', 'found',
+                                                          'last'))
+        for r in results:
+            print('{:<20} {:<20} {:>12.2f} {:>16.2f} {:>8}  {}'.format(r['name'], r['expr'], r['next_us'],
+                                                                    r['iter_us_per_occurrence'], r['occurrences'],
+                                                                    r['last']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+from bsrv.job import SchedulerQueue
+
+
+class Elem:
+    def __init__(self, name: str):
+        self.name = name
+
+    def __eq__(self, other):
+        return other.name == self.name
+
+    def __hash__(self):
+        return hash(self.name)
+
+
+def timed(func, reps: int) -> float:
+    t0 = time.perf_counter()
+    for k in range(reps):
+        func(k)
+    return (time.perf_counter() - t0) / reps * 1e6
+
+
+def bench(n: int, reps: int, seed: int) -> dict:
+    rnd = random.Random(seed)
+    base = datetime.datetime(2021, 1, 1)
+    elems = [Elem('job{}'.format(k)) for k in range(n)]
+    queue = SchedulerQueue()
+
+    t0 = time.perf_counter()
+    for elem in elems:
+        queue.put(elem, base + datetime.timedelta(minutes=rnd.randrange(525600)), hook_enabled=False)
+    fill = (time.perf_counter() - t0) / n * 1e6
+
+    picks = [rnd.choice(elems) for _ in range(reps)]
+    dts = [base + datetime.timedelta(minutes=rnd.randrange(525600)) for _ in range(reps)]
+
+    result = {
+        'n': n,
+        'put_us': fill,
+        'when_us': timed(lambda k: queue.when(picks[k]), reps),
+        'move_us': timed(lambda k: queue.move(picks[k], dts[k], hook_enabled=False), reps),
+    }
+
+    def delete_put(k):
+        queue.delete(picks[k], hook_enabled=False)
+        queue.put(picks[k], dts[k], hook_enabled=False)
+
+    result['delete_put_us'] = timed(delete_put, reps)
+
+    def next_put(k):
+        dt, items = queue.get_next_action()
+        for item in items:
+            queue.put(item, dt + datetime.timedelta(days=365), hook_enabled=False)
+
+    result['get_next_action_us'] = timed(next_put, reps)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmark for bsrv.job.SchedulerQueue')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000, 100000],
+                        help='Queue sizes to benchmark.')
+    parser.add_argument('--reps', type=int, default=2000, help='Operations measured per size.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    parser.add_argument('--json', action='store_true', default=False, help='Output results as JSON')
+    args = parser.parse_args()
+
+    results = [bench(n, args.reps, args.seed) for n in args.sizes]
+
+    if args.json:
+        print(json.dumps(results))
+    else:
+        keys = ['put_us', 'when_us', 'move_us', 'delete_put_us', 'get_next_action_us']
+        print('{:>8} '.format('n') + ' '.join('{:>20}'.format(k) for k in keys))
+        for r in results:
+            print('{:>8} '.format(r['n']) + ' '.join('{:>20.2f}'.format(r[k]) for k in keys))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# Stand-in for borg, set as [borg] binary. Behavior is controlled by environment variables:
+#   FAKE_BORG_LATENCY       duration of borg create in seconds (default 0.1)
+#   FAKE_BORG_LIST_LATENCY  duration of borg list and borg info in seconds (default 0)
+#   FAKE_BORG_LINES         progress and file status lines written by borg create (default 100)
+#   FAKE_BORG_FAILURE_RATE  probability that borg create fails (default 0)
+#   FAKE_BORG_ARCHIVES      number of archives returned by borg list (default 10)
+import datetime
+import json
+import os
+import random
+import sys
+import time
+
+
+def env_float(name: str, default: float) -> float:
+    return float(os.environ.get(name, default))
+
+
+def log(obj: dict):
+    sys.stderr.write(json.dumps(obj) + '\n')
+
+
+def create(args: list) -> int:
+    latency = env_float('FAKE_BORG_LATENCY', 0.1)
+    lines = int(env_float('FAKE_BORG_LINES', 100))
+    original_size = 0
+    for k in range(lines):
+        original_size += 1000000
+        if k % 2:
+            log({'type': 'file_status', 'status': 'A', 'path': '/data/file{}'.format(k)})
+        else:
+            log({'type': 'archive_progress', 'original_size': original_size, 'compressed_size': original_size // 2,
+                 'deduplicated_size': original_size // 10, 'nfiles': k, 'path': '/data/file{}'.format(k),
+                 'time': time.time()})
+        time.sleep(latency / max(1, lines))
+    if lines == 0:
+        time.sleep(latency)
+    log({'type': 'archive_progress', 'finished': True, 'time': time.time()})
+
+    if random.random() < env_float('FAKE_BORG_FAILURE_RATE', 0.0):
+        log({'type': 'log_message', 'levelname': 'ERROR', 'name': 'borg.archiver',
+             'message': 'Connection closed by remote host'})
+        return 2
+
+    archive = next((arg[2:] for arg in args if arg.startswith('::')), 'archive')
+    print(json.dumps({'archive': {'name': archive, 'duration': latency, 'stats': {
+        'original_size': original_size, 'compressed_size': original_size // 2,
+        'deduplicated_size': original_size // 10, 'nfiles': lines}}}))
+    return 0
+
+
+def list_archives(args: list) -> int:
+    time.sleep(env_float('FAKE_BORG_LIST_LATENCY', 0.0))
+    start = datetime.datetime(2020, 1, 1)
+    archives = []
+    n = int(env_float('FAKE_BORG_ARCHIVES', 10))
+    last = int(args[args.index('--last') + 1]) if '--last' in args else n
+    for k in range(max(0, n - last), n):
+        dt = start + datetime.timedelta(hours=k)
+        archives.append({'name': '{:%Y-%m-%d_%H-%M-%S}'.format(dt), 'id': '{:064x}'.format(k),
+                         'start': dt.isoformat(timespec='microseconds'),
+                         'time': (dt + datetime.timedelta(minutes=1)).isoformat(timespec='microseconds')})
+    print(json.dumps({'archives': archives}))
+    return 0
+
+
+def info() -> int:
+    time.sleep(env_float('FAKE_BORG_LIST_LATENCY', 0.0))
+    print(json.dumps({
+        'cache': {'stats': {'total_size': 10 ** 10, 'total_csize': 5 * 10 ** 9, 'unique_csize': 10 ** 9,
+                            'total_chunks': 10 ** 5, 'total_unique_chunks': 10 ** 4}},
+        'repository': {'id': '0' * 64, 'location': os.environ.get('BORG_REPO', ''),
+                       'last_modified': '2020-01-01T00:00:00.000000'}
+    }))
+    return 0
+
+
+def main() -> int:
+    command = sys.argv[1] if len(sys.argv) > 1 else ''
+    if command == 'create':
+        return create(sys.argv[2:])
+    elif command == 'prune':
+        log({'type': 'log_message', 'levelname': 'INFO', 'name': 'borg.output.prune', 'message': 'Keeping archive'})
+        return 0
+    elif command == 'list':
+        return list_archives(sys.argv[2:])
+    elif command == 'info':
+        return info()
+    elif command in ['init', 'mount', 'umount']:
+        return 0
+    sys.stderr.write('fake borg: unknown command "{}"\n'.format(command))
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,10 @@
 from .cache import Cache
 from .config import Config
+from .diagnostics import Diagnostics
+from .history import History
 from .dbus import MainLoop, SESSION_BUS, SYSTEM_BUS, get_dbus_service_identifier
 from .hook import Hook
 from .job import Job, Schedule, ScheduleParseError, Scheduler
 from .logger import Logger
+from .metrics import Metrics
+from .simulation import Simulation
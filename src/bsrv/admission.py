@@ -0,0 +1,215 @@
+import datetime
+import re
+from typing import Any, Dict, List, Union, TYPE_CHECKING
+
+from .config import Config
+from .logger import Logger
+from .tools import parse_timeperiod
+
+if TYPE_CHECKING:
+    from .job import Job
+
+ssh_url_expr = re.compile(r'^ssh://([^@/]+@)?(?P<host>\[[^\]]+\]|[^:/]+)')
+scp_style_expr = re.compile(r'^([^@/:]+@)?(?P<host>[^:/]+):')
+
+
+def repo_key(borg_repo: str) -> str:
+    return borg_repo.rstrip('/')
+
+
+def repo_host(borg_repo: str) -> Union[None, str]:
+    for expr in [ssh_url_expr, scp_style_expr]:
+        match = expr.match(borg_repo)
+        if match:
+            return match.group('host')
+    return None
+
+
+class Admission:
+    @staticmethod
+    def from_config():
+        return Admission(
+            max_running=Config.getint('borg', 'max_concurrent', fallback=0),
+            max_per_host=Config.getint('borg', 'max_concurrent_per_host', fallback=0)
+        )
+
+    def __init__(self, max_running: int = 0, max_per_host: int = 0):
+        # A limit <= 0 means unlimited. Jobs sharing a repository are always mutually exclusive.
+        self.max_running: int = max_running
+        self.max_per_host: int = max_per_host
+        self.running: int = 0
+        self.repos: Dict[str, str] = {}
+        self.hosts: Dict[str, int] = {}
+
+    def blocked_reason(self, job: 'Job') -> Union[None, str]:
+        key = repo_key(job.borg_repo)
+        if key in self.repos:
+            return 'repository in use by job "{}"'.format(self.repos[key])
+        if 0 < self.max_running <= self.running:
+            return 'maximum of {} concurrent jobs reached'.format(self.max_running)
+        host = repo_host(job.borg_repo)
+        if host is not None and 0 < self.max_per_host <= self.hosts.get(host, 0):
+            return 'maximum of {} concurrent jobs for host "{}" reached'.format(self.max_per_host, host)
+        return None
+
+    def try_acquire(self, job: 'Job') -> bool:
+        if self.blocked_reason(job) is not None:
+            return False
+        self.repos[repo_key(job.borg_repo)] = job.name
+        self.running += 1
+        host = repo_host(job.borg_repo)
+        if host is not None:
+            self.hosts[host] = self.hosts.get(host, 0) + 1
+        return True
+
+    def release(self, job: 'Job'):
+        key = repo_key(job.borg_repo)
+        if self.repos.get(key) != job.name:
+            return
+        del self.repos[key]
+        self.running -= 1
+        host = repo_host(job.borg_repo)
+        if host is not None:
+            self.hosts[host] -= 1
+            if self.hosts[host] <= 0:
+                del self.hosts[host]
+
+
+class SchedulingPolicy:
+    FIFO = 'fifo'
+    EDF = 'edf'
+    # Shift of the deadline per priority level if aging is disabled
+    priority_step: 'datetime.timedelta' = datetime.timedelta(hours=1)
+
+    @staticmethod
+    def from_config():
+        name = Config.get('borg', 'scheduling_policy', fallback=SchedulingPolicy.FIFO).strip().lower()
+        if name not in [SchedulingPolicy.FIFO, SchedulingPolicy.EDF]:
+            Logger.error('Error in config file: scheduling_policy can only be "fifo" or "edf". Using "fifo".')
+            name = SchedulingPolicy.FIFO
+        return SchedulingPolicy(
+            name=name,
+            aging=parse_timeperiod(Config.get('borg', 'scheduling_aging', fallback='1h')),
+            default_deadline=parse_timeperiod(Config.get('borg', 'scheduling_default_deadline', fallback='1d'))
+        )
+
+    def __init__(self, name: str = FIFO, aging: Union[None, 'datetime.timedelta'] = None,
+                 default_deadline: Union[None, 'datetime.timedelta'] = None):
+        self.name: str = name
+        self.aging: Union[None, 'datetime.timedelta'] = aging or None
+        self.default_deadline: 'datetime.timedelta' = default_deadline or datetime.timedelta(days=1)
+
+    def deadline(self, job: 'Job', queued_since: 'datetime.datetime') -> 'datetime.datetime':
+        # The latest point in time the next archive has to exist, as bsrvstatd would check it
+        last = job.last_archive_date
+        if job.stat_maxage and last:
+            return last + job.stat_maxage
+        return queued_since + self.default_deadline
+
+    def priority(self, job: 'Job', queued_since: 'datetime.datetime', now: 'datetime.datetime') -> int:
+        # Waiting jobs gain one priority level per aging period, so none of them starves
+        if self.aging:
+            return job.priority + int((now - queued_since) / self.aging)
+        return job.priority
+
+    def effective_deadline(self, job: 'Job', queued_since: 'datetime.datetime',
+                           now: 'datetime.datetime') -> 'datetime.datetime':
+        # Each priority level, configured or gained by waiting, moves the deadline one aging period earlier. A higher
+        # priority wins over a deadline that is not too far ahead, but not over a much more urgent one.
+        step = self.aging or self.priority_step
+        return self.deadline(job, queued_since) - self.priority(job, queued_since, now) * step
+
+    def order(self, jobs: List['Job'], queued_since: Dict['Job', 'datetime.datetime'],
+              now: Union[None, 'datetime.datetime'] = None) -> List['Job']:
+        if self.name == SchedulingPolicy.FIFO:
+            return list(jobs)
+
+        now = now or datetime.datetime.now()
+        return sorted(jobs, key=lambda job: (self.effective_deadline(job, queued_since[job], now), queued_since[job]))
+
+    def describe(self, job: 'Job', queued_since: 'datetime.datetime',
+                 now: Union[None, 'datetime.datetime'] = None) -> Dict[str, str]:
+        info = {'schedule_policy': self.name}
+        if self.name == SchedulingPolicy.EDF:
+            now = now or datetime.datetime.now()
+            info['schedule_deadline'] = self.effective_deadline(job, queued_since, now).isoformat()
+            info['schedule_priority'] = str(self.priority(job, queued_since, now))
+        return info
+
+
+class CircuitBreaker:
+    @staticmethod
+    def from_config():
+        return CircuitBreaker(
+            threshold=Config.getint('borg', 'circuit_breaker_failures', fallback=0),
+            cooldown=parse_timeperiod(Config.get('borg', 'circuit_breaker_cooldown', fallback='5m')),
+            cooldown_max=parse_timeperiod(Config.get('borg', 'circuit_breaker_cooldown_max', fallback='1h'))
+        )
+
+    def __init__(self, threshold: int = 0, cooldown: Union[None, 'datetime.timedelta'] = None,
+                 cooldown_max: Union[None, 'datetime.timedelta'] = None):
+        # Opens after threshold consecutive failures of jobs with the same repository host, <= 0 disables it.
+        # While open, a single canary job probes the host after the cooldown, the others wait for it to succeed.
+        self.threshold: int = threshold
+        self.cooldown: 'datetime.timedelta' = cooldown or datetime.timedelta(minutes=5)
+        self.cooldown_max: 'datetime.timedelta' = max(cooldown_max or datetime.timedelta(hours=1), self.cooldown)
+        self.failures: Dict[str, int] = {}
+        self.circuits: Dict[str, Dict[str, Any]] = {}
+
+    def blocked_reason(self, job: 'Job', now: 'datetime.datetime') -> Union[None, str]:
+        circuit = self.circuits.get(repo_host(job.borg_repo))
+        if circuit is None:
+            return None
+        if circuit['canary'] is not None:
+            return 'host "{}" unavailable, waiting for canary job "{}"'.format(circuit['host'], circuit['canary'])
+        if now < circuit['probe_dt']:
+            return 'host "{}" unavailable, next probe at {}'.format(circuit['host'], circuit['probe_dt'])
+        return None
+
+    def acquire(self, job: 'Job'):
+        # The first job launched for an open circuit becomes the canary
+        circuit = self.circuits.get(repo_host(job.borg_repo))
+        if circuit is not None and circuit['canary'] is None:
+            circuit['canary'] = job.name
+            Logger.info('[Scheduler] Probing host "{}" with canary job "{}"'.format(circuit['host'], job.name))
+
+    def record(self, job: 'Job', successful: bool, now: 'datetime.datetime'):
+        host = repo_host(job.borg_repo)
+        if host is None or self.threshold <= 0:
+            return
+
+        circuit = self.circuits.get(host)
+        if successful:
+            self.failures.pop(host, None)
+            if circuit is not None:
+                del self.circuits[host]
+                Logger.info('[Scheduler] Host "{}" available again, resuming its jobs'.format(host))
+            return
+
+        if circuit is not None:
+            # Failures of jobs that were already running when the circuit opened do not count
+            if circuit['canary'] == job.name:
+                circuit['canary'] = None
+                circuit['probes'] += 1
+                circuit['probe_dt'] = now + self.backoff(circuit['probes'])
+                Logger.warning('[Scheduler] Canary job "{}" failed, next probe of host "{}" at {}'.format(
+                    job.name, host, circuit['probe_dt']))
+            return
+
+        self.failures[host] = self.failures.get(host, 0) + 1
+        if self.failures[host] >= self.threshold:
+            self.circuits[host] = {'host': host, 'since': now, 'probe_dt': now + self.cooldown, 'probes': 0,
+                                   'canary': None}
+            Logger.warning('[Scheduler] {} consecutive failures for host "{}", holding back its jobs until {}'.format(
+                self.failures[host], host, self.circuits[host]['probe_dt']))
+
+    def backoff(self, probes: int) -> 'datetime.timedelta':
+        # cooldown, 2 * cooldown, 4 * cooldown, ... up to cooldown_max
+        return min(self.cooldown * 2 ** min(probes, 16), self.cooldown_max)
+
+    def next_probe_dt(self, now: 'datetime.datetime') -> Union[None, 'datetime.datetime']:
+        # Only probes still ahead. Once the cooldown has passed, the probe starts with the next admitted job of the
+        # host, a wakeup for it would fire again immediately until then.
+        probes = [circuit['probe_dt'] for circuit in self.circuits.values()
+                  if circuit['canary'] is None and circuit['probe_dt'] > now]
+        return min(probes) if probes else None
@@ -1,43 +1,356 @@
+import atexit
+import datetime
 import os
-from typing import Any, Union
+import re
+import sqlite3
+import threading
+from typing import Any, Dict, List, Union
 
+from gi.repository import GLib
+
+from .catalog import Archive
 from .config import Config
 from .logger import Logger
-from .tools import parse_json, gen_json
+from .tools import gen_json, iso2datetime, parse_json
 
+# Typed per-job state and the python type of each value. catalog_dt is the time of the last full borg list, repo_state
+# the probed state of the repository when the catalog was last listed, archive_glob the borg_archive_glob of the last start.
+JOB_FIELDS = {'last_dt': datetime.datetime, 'last_size': int, 'catalog_dt': datetime.datetime, 'repo_state': str,
+              'archive_glob': str}
 
-class Cache:
-    data = None
-    file = None
+JOB_KEY = re.compile(r'^job_(?P<job>.*)_(?P<field>{})$'.format('|'.join(list(JOB_FIELDS) + ['archives'])))
 
-    @staticmethod
-    def initialize(name: str = 'bsrvd.cache'):
-        base_dir = Config.get('borg', 'base_dir')
-        Cache.file = os.path.join(base_dir, name)
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS job_state (
+        job TEXT PRIMARY KEY,
+        last_dt TEXT,
+        last_size INTEGER,
+        catalog_dt TEXT,
+        repo_state TEXT,
+        archive_glob TEXT,
+        updated TEXT NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS archives (
+        job TEXT NOT NULL,
+        name TEXT NOT NULL,
+        id TEXT,
+        start TEXT,
+        time TEXT,
+        PRIMARY KEY (job, name)
+    ) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS stat_results (
+        job TEXT PRIMARY KEY,
+        checked TEXT NOT NULL,
+        status TEXT NOT NULL,
+        last TEXT,
+        age REAL,
+        maxage REAL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS kv (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )'''
+]
+
+# Columns added after the first release, added to existing databases on startup
+ADDED_COLUMNS = [('job_state', 'catalog_dt', 'TEXT'), ('job_state', 'repo_state', 'TEXT'),
+                 ('job_state', 'archive_glob', 'TEXT')]
+
+
+def is_datetime_key(key: str) -> bool:
+    # Keys of datetime values end in _dt, e.g. job_NAME_last_dt and stat_dt
+    return key.endswith('_dt')
+
+
+class JsonCacheBackend:
+    # One JSON file per daemon. Changes are written behind, coalesced into at most one write per write_delay seconds.
+    # Archive catalogs are kept as one tab separated line per archive, stat results are not kept.
+    shared = False
+    write_delay: int = 1
+
+    def __init__(self, file: Union[None, str]):
+        self.file: Union[None, str] = file
+        self.data: Dict[str, Any] = {}
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.dirty: bool = False
+        self.write_source: Union[None, int] = None
+        if file is None:
+            return
         try:
-            with open(Cache.file, 'r') as f:
+            with open(file, 'r') as f:
                 cnt = f.read()
-                Cache.data = parse_json(cnt)
+            data = parse_json(cnt, datetime_keys=frozenset())
+            if not isinstance(data, dict):
+                raise ValueError('Expected a JSON object')
+            self.data = iso2datetime(data, frozenset(k for k in data if is_datetime_key(k)))
         except FileNotFoundError:
-            Cache.data = {}
+            pass
+        except (ValueError, AttributeError) as e:
+            # Keep the broken file for inspection, everything in the cache can be read from the repositories again
+            corrupt_file = '{}.corrupt'.format(file)
+            Logger.error('Cache file "{}" is corrupt, moved it to "{}" and starting with an empty cache: {}'.format(
+                file, corrupt_file, str(e)))
+            try:
+                os.replace(file, corrupt_file)
+            except OSError as e:
+                Logger.error('Could not move corrupt cache file: {}'.format(str(e)))
+            self.data = {}
+
+    def get(self, key: str) -> Union[None, Any]:
+        with self.lock:
+            return self.data.get(key)
+
+    def set(self, key: str, value: Any):
+        with self.lock:
+            if key in self.data and self.data[key] == value:
+                return
+            self.data[key] = value
+            self.dirty = True
+            if self.write_source is None and self.file is not None:
+                self.write_source = GLib.timeout_add_seconds(self.write_delay, self.__write)
+
+    def get_job(self, job: str, field: str) -> Union[None, Any]:
+        return self.get('job_{}_{}'.format(job, field))
+
+    def set_job(self, job: str, field: str, value: Any):
+        self.set('job_{}_{}'.format(job, field), value)
+
+    def get_archives(self, job: str) -> List['Archive']:
+        archives = []
+        for line in (self.get('job_{}_archives'.format(job)) or '').splitlines():
+            name, archive_id, start, time = line.split('\t')
+            archives.append(Archive(name, archive_id or None,
+                                    datetime.datetime.fromtimestamp(float(start)) if start else None,
+                                    datetime.datetime.fromtimestamp(float(time))))
+        return archives
+
+    def update_archives(self, job: str, added: List['Archive'], removed: List[str], replace: bool = False):
+        archives = {} if replace else {a.name: a for a in self.get_archives(job)}
+        for name in removed:
+            archives.pop(name, None)
+        archives.update((a.name, a) for a in added)
+        self.set('job_{}_archives'.format(job), '\n'.join('{}\t{}\t{}\t{}'.format(
+            a.name, a.id or '', a.start.timestamp() if a.start else '', a.time.timestamp()) for a in archives.values()))
+
+    def set_stat(self, job: str, result: Dict[str, Any]):
+        pass
+
+    def flush(self):
+        with self.write_lock:
+            with self.lock:
+                if not self.dirty or self.file is None:
+                    return
+                cnt = gen_json(self.data)
+                self.dirty = False
+            tmp_file = '{}.{}.tmp'.format(self.file, os.getpid())
+            try:
+                with open(tmp_file, 'w') as f:
+                    f.write(cnt)
+                    f.flush()
+                    os.fsync(f.fileno())
+                # Atomic, a crash leaves either the old or the new file
+                os.replace(tmp_file, self.file)
+                dir_fd = os.open(os.path.dirname(self.file) or '.', os.O_RDONLY)
+                try:
+                    os.fsync(dir_fd)
+                finally:
+                    os.close(dir_fd)
+            except OSError as e:
+                Logger.error('Could not write cache file "{}": {}'.format(self.file, str(e)))
+                with self.lock:
+                    self.dirty = True
+
+    def __write(self) -> bool:
+        with self.lock:
+            self.write_source = None
+        self.flush()
+        return False
+
+
+class SqliteCacheBackend:
+    # One database in WAL mode shared by bsrvd and bsrvstatd, readers never block the writer of the other daemon.
+    # Every change is a short transaction of its own.
+    shared = True
+
+    def __init__(self, file: str):
+        self.file: str = file
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(file, check_same_thread=False, isolation_level=None, timeout=10)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        for statement in SCHEMA:
+            self.db.execute(statement)
+        for table, column, column_type in ADDED_COLUMNS:
+            if column not in [row[1] for row in self.db.execute('PRAGMA table_info({})'.format(table))]:
+                self.db.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table, column, column_type))
+
+    def get(self, key: str) -> Union[None, Any]:
+        with self.lock:
+            row = self.db.execute('SELECT value FROM kv WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        # Values are wrapped in {"value": ...}
+        return parse_json(row[0], datetime_keys=frozenset(['value'] if is_datetime_key(key) else []))['value']
+
+    def set(self, key: str, value: Any):
+        self.__write('INSERT INTO kv (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value',
+                     (key, gen_json({'value': value})))
+
+    def get_job(self, job: str, field: str) -> Union[None, Any]:
+        with self.lock:
+            row = self.db.execute('SELECT {} FROM job_state WHERE job = ?'.format(field), (job,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return datetime.datetime.fromisoformat(row[0]) if JOB_FIELDS[field] is datetime.datetime else row[0]
+
+    def set_job(self, job: str, field: str, value: Any):
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        self.__write('INSERT INTO job_state (job, {0}, updated) VALUES (?, ?, ?) '
+                     'ON CONFLICT (job) DO UPDATE SET {0} = excluded.{0}, updated = excluded.updated'.format(field),
+                     (job, value, datetime.datetime.now().isoformat()))
+
+    def get_archives(self, job: str) -> List['Archive']:
+        with self.lock:
+            rows = self.db.execute('SELECT name, id, start, time FROM archives WHERE job = ?', (job,)).fetchall()
+        return [Archive(name, archive_id, datetime.datetime.fromisoformat(start) if start else None,
+                        datetime.datetime.fromisoformat(time)) for name, archive_id, start, time in rows]
+
+    def update_archives(self, job: str, added: List['Archive'], removed: List[str], replace: bool = False):
+        try:
+            with self.lock:
+                self.db.execute('BEGIN IMMEDIATE')
+                try:
+                    if replace:
+                        self.db.execute('DELETE FROM archives WHERE job = ?', (job,))
+                    self.db.executemany('DELETE FROM archives WHERE job = ? AND name = ?',
+                                        [(job, name) for name in removed])
+                    self.db.executemany('INSERT OR REPLACE INTO archives (job, name, id, start, time) '
+                                        'VALUES (?, ?, ?, ?, ?)',
+                                        [(job, a.name, a.id, a.start.isoformat() if a.start else None,
+                                          a.time.isoformat()) for a in added])
+                except sqlite3.Error:
+                    self.db.execute('ROLLBACK')
+                    raise
+                self.db.execute('COMMIT')
+        except sqlite3.Error as e:
+            Logger.error('Could not write to state database "{}": {}'.format(self.file, str(e)))
+
+    def set_stat(self, job: str, result: Dict[str, Any]):
+        values = [result.get(column) for column in ['checked', 'status', 'last', 'age', 'maxage']]
+        values = [v.isoformat() if isinstance(v, datetime.datetime) else v for v in values]
+        self.__write('INSERT OR REPLACE INTO stat_results (job, checked, status, last, age, maxage) '
+                     'VALUES (?, ?, ?, ?, ?, ?)', [job] + values)
+
+    def flush(self):
+        pass
+
+    def __write(self, statement: str, params):
+        try:
+            with self.lock:
+                self.db.execute(statement, params)
+        except sqlite3.Error as e:
+            Logger.error('Could not write to state database "{}": {}'.format(self.file, str(e)))
+
+
+class Cache:
+    # State kept between restarts: last archive dates and sizes, archive catalogs and stat results.
+    # With cache_backend: sqlite, bsrvd and bsrvstatd share one database and see each others state.
+    backend: Union[None, JsonCacheBackend, SqliteCacheBackend] = None
 
     @staticmethod
-    def get(key: str) -> Union[None, Any]:
-        if Cache.data is None:
+    def initialize(name: str = 'bsrvd.cache', persistent: bool = True):
+        if not persistent:
+            Cache.backend = JsonCacheBackend(None)
+            return
+        base_dir = Config.get('borg', 'base_dir')
+        json_file = os.path.join(base_dir, name)
+        backend = Config.get('borg', 'cache_backend', fallback='json').lower()
+        if backend == 'sqlite':
+            state_file = Config.get('borg', 'state_file', fallback=os.path.join(base_dir, 'bsrv.state.sqlite'))
+            try:
+                Cache.backend = SqliteCacheBackend(state_file)
+            except sqlite3.Error as e:
+                Logger.error('Could not open state database "{}", using "{}" instead: {}'.format(
+                    state_file, json_file, str(e)))
+            else:
+                if os.path.exists(json_file) and not Cache.backend.get('imported_' + name):
+                    Cache.__import_json(json_file)
+                    Cache.backend.set('imported_' + name, True)
+                return
+        elif backend != 'json':
+            Logger.error('Error in config file: cache_backend can only be "json" or "sqlite". Ignoring "{}"'.format(
+                backend))
+        Cache.backend = JsonCacheBackend(json_file)
+        atexit.register(Cache.flush)
+
+    @staticmethod
+    def __import_json(json_file: str):
+        # Switching to sqlite keeps the state of the previous JSON cache, without overwriting what is already known
+        Logger.info('Importing cache file "{}" into the state database'.format(json_file))
+        old = JsonCacheBackend(json_file)
+        for key, value in old.data.items():
+            match = JOB_KEY.match(key)
+            if match and match.group('field') == 'archives':
+                if not Cache.backend.get_archives(match.group('job')):
+                    Cache.backend.update_archives(match.group('job'), old.get_archives(match.group('job')), [],
+                                                  replace=True)
+            elif match:
+                if Cache.backend.get_job(match.group('job'), match.group('field')) is None:
+                    Cache.backend.set_job(match.group('job'), match.group('field'), value)
+            elif Cache.backend.get(key) is None:
+                Cache.backend.set(key, value)
+
+    @staticmethod
+    def __backend() -> Union[JsonCacheBackend, SqliteCacheBackend]:
+        if Cache.backend is None:
             raise RuntimeError('Cache was never initialized')
-        try:
-            return Cache.data[key]
-        except KeyError:
-            return None
+        return Cache.backend
+
+    @staticmethod
+    def shared() -> bool:
+        return Cache.__backend().shared
+
+    @staticmethod
+    def get(key: str) -> Union[None, Any]:
+        return Cache.__backend().get(key)
 
     @staticmethod
     def set(key: str, value: Any):
-        if Cache.data is None:
-            raise RuntimeError('Cache was never initialized')
-        Cache.data[key] = value
-        try:
-            with open(Cache.file, 'w') as f:
-                cnt = gen_json(Cache.data)
-                f.write(cnt)
-        except:
-            Logger.error('Could not write cache file "{}".'.format(Cache.file))
+        Cache.__backend().set(key, value)
+
+    @staticmethod
+    def get_job(job: str, field: str) -> Union[None, Any]:
+        if field not in JOB_FIELDS:
+            raise KeyError('Unknown job state "{}"'.format(field))
+        return Cache.__backend().get_job(job, field)
+
+    @staticmethod
+    def set_job(job: str, field: str, value: Any):
+        if field not in JOB_FIELDS:
+            raise KeyError('Unknown job state "{}"'.format(field))
+        Cache.__backend().set_job(job, field, value)
+
+    @staticmethod
+    def get_archives(job: str) -> Union[None, List['Archive']]:
+        # None if the repository was never listed completely
+        if Cache.get_job(job, 'catalog_dt') is None:
+            return None
+        return Cache.__backend().get_archives(job)
+
+    @staticmethod
+    def update_archives(job: str, added: List['Archive'], removed: List[str] = (), replace: bool = False):
+        Cache.__backend().update_archives(job, added, removed, replace)
+        if replace:
+            Cache.set_job(job, 'catalog_dt', datetime.datetime.now())
+
+    @staticmethod
+    def set_stat(job: str, result: Dict[str, Any]):
+        Cache.__backend().set_stat(job, result)
+
+    @staticmethod
+    def flush():
+        # Called at exit, writes pending changes immediately
+        if Cache.backend is not None:
+            Cache.backend.flush()
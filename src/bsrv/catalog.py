@@ -0,0 +1,80 @@
+import bisect
+import datetime
+from typing import Any, Dict, Iterable, List, Set, Tuple, Union
+
+
+def to_datetime(value: Any) -> Union[None, 'datetime.datetime']:
+    if isinstance(value, datetime.datetime) or value is None:
+        return value
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class Archive:
+    __slots__ = ('name', 'id', 'start', 'time')
+
+    def __init__(self, name: str, archive_id: Union[None, str], start: Union[None, 'datetime.datetime'],
+                 time: 'datetime.datetime'):
+        self.name: str = name
+        self.id: Union[None, str] = archive_id
+        self.start: Union[None, 'datetime.datetime'] = start
+        self.time: 'datetime.datetime' = time
+
+    @staticmethod
+    def from_borg(archive: Dict[str, Any]) -> 'Archive':
+        # An entry of borg list --json or the archive of borg create --json, which has no time but start
+        start = to_datetime(archive.get('start'))
+        return Archive(archive.get('name', archive.get('archive')), archive.get('id'), start,
+                       to_datetime(archive.get('time')) or start)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'archive': self.name, 'name': self.name, 'id': self.id, 'start': self.start, 'time': self.time}
+
+
+class ArchiveCatalog:
+    # Archives of one repository ordered by time, the newest last. Kept up to date from borg create, borg prune and
+    # borg list --last, so that a full borg list is rarely needed.
+    def __init__(self, archives: Iterable['Archive'] = ()):
+        self.archives: List['Archive'] = sorted(archives, key=lambda a: a.time)
+        self.times: List['datetime.datetime'] = [a.time for a in self.archives]
+        self.names: Set[str] = {a.name for a in self.archives}
+
+    def __len__(self) -> int:
+        return len(self.archives)
+
+    @property
+    def latest(self) -> Union[None, 'Archive']:
+        return self.archives[-1] if self.archives else None
+
+    def add(self, archive: 'Archive'):
+        if archive.name in self.names:
+            self.remove([archive.name])
+        # New archives are the newest, appending is the common case
+        k = bisect.bisect_right(self.times, archive.time)
+        self.archives.insert(k, archive)
+        self.times.insert(k, archive.time)
+        self.names.add(archive.name)
+
+    def remove(self, names: Iterable[str]) -> List[str]:
+        names = set(names) & self.names
+        if names:
+            self.archives = [a for a in self.archives if a.name not in names]
+            self.times = [a.time for a in self.archives]
+            self.names -= names
+        return list(names)
+
+    def merge_newest(self, newest: List['Archive']) -> Union[None, Tuple[List['Archive'], List[str]]]:
+        # Merges the result of borg list --last N. Archives missing in it that are not older than the oldest listed
+        # one were deleted. Returns the added archives and deleted names, or None if archives may be missing between
+        # the catalog and the listed ones, which needs a full listing.
+        if not newest or not any(a.name in self.names for a in newest):
+            return None
+        oldest = min(a.time for a in newest)
+        listed = {a.name for a in newest}
+        deleted = self.remove([a.name for a in self.archives if a.time >= oldest and a.name not in listed])
+        added = [a for a in newest if a.name not in self.names]
+        for archive in added:
+            self.add(archive)
+        return added, deleted
@@ -0,0 +1,66 @@
+import datetime
+import heapq
+import itertools
+from typing import Any, Callable, List, Set, Tuple
+
+from gi.repository import GLib
+
+
+class Clock:
+    # Wall clock and GLib main loop sources, used by the scheduler for everything time related
+    def now(self) -> 'datetime.datetime':
+        return datetime.datetime.now()
+
+    def idle_add(self, func: Callable[..., bool], *args: Any) -> int:
+        return GLib.idle_add(func, *args)
+
+    def timeout_add(self, milliseconds: int, func: Callable[..., bool], *args: Any) -> int:
+        return GLib.timeout_add(milliseconds, func, *args)
+
+    def source_remove(self, source: int):
+        GLib.source_remove(source)
+
+
+class VirtualClock(Clock):
+    # Simulated time without a main loop, run_until() calls the sources in order of their due time without waiting.
+    # Sources are called once, their return value is ignored.
+
+    # Sources called at the same virtual time before run_until() gives up, more mean they keep re-arming each other
+    max_sources_per_instant: int = 100000
+
+    def __init__(self, start: 'datetime.datetime'):
+        self.current: 'datetime.datetime' = start
+        self.sources: List[Tuple['datetime.datetime', int, Callable[..., bool], Tuple[Any, ...]]] = []
+        self.counter = itertools.count(1)
+        self.removed: Set[int] = set()
+
+    def now(self) -> 'datetime.datetime':
+        return self.current
+
+    def idle_add(self, func: Callable[..., bool], *args: Any) -> int:
+        return self.timeout_add(0, func, *args)
+
+    def timeout_add(self, milliseconds: int, func: Callable[..., bool], *args: Any) -> int:
+        source = next(self.counter)
+        heapq.heappush(self.sources, (self.current + datetime.timedelta(milliseconds=milliseconds), source, func, args))
+        return source
+
+    def source_remove(self, source: int):
+        self.removed.add(source)
+
+    def run_until(self, end: 'datetime.datetime'):
+        calls = 0
+        while self.sources and self.sources[0][0] <= end:
+            dt, source, func, args = heapq.heappop(self.sources)
+            if source in self.removed:
+                self.removed.discard(source)
+                continue
+            if dt > self.current:
+                self.current = dt
+                calls = 0
+            calls += 1
+            if calls > self.max_sources_per_instant:
+                raise RuntimeError('Time does not advance at {}, {} sources were called without delay, last {}'.format(
+                    self.current, calls - 1, getattr(func, '__qualname__', func)))
+            func(*args)
+        self.current = max(self.current, end)
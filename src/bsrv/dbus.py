@@ -1,19 +1,24 @@
 import concurrent.futures
 import datetime
 import signal
-from typing import TYPE_CHECKING
+from typing import Any, Callable, TYPE_CHECKING
 
 from dasbus.connection import SessionMessageBus, SystemMessageBus
 from dasbus.identifier import DBusServiceIdentifier
 from dasbus.loop import EventLoop
+from dasbus.server.handler import ServerObjectHandler
 from dasbus.server.interface import dbus_interface, dbus_signal
 from dasbus.typing import Str, List, Dict, Bool, Int
+from gi.repository import GLib
 
 from bsrv.tools import gen_json
+from .diagnostics import Diagnostics
+from .history import History
 from .logger import Logger
+from .metrics import Metrics, timed
 
 if TYPE_CHECKING:
-    from .job import Scheduler
+    from .job import Job, Scheduler
 
 SYSTEM_BUS = SystemMessageBus()
 SESSION_BUS = SessionMessageBus()
@@ -26,6 +31,42 @@ TMP_SERVICE_IDENTIFIER = DBusServiceIdentifier(
 pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
 
 
+def run_in_pool(work: Callable[[], Any],
+                finish: Callable[[Any], Any] = lambda result: result) -> 'concurrent.futures.Future':
+    # Runs work in the worker pool, then finish with its result on the main loop. Blocking borg calls on the main loop
+    # would stall the scheduler and the output readers of running borg processes.
+    future = concurrent.futures.Future()
+
+    def complete(work_future: 'concurrent.futures.Future') -> bool:
+        try:
+            future.set_result(finish(work_future.result()))
+        except Exception as e:
+            future.set_exception(e)
+        return False
+
+    pool.submit(work).add_done_callback(lambda work_future: GLib.idle_add(complete, work_future))
+    return future
+
+
+class AsyncServerObjectHandler(ServerObjectHandler):
+    # Methods may return a Future, the reply is sent once it is done
+    def _handle_method_result(self, invocation, method_spec, method_reply):
+        if isinstance(method_reply, concurrent.futures.Future):
+            method_reply.add_done_callback(
+                lambda future: GLib.idle_add(self.__reply, invocation, method_spec, future))
+        else:
+            super()._handle_method_result(invocation, method_spec, method_reply)
+
+    def __reply(self, invocation, method_spec, future: 'concurrent.futures.Future') -> bool:
+        try:
+            method_reply = future.result()
+        except Exception as e:
+            self._handle_method_error(invocation, method_spec.interface_name, method_spec.name, e)
+        else:
+            super()._handle_method_result(invocation, method_spec, method_reply)
+        return False
+
+
 def get_dbus_service_identifier(message_bus):
     return DBusServiceIdentifier(
         namespace=TMP_SERVICE_IDENTIFIER.namespace,
@@ -43,6 +84,10 @@ class DBusInterface(object):
     def StatusUpdateNotifier(self, job_name: Str, scheduler_status: Str, retry: Int):
         pass
 
+    @dbus_signal
+    def ProgressNotifier(self, job_name: Str, progress: Dict[Str, Str]):
+        pass
+
     @dbus_signal
     def PauseNotifier(self, is_paused: Bool):
         pass
@@ -51,48 +96,74 @@ class DBusInterface(object):
     def JobInfoNotifier(self, job_name: str, info: str):
         pass
 
+    @timed('bsrv_dbus_method_seconds', 'method')
     def SetPause(self, is_paused: Bool):
         if is_paused:
             self.scheduler.pause()
         else:
             self.scheduler.unpause()
 
+    @timed('bsrv_dbus_method_seconds', 'method')
     def GetPause(self) -> Bool:
         return self.scheduler.paused
 
+    @timed('bsrv_dbus_method_seconds', 'method')
     def GetLoadedJobs(self) -> List[Str]:
         return [job.name for job in self.scheduler.jobs]
 
+    @timed('bsrv_dbus_method_seconds', 'method')
     def GetJobStatus(self, job_name: Str) -> Dict[Str, Str]:
         job = self.scheduler.find_job_by_name(job_name)
         if not job:
             return {}
-        else:
+        elif job.last_archive_date:
+            # job.status() only runs borg list if the date of the last archive is unknown
             return self.scheduler.get_job_status(job)
+        else:
+            return run_in_pool(job.status, lambda status: self.scheduler.add_schedule_status(job, status))
 
+    @timed('bsrv_dbus_method_seconds', 'method')
     def RequestJobInfo(self, job_name: Str) -> Bool:
         job = self.scheduler.find_job_by_name(job_name)
         if not job:
             return False
-        future = pool.submit(lambda: gen_json(self.job_info(job_name)))
+        future = self.job_info(job)
         future.add_done_callback(lambda fut: self.JobInfoNotifier(job_name, fut.result()))
         return True
 
+    @timed('bsrv_dbus_method_seconds', 'method')
     def GetJobInfo(self, job_name: Str) -> str:
         job = self.scheduler.find_job_by_name(job_name)
         if not job:
             return ''
-        return gen_json(self.job_info(job_name))
-
-    def job_info(self, job_name: str) -> dict:
-        job = self.scheduler.find_job_by_name(job_name)
-        if not job:
-            return {}
-        scheduler_info = self.scheduler.get_job_status(job)
-        job_info = job.get_info()
-        job_info['scheduler'] = scheduler_info
-        return job_info
-
+        return self.job_info(job)
+
+    def job_info(self, job: 'Job') -> 'concurrent.futures.Future':
+        # JSON of borg info and the job status, the scheduler part is added on the main loop
+        def finish(result):
+            job_info, job_status = result
+            job_info['scheduler'] = self.scheduler.add_schedule_status(job, job_status)
+            return gen_json(job_info)
+
+        return run_in_pool(lambda: (job.get_info(), job.status()), finish)
+
+    @timed('bsrv_dbus_method_seconds', 'method')
+    def GetHistory(self, job_name: Str, before: Int, limit: Int) -> Str:
+        # Newest runs first, an empty job_name returns runs of all jobs. Pass the smallest returned id as before to get
+        # the next page.
+        return gen_json({'runs': History.get(job_name, before, limit)})
+
+    @timed('bsrv_dbus_method_seconds', 'method')
+    def GetMetrics(self) -> Str:
+        # Snapshot of all gauges, counters and latency histograms, also available if the exporter is disabled
+        return gen_json(Metrics.snapshot())
+
+    @timed('bsrv_dbus_method_seconds', 'method')
+    def DumpDiagnostics(self, profile_seconds: Int, tracemalloc_top: Int) -> Str:
+        # Returns the path of the dump, which is written after profile_seconds
+        return Diagnostics.dump(self.scheduler, profile_seconds, tracemalloc_top)
+
+    @timed('bsrv_dbus_method_seconds', 'method')
     def RunJob(self, job_name: Str) -> Bool:
         job = self.scheduler.find_job_by_name(job_name)
         if not job:
@@ -103,23 +174,23 @@ class DBusInterface(object):
             else:
                 return self.scheduler.schedule(job, datetime.datetime.now())
 
+    @timed('bsrv_dbus_method_seconds', 'method')
     def MountRepo(self, job_name: Str) -> Str:
         job = self.scheduler.find_job_by_name(job_name)
         if not job:
             return ''
         else:
-            if job.mount():
-                return job.mount_dir
-            else:
-                return ''
+            return run_in_pool(job.mount, lambda mounted: job.mount_dir if mounted else '')
 
+    @timed('bsrv_dbus_method_seconds', 'method')
     def UMountRepo(self, job_name: Str) -> Bool:
         job = self.scheduler.find_job_by_name(job_name)
         if not job:
             return False
         else:
-            return job.umount()
+            return run_in_pool(job.umount)
 
+    @timed('bsrv_dbus_method_seconds', 'method')
     def Shutdown(self):
         Logger.info('Received Shutdown command via DBus')
 
@@ -130,28 +201,53 @@ class MainLoop:
         self.scheduler = scheduler
         self.scheduler.status_update_callback = self.__status_update_handler
         self.scheduler.pause_callback = self.__pause_handler
+        self.scheduler.progress_callback = self.__progress_handler
         self.bus = bus
         self.service_identifier = get_dbus_service_identifier(bus)
         self.loop = EventLoop()
+        self.stopping = False
 
     def start(self):
-        self.bus.publish_object(self.service_identifier.object_path, self.interface)
+        # DBus, the scheduler and all borg and hook child processes are served by this single GLib main loop
+        self.bus.publish_object(self.service_identifier.object_path, self.interface,
+                                server_factory=AsyncServerObjectHandler)
         self.bus.register_service(self.service_identifier.service_name)
-        signal.signal(signal.SIGTERM, self.__sigterm_handler)
+        GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGTERM, self.__sigterm_handler)
+        GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGUSR1, self.__sigusr1_handler)
+        # Registered after the main loop handler, which is chained
+        Diagnostics.register_stacks_signal(signal.SIGUSR1)
         try:
             self.loop.run()
         finally:
             self.bus.disconnect()
 
-    def __sigterm_handler(self, signal_number, frame):
+    def __sigterm_handler(self) -> bool:
         Logger.info('Received SIGTERM')
         self.stop()
+        return True
+
+    def __sigusr1_handler(self) -> bool:
+        Logger.info('Received SIGUSR1, dumping diagnostics')
+        Diagnostics.dump(self.scheduler)
+        return True
 
     def __status_update_handler(self, job_name: str, scheduler_status: str, retry: int):
         self.interface.StatusUpdateNotifier(job_name, scheduler_status, retry)
 
+    def __progress_handler(self, job_name: str, progress: dict):
+        self.interface.ProgressNotifier(job_name, progress)
+
     def __pause_handler(self, is_paused: bool):
         self.interface.PauseNotifier(is_paused)
 
     def stop(self):
-        self.loop.quit()
+        if self.stopping:
+            Logger.warning('Stopping without waiting for running jobs')
+            self.loop.quit()
+        else:
+            self.stopping = True
+            self.scheduler.stop(on_stopped=self.__quit)
+
+    def __quit(self):
+        # Quit after pending idle callbacks, e.g. hooks triggered by the last finished job, were dispatched
+        GLib.idle_add(self.loop.quit)
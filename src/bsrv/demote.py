@@ -1,12 +1,18 @@
 import os
 import subprocess
 import pwd
+from typing import Union, TYPE_CHECKING
+
 from .logger import Logger
 
+if TYPE_CHECKING:
+    from .resources import ResourceControl
+
 
 class DemotionSubprocess:
-    def __init__(self, username: str, parent_descr: str):
+    def __init__(self, username: str, parent_descr: str, resources: Union[None, 'ResourceControl'] = None):
         self.parent_descr = parent_descr
+        self.resources = resources
         self.is_demotion = False
         self.name = username
         confirmed = False
@@ -49,5 +55,13 @@ class DemotionSubprocess:
 
         return demote_
 
-    def Popen(self, *args, **kwargs):
-        return subprocess.Popen(*args, **kwargs, preexec_fn=self.demote_fn(self.uid, self.gid))
+    def Popen(self, args, **kwargs):
+        if self.resources is None or not self.resources.active():
+            return subprocess.Popen(args, **kwargs, preexec_fn=self.demote_fn(self.uid, self.gid))
+
+        if self.resources.cgroup_properties:
+            # systemd-run has to be started privileged and switches to the demoted user itself
+            return subprocess.Popen(self.resources.scope_command(self) + list(args), **kwargs,
+                                    preexec_fn=self.resources.limit_fn())
+        return subprocess.Popen(args, **kwargs,
+                                preexec_fn=self.resources.limit_fn(then=self.demote_fn(self.uid, self.gid)))
@@ -0,0 +1,157 @@
+import cProfile
+import datetime
+import faulthandler
+import io
+import os
+import pstats
+import sys
+import threading
+import traceback
+import tracemalloc
+from typing import IO, List, Union, TYPE_CHECKING
+
+from gi.repository import GLib
+
+from .config import Config
+from .logger import Logger
+
+if TYPE_CHECKING:
+    from .job import Scheduler
+
+
+class Diagnostics:
+    # Dumps the state of the daemon on SIGUSR1 or DumpDiagnostics, for debugging without restarting it
+    directory: Union[None, str] = None
+    profile_seconds: int = 0
+    tracemalloc_top: int = 0
+    pending: bool = False
+    stacks_file: Union[None, IO] = None
+
+    @staticmethod
+    def initialize():
+        Diagnostics.directory = Config.get('diagnostics', 'dir', fallback=Config.get('borg', 'base_dir'))
+        Diagnostics.profile_seconds = Config.getint('diagnostics', 'profile_seconds', fallback=0)
+        Diagnostics.tracemalloc_top = Config.getint('diagnostics', 'tracemalloc_top', fallback=0)
+        if Diagnostics.tracemalloc_top > 0:
+            # Tracing from the start makes the snapshot cover the whole lifetime, at the cost of some overhead
+            tracemalloc.start()
+
+    @staticmethod
+    def register_stacks_signal(signum: int):
+        # Python code does not run while the main loop is stuck, faulthandler writes the stacks from the C signal
+        # handler and then calls the previously installed handler of the main loop.
+        path = os.path.join(Diagnostics.directory, 'bsrvd.stacks.txt')
+        try:
+            Diagnostics.stacks_file = open(path, 'a')
+            faulthandler.register(signum, file=Diagnostics.stacks_file, all_threads=True, chain=True)
+        except (OSError, RuntimeError, ValueError) as e:
+            Logger.error('Could not register stack dump to "{}": {}'.format(path, str(e)))
+
+    @staticmethod
+    def dump(scheduler: 'Scheduler', profile_seconds: Union[None, int] = None,
+             tracemalloc_top: Union[None, int] = None) -> str:
+        # Must be called from the main loop. Returns the path of the dump, which is written after profile_seconds.
+        profile_seconds = Diagnostics.profile_seconds if profile_seconds is None else max(0, profile_seconds)
+        tracemalloc_top = Diagnostics.tracemalloc_top if tracemalloc_top is None else max(0, tracemalloc_top)
+        now = datetime.datetime.now()
+        path = os.path.join(Diagnostics.directory, 'bsrvd.diagnostics.{:%Y-%m-%d_%H-%M-%S}.txt'.format(now))
+
+        sections = [('bsrvd diagnostics', ['time: {}'.format(now.isoformat()), 'pid: {}'.format(os.getpid())]),
+                    ('Threads', Diagnostics.__threads()),
+                    ('Scheduler', Diagnostics.__scheduler(scheduler))]
+
+        if Diagnostics.pending:
+            Logger.warning('Diagnostics are already being collected, dumping without profile')
+            profile_seconds = 0
+        profiler = None
+        tracemalloc_started = False
+        if profile_seconds > 0:
+            # Profiles everything running on the main loop: scheduler, DBus, child process io and hooks
+            profiler = cProfile.Profile()
+            profiler.enable()
+        if tracemalloc_top > 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            tracemalloc_started = True
+
+        if profile_seconds > 0 or tracemalloc_started:
+            # Allocations are only traced from now on if tracing was not enabled at startup
+            duration = profile_seconds or 10
+            Diagnostics.pending = True
+            Logger.info('Collecting diagnostics for {} s, writing to "{}"'.format(duration, path))
+            GLib.timeout_add_seconds(duration, Diagnostics.__finish, path, sections, profiler, profile_seconds,
+                                     tracemalloc_top, tracemalloc_started)
+        else:
+            Diagnostics.__finish(path, sections, None, 0, tracemalloc_top, False)
+        return path
+
+    @staticmethod
+    def __finish(path: str, sections: list, profiler: Union[None, 'cProfile.Profile'], profile_seconds: int,
+                 tracemalloc_top: int, tracemalloc_started: bool) -> bool:
+        Diagnostics.pending = False
+        if profiler is not None:
+            profiler.disable()
+        if tracemalloc_top > 0 and tracemalloc.is_tracing():
+            # Before the profile is evaluated, which allocates a lot itself
+            snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, cProfile.__file__),
+                                                                  tracemalloc.Filter(False, tracemalloc.__file__)])
+            current, peak = tracemalloc.get_traced_memory()
+            if tracemalloc_started:
+                tracemalloc.stop()
+            lines = ['Allocations since {}'.format('the dump was requested' if tracemalloc_started
+                                                   else 'the start of the daemon'),
+                     'traced: {} bytes, peak: {} bytes'.format(current, peak)]
+            lines += [str(stat) for stat in snapshot.statistics('lineno')[:tracemalloc_top]]
+            sections.append(('Top {} allocations'.format(tracemalloc_top), lines))
+        if profiler is not None:
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(50)
+            sections.append(('Profile of the main loop for {} s'.format(profile_seconds), out.getvalue().splitlines()))
+
+        try:
+            with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                for title, lines in sections:
+                    f.write('== {} ==\n'.format(title))
+                    for line in lines:
+                        f.write(line + '\n')
+                    f.write('\n')
+        except OSError as e:
+            Logger.error('Could not write diagnostics to "{}": {}'.format(path, str(e)))
+        else:
+            Logger.info('Wrote diagnostics to "{}"'.format(path))
+        return False
+
+    @staticmethod
+    def __threads() -> List[str]:
+        lines = []
+        threads = {thread.ident: thread for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            thread = threads.get(ident)
+            lines.append('Thread "{}" ({}{}):'.format(thread.name if thread else '?', ident,
+                                                      ', daemon' if thread and thread.daemon else ''))
+            lines += [line.rstrip('\n') for line in traceback.format_stack(frame)]
+        return lines
+
+    @staticmethod
+    def __scheduler(scheduler: 'Scheduler') -> List[str]:
+        now = datetime.datetime.now()
+        lines = ['running: {}, paused: {}, next action: {}'.format(scheduler.running, scheduler.paused,
+                                                                   scheduler.next_dt),
+                 'running jobs: {}'.format(', '.join(job.name for job in scheduler.jobs_running) or '-'),
+                 'queued jobs: {}'.format(', '.join('{} (since {})'.format(job.name, scheduler.queued_since.get(job))
+                                                    for job in scheduler.jobs_queued) or '-')]
+        for circuit in scheduler.breaker.circuits.values():
+            lines.append('circuit open for {}: since {}, next probe {}, canary {}'.format(
+                circuit['host'], circuit['since'], circuit['probe_dt'],
+                circuit['canary'] or '-'))
+
+        lines.append('queue ({} entries):'.format(len(scheduler.queue)))
+        for dt, jobs in scheduler.queue.get_waiting().items():
+            lines.append('  {} (in {}): {}'.format(dt, dt - now, ', '.join(job.name for job in jobs)))
+
+        # Only cached state, the daemon may be stuck in borg already
+        lines.append('jobs:')
+        for job in scheduler.jobs:
+            lines.append('  {}: last archive {}, retry {}, deferral {}{}'.format(
+                job.name, job.last_archive_date, job.retry_count, scheduler.deferrals.get(job),
+                ', progress {}'.format(job.progress) if job.progress else ''))
+        return lines
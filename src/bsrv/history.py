@@ -0,0 +1,115 @@
+import datetime
+import json
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, List, Union
+
+from .config import Config
+from .logger import Logger
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        job TEXT NOT NULL,
+        started TEXT NOT NULL,
+        finished TEXT NOT NULL,
+        successful INTEGER NOT NULL,
+        retry INTEGER NOT NULL,
+        archive TEXT,
+        create_duration REAL,
+        prune_duration REAL,
+        hook_duration REAL,
+        original_size INTEGER,
+        compressed_size INTEGER,
+        deduplicated_size INTEGER,
+        nfiles INTEGER,
+        error TEXT,
+        stats TEXT,
+        usage TEXT
+    )''',
+    'CREATE INDEX IF NOT EXISTS runs_job_id ON runs (job, id)',
+    'CREATE INDEX IF NOT EXISTS runs_started ON runs (started)'
+]
+
+COLUMNS = ['job', 'started', 'finished', 'successful', 'retry', 'archive', 'create_duration', 'prune_duration',
+           'hook_duration', 'original_size', 'compressed_size', 'deduplicated_size', 'nfiles', 'error', 'stats', 'usage']
+
+# Columns added after the first release, added to existing databases on startup
+ADDED_COLUMNS = [('usage', 'TEXT')]
+
+
+class History:
+    # Append-only record of all job runs, one row per run
+    db: Union[None, 'sqlite3.Connection'] = None
+    lock = threading.Lock()
+
+    @staticmethod
+    def initialize(name: str = 'bsrvd.history.sqlite'):
+        path = Config.get('borg', 'history_file', fallback=os.path.join(Config.get('borg', 'base_dir'), name))
+        try:
+            History.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            for statement in SCHEMA:
+                History.db.execute(statement)
+            existing = [row[1] for row in History.db.execute('PRAGMA table_info(runs)')]
+            for column, column_type in ADDED_COLUMNS:
+                if column not in existing:
+                    History.db.execute('ALTER TABLE runs ADD COLUMN {} {}'.format(column, column_type))
+        except sqlite3.Error as e:
+            Logger.error('Could not open history database "{}": {}'.format(path, str(e)))
+            History.db = None
+
+    @staticmethod
+    def add(run: Dict[str, Any]) -> Union[None, int]:
+        if History.db is None:
+            return None
+        values = [run.get(column) for column in COLUMNS]
+        values = [v.isoformat() if isinstance(v, datetime.datetime) else v for v in values]
+        try:
+            with History.lock:
+                cursor = History.db.execute('INSERT INTO runs ({}) VALUES ({})'.format(
+                    ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))), values)
+                return cursor.lastrowid
+        except sqlite3.Error as e:
+            Logger.error('Could not write to history database: {}'.format(str(e)))
+            return None
+
+    @staticmethod
+    def set_hook_duration(run_id: int, duration: float):
+        # Hooks finish after the run was recorded
+        if History.db is None or run_id is None:
+            return
+        try:
+            with History.lock:
+                History.db.execute('UPDATE runs SET hook_duration = ? WHERE id = ?', (duration, run_id))
+        except sqlite3.Error as e:
+            Logger.error('Could not write to history database: {}'.format(str(e)))
+
+    @staticmethod
+    def get(job_name: Union[None, str] = None, before: int = 0, limit: int = 50) -> List[Dict[str, Any]]:
+        # Newest runs first. Pass the id of the last returned run as before to get the next page.
+        if History.db is None:
+            return []
+        where = []
+        params = []
+        if job_name:
+            where.append('job = ?')
+            params.append(job_name)
+        if before > 0:
+            where.append('id < ?')
+            params.append(before)
+        query = 'SELECT id, {} FROM runs {} ORDER BY id DESC LIMIT ?'.format(
+            ', '.join(COLUMNS), 'WHERE ' + ' AND '.join(where) if where else '')
+        params.append(max(0, min(limit, 1000)))
+        try:
+            with History.lock:
+                rows = History.db.execute(query, params).fetchall()
+        except sqlite3.Error as e:
+            Logger.error('Could not read from history database: {}'.format(str(e)))
+            return []
+        runs = [dict(zip(['id'] + COLUMNS, row)) for row in rows]
+        for run in runs:
+            run['successful'] = bool(run['successful'])
+            run['stats'] = json.loads(run['stats']) if run['stats'] else None
+            run['usage'] = json.loads(run['usage']) if run['usage'] else None
+        return runs
@@ -1,12 +1,17 @@
 import os
 import shlex
 import subprocess
-import threading
-from typing import Union, NoReturn, List, TYPE_CHECKING
+import time
+from typing import Callable, Union, NoReturn, List, TYPE_CHECKING
+
+from gi.repository import GLib
 
 from .logger import Logger
+from .metrics import Metrics
 from .demote import DemotionSubprocess
 from .config import Config
+from .process import ChildProcess, format_usage
+from .resources import ResourceControl
 
 if TYPE_CHECKING:
     pass
@@ -21,59 +26,91 @@ class Hook:
                                                                                                               'hook_timeout',
                                                                                                               fallback=20)))
         run_as = Config.get(cfg_section, name + '_run_as', fallback=Config.get('borg', name + '_run_as', fallback=None))
-        return Hook(name=name, command_string=command_str, timeout=timeout, run_as=run_as)
+        return Hook(name=name, command_string=command_str, timeout=timeout, run_as=run_as,
+                    resources=ResourceControl.from_config(cfg_section) if command_str else None)
 
-    def __init__(self, name: str, command_string: str, timeout: int, run_as: Union[str, None]):
+    def __init__(self, name: str, command_string: str, timeout: int, run_as: Union[str, None],
+                 resources: Union[None, ResourceControl] = None):
         self.parent_descr: Union[str, None] = None
         self.name: str = name
         self.command: List[str] = shlex.split(command_string)
         self.timeout: int = timeout
-        self.task: Union[None, 'subprocess.Popen'] = None
-        self.demotion = DemotionSubprocess(run_as, parent_descr='Hook:{}'.format(self.name))
+        self.task: Union[None, 'ChildProcess'] = None
+        self.demotion = DemotionSubprocess(run_as, parent_descr='Hook:{}'.format(self.name), resources=resources)
 
     def set_parent_description(self, parent_descr: str):
         self.parent_descr = parent_descr
 
-    def trigger(self, env: dict = None) -> NoReturn:
+    def trigger(self, env: dict = None, on_finished: Union[None, Callable[[float], None]] = None) -> NoReturn:
+        # on_finished is called with the duration of the hook in seconds, if a command is configured
         if self.command:
             Logger.info('Triggered hook "{}" for "{}"'.format(self.name, self.parent_descr))
-            new_thread = threading.Thread(target=self.run_thread, args=(env,))
-            new_thread.start()
+            # Spawn on the main loop, this may be called from any thread
+            GLib.idle_add(self.__start, env, on_finished, time.monotonic())
 
     def trigger_wait(self, env: dict = None) -> NoReturn:
         if self.command:
             Logger.info('Triggered hook "{}" for "{}"'.format(self.name, self.parent_descr))
-            self.run_thread(env)
+            self.run_wait(env)
+
+    def __env(self, env: dict = None) -> dict:
+        proc_env = os.environ.copy()
+        proc_env['BSRV_HOOK_NAME'] = self.name
+        if env:
+            for key, val in env.items():
+                proc_env[key] = val
+        return proc_env
+
+    def __start(self, env: dict = None, on_finished: Union[None, Callable[[float], None]] = None,
+                triggered: Union[None, float] = None) -> bool:
+        started = time.monotonic()
+        triggered = triggered or started
+        self.task = ChildProcess(self.demotion, self.command, self.__env(env),
+                                 on_exit=lambda task: self.__finished(task, started, triggered, on_finished),
+                                 timeout=self.timeout)
+        if not self.task.start():
+            Metrics.observe('bsrv_hook_seconds', time.monotonic() - triggered, hook=self.name)
+            if on_finished is not None:
+                on_finished(time.monotonic() - started)
+        return False
+
+    def __finished(self, task: 'ChildProcess', started: float, triggered: float,
+                   on_finished: Union[None, Callable[[float], None]]):
+        # Latency as seen by the caller, including the wait for the main loop
+        Metrics.observe('bsrv_hook_seconds', time.monotonic() - triggered, hook=self.name)
+        if on_finished is not None:
+            on_finished(time.monotonic() - started)
+        if task.timed_out:
+            Logger.error(
+                'Hook "{}" for "{}" timed out after {} s'.format(self.name, self.parent_descr, self.timeout))
+        else:
+            self.__report(task.returncode, task.output, task.usage)
 
-    def run_thread(self, env: dict = None) -> NoReturn:
+    def __report(self, returncode: int, lines: List[str], usage: Union[None, dict] = None):
+        if returncode == 0:
+            Logger.info('Hook "{}" for "{}" succeeded{}'.format(self.name, self.parent_descr,
+                                                                ' ({})'.format(format_usage(usage)) if usage else ''))
+            for line in lines:
+                Logger.info('[HOOK] ' + line)
+        else:
+            Logger.error('Hook "{}" for "{}" failed with code {}: {}'.format(self.name, self.parent_descr,
+                                                                             returncode, str(self.command)))
+            for line in lines:
+                Logger.error('[HOOK] ' + line)
+
+    def run_wait(self, env: dict = None) -> NoReturn:
         try:
-            proc_env = os.environ.copy()
-            proc_env['BSRV_HOOK_NAME'] = self.name
-            if env:
-                for key, val in env.items():
-                    proc_env[key] = val
-            self.task = self.demotion.Popen(self.command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=proc_env)
+            task = self.demotion.Popen(self.command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE, env=self.__env(env))
         except Exception as e:
             Logger.error('Exception occured during Popen: {}'.format(str(e)))
             return
 
         try:
-            stdout, stderr = self.task.communicate(timeout=self.timeout)
-            stdout_ = stdout.decode()
-            stderr_ = stderr.decode()
-            if self.task.returncode == 0:
-                Logger.info('Hook "{}" for "{}" succeeded'.format(self.name, self.parent_descr))
-                if stdout_ or stderr_:
-                    for line in (stdout_ + stderr_).splitlines(keepends=False):
-                        Logger.info('[HOOK] ' + line)
-            else:
-                Logger.error('Hook "{}" for "{}" failed with code {}: {}'.format(self.name, self.parent_descr,
-                                                                                 self.task.returncode,
-                                                                                 str(self.command)))
-                if stdout_ or stderr_:
-                    for line in (stdout_ + stderr_).splitlines(keepends=False):
-                        Logger.error('[HOOK] ' + line)
-
+            stdout, stderr = task.communicate(timeout=self.timeout)
+            self.__report(task.returncode, (stdout.decode() + stderr.decode()).splitlines(keepends=False))
         except subprocess.TimeoutExpired:
+            task.kill()
+            task.communicate()
             Logger.error(
                 'Hook "{}" for "{}" timed out after {} s'.format(self.name, self.parent_descr, self.timeout))
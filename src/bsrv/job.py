@@ -1,55 +1,118 @@
+import concurrent.futures
 import configparser
 import datetime
 import enum
+import fnmatch
+import hashlib
+import heapq
+import itertools
+import json
+import math
 import os
 import pathlib
+import random
 import re
 import shlex
-import subprocess
+import socket
 import threading
 import time
 from calendar import monthrange
 from collections import OrderedDict
 from typing import *
 
+from .admission import Admission, CircuitBreaker, SchedulingPolicy
 from .cache import Cache
+from .catalog import Archive, ArchiveCatalog
+from .clock import Clock
 from .config import Config
 from .demote import DemotionSubprocess
+from .history import History
 from .hook import Hook
 from .logger import Logger
-from .tools import parse_json
+from .metrics import Metrics, timed
+from .pressure import PressureLimits
+from .repository import PROBE_UNREACHABLE, repository_state
+from .resources import ResourceControl
+from .process import ChildProcess, format_usage, run_sync
+from .tools import parse_json, parse_timeperiod, every_expr2dt
 
 
-def every_expr2dt(match: re.Match) -> datetime.timedelta:
-    info = match.groupdict()
-    return datetime.timedelta(
-        weeks=int(info['weeks'] if info['weeks'] is not None else 0),
-        days=int(info['days'] if info['days'] is not None else 0),
-        hours=int(info['hours'] if info['hours'] is not None else 0),
-        minutes=int(info['minutes'] if info['minutes'] is not None else 0),
-    )
+def stable_hash(*parts: str) -> int:
+    # Unlike hash(), this does not change between interpreter runs
+    return int.from_bytes(hashlib.sha256('\0'.join(parts).encode()).digest()[:8], 'big')
+
+
+def job_seed(name: str) -> str:
+    return '{}@{}'.format(name, socket.gethostname())
+
+
+BORG_LOG_LEVELS = {
+    'DEBUG': 'debug',
+    'INFO': 'info',
+    'WARNING': 'warning',
+    'ERROR': 'error',
+    'CRITICAL': 'critical'
+}
+
+DEFAULT_ARCHIVE_NAME_TEMPLATE = '%Y-%m-%d_%H-%M-%S'
+
+# borg 1.1: "Pruning archive: NAME ...", borg 1.2: "Pruning archive (1/3): NAME ..."
+PRUNED_ARCHIVE = re.compile(r'^Pruning archive(?: \(\d+/\d+\))?:\s+(?P<name>\S+)')
+
+
+def format_hook_lines(lines: Iterable[str]) -> str:
+    # BSRV_ERROR separates lines by a literal \\n
+    return ''.join(line + '\\n' for line in lines)
+
+
+def template_glob(template: str) -> str:
+    # Glob matching all archive names created from a strftime template, e.g. "host1-%Y-%m-%d" gives "host1-*-*-*"
+    out = ''
+    k = 0
+    while k < len(template):
+        c = template[k]
+        if c == '%' and k + 1 < len(template):
+            k += 1
+            if template[k] == '%':
+                out += '%'
+            else:
+                while template[k] in '-_0^#' and k + 1 < len(template):
+                    k += 1
+                if not out.endswith('*'):
+                    out += '*'
+        elif c in '*?[]':
+            out += '[{}]'.format(c)
+        else:
+            out += c
+        k += 1
+    return out
+
+
+def archive_glob_from_config(cfg_section: str) -> Union[None, str]:
+    # An empty borg_archive_glob lists and prunes all archives of the repository
+    glob = Config.get(cfg_section, 'borg_archive_glob', fallback=None)
+    if glob is None:
+        glob = template_glob(Config.get(cfg_section, 'borg_archive_name_template',
+                                        fallback=DEFAULT_ARCHIVE_NAME_TEMPLATE))
+    return glob if glob and glob != '*' else None
 
 
 class Job:
+    # Backoff in seconds before probing the repository again after its host could not be reached
+    probe_retry_delay: float = 60.0
+    probe_retry_delay_max: float = 3600.0
+
     @staticmethod
     def from_bsrvstatd_config(cfg_section: str):
         try:
-            every_expr = re.compile(r'^\s*((?P<weeks>\d+)\s*w(eeks?)?)?'
-                                    r'\s*((?P<days>\d+)\s*d(ays?)?)?'
-                                    r'\s*((?P<hours>\d+)\s*h(ours?)?)?'
-                                    r'\s*((?P<minutes>\d+)\s*m(in(utes?)?)?)?\s*$', re.IGNORECASE)
-
-            match = every_expr.fullmatch(Config.get(cfg_section, 'stat_maxage', fallback=''))
-            if match:
-                stat_maxage = every_expr2dt(match)
-            else:
-                stat_maxage = None
+            stat_maxage = parse_timeperiod(Config.get(cfg_section, 'stat_maxage', fallback=''))
 
             return Job(
                 name=cfg_section,
                 borg_repo=Config.get(cfg_section, 'borg_repo'),
                 borg_rsh=Config.get(cfg_section, 'borg_rsh', fallback='ssh'),
                 borg_archive_name_template=None,
+                borg_archive_glob=archive_glob_from_config(cfg_section),
                 borg_passphrase=Config.get(cfg_section, 'borg_passphrase'),
                 borg_prune_args=None,
                 borg_create_args=None,
@@ -81,16 +144,24 @@ class Job:
                 borg_repo=Config.get(cfg_section, 'borg_repo'),
                 borg_rsh=Config.get(cfg_section, 'borg_rsh', fallback='ssh'),
                 borg_archive_name_template=Config.get(cfg_section, 'borg_archive_name_template',
-                                                      fallback='%Y-%m-%d_%H-%M-%S'),
+                                                      fallback=DEFAULT_ARCHIVE_NAME_TEMPLATE),
+                borg_archive_glob=archive_glob_from_config(cfg_section),
                 borg_passphrase=Config.get(cfg_section, 'borg_passphrase'),
                 borg_prune_args=shlex.split(Config.get(cfg_section, 'borg_prune_args')),
                 borg_create_args=shlex.split(Config.get(cfg_section, 'borg_create_args')),
                 borg_create_args_file=Config.get(cfg_section, 'borg_create_args_file', fallback=None),
                 borg_run_as=Config.get(cfg_section, 'borg_run_as', fallback=None),
-                schedule=Schedule(Config.get(cfg_section, 'schedule')),
+                schedule=Schedule(Config.get(cfg_section, 'schedule'), seed=job_seed(cfg_section),
+                                  spread=parse_timeperiod(Config.get(cfg_section, 'schedule_spread', fallback=''))),
                 retry_delay=Config.getint(cfg_section, 'retry_delay', fallback=60),
                 retry_max=Config.getint(cfg_section, 'retry_max', fallback=3),
-                stat_maxage=None,
+                retry_jitter=Config.getint(cfg_section, 'retry_jitter', fallback=0),
+                retry_backoff=Config.getfloat(cfg_section, 'retry_backoff', fallback=1.0),
+                retry_delay_max=Config.getint(cfg_section, 'retry_delay_max', fallback=0),
+                priority=Config.getint(cfg_section, 'priority', fallback=0),
+                stat_maxage=parse_timeperiod(Config.get(cfg_section, 'stat_maxage', fallback='')),
+                pressure_limits=PressureLimits.from_config(cfg_section),
+                resources=ResourceControl.from_config(cfg_section),
                 hook_list_failed=Hook.from_config(cfg_section, 'hook_list_failed'),
                 hook_list_successful=Hook.from_config(cfg_section, 'hook_list_successful'),
                 hook_mount_failed=Hook.from_config(cfg_section, 'hook_mount_failed'),
@@ -131,7 +202,14 @@ class Job:
             hook_run_successful: Hook,
             hook_give_up: Hook,
             stat_maxage: Union[datetime.timedelta, None] = None,
-            borg_archive_name_template: Union[str, None] = "%Y-%m-%d_%H-%M-%S",
+            retry_jitter: int = 0,
+            retry_backoff: float = 1.0,
+            retry_delay_max: int = 0,
+            priority: int = 0,
+            pressure_limits: Union[None, PressureLimits] = None,
+            resources: Union[None, ResourceControl] = None,
+            borg_archive_name_template: Union[str, None] = DEFAULT_ARCHIVE_NAME_TEMPLATE,
+            borg_archive_glob: Union[str, None] = None,
             borg_rsh='ssh'
     ):
 
@@ -141,7 +219,7 @@ class Job:
         self.borg_repo: str = borg_repo
         self.borg_passphrase: str = borg_passphrase
 
-        self.demotion = DemotionSubprocess(borg_run_as, parent_descr='Job{}'.format(self.name))
+        self.demotion = DemotionSubprocess(borg_run_as, parent_descr='Job{}'.format(self.name), resources=resources)
         if self.demotion.is_demotion:
             if not Config.check_user_dirs(self.demotion, mount_name=self.name):
                 self.runnable = False
@@ -173,6 +251,21 @@ class Job:
             self.borg_rsh: str = shlex.join(borg_rsh_prep)
 
         self.borg_archive_name_template: str = borg_archive_name_template
+        # Selects the archives of this job in list and prune, when several jobs or hosts share a repository
+        self.borg_archive_glob: Union[str, None] = borg_archive_glob
+        if borg_archive_name_template and borg_archive_glob and not fnmatch.fnmatchcase(
+                ('{:%s}' % (borg_archive_name_template,)).format(datetime.datetime.now()), borg_archive_glob):
+            Logger.warning('[JOB{}] Archives created by this job do not match borg_archive_glob "{}", they will not be '
+                           'listed or pruned'.format(self.name, borg_archive_glob))
+        if borg_archive_name_template:
+            # The default glob follows borg_archive_name_template, changing either hides the previous archives
+            previous_glob = Cache.get_job(self.name, 'archive_glob')
+            if previous_glob != (borg_archive_glob or '*'):
+                if previous_glob is not None:
+                    Logger.warning('[JOB{}] borg_archive_glob changed from "{}" to "{}", archives only matching the '
+                                   'previous one are no longer listed or pruned. Set borg_archive_glob to select them '
+                                   'again.'.format(self.name, previous_glob, borg_archive_glob or '*'))
+                Cache.set_job(self.name, 'archive_glob', borg_archive_glob or '*')
         self.borg_prune_args: str = borg_prune_args
         self.borg_create_args: str = borg_create_args
         if borg_create_args_file:
@@ -191,12 +284,34 @@ class Job:
         self.schedule: Schedule = schedule
         self.retry_delay: int = retry_delay
         self.retry_max: int = retry_max
+        self.retry_jitter: int = retry_jitter
+        self.retry_backoff: float = retry_backoff
+        self.retry_delay_max: int = retry_delay_max
+        self.priority: int = priority
+        self.pressure_limits: Union[None, PressureLimits] = pressure_limits
         self.retry_count: int = 0
-        self.last_archive_date = Cache.get('job_{}_last_dt'.format(self.name))
+        self.last_archive_date = Cache.get_job(self.name, 'last_dt')
+        self.catalog: Union[None, ArchiveCatalog] = None
+        # repo_state the catalog was listed at. The other daemon may list and store a newer one in a shared cache.
+        self.catalog_state: Union[None, str] = None
+        # get_info runs in DBus worker threads while runs update the catalog on the main loop
+        self.catalog_lock: 'threading.Lock' = threading.Lock()
+        # Result of get_info as (monotonic time, datetime, info), shared by concurrent callers for info_ttl seconds
+        self.info_lock: 'threading.Lock' = threading.Lock()
+        self.info: Union[None, Tuple[float, 'datetime.datetime', dict]] = None
+        self.info_pending: Union[None, 'concurrent.futures.Future'] = None
+        self.info_generation: int = 0
+        # An unsupported probe is not tried again, an unreachable host after a backoff from probe_retry_at (monotonic)
+        self.probe_failed: bool = False
+        self.probe_retries: int = 0
+        self.probe_retry_at: float = 0.0
         self.stat_maxage = stat_maxage
+        self.progress: Dict[str, str] = {}
 
         if self.borg_archive_name_template is None or self.borg_create_args is None or self.borg_prune_args is None or self.schedule is None or self.retry_delay is None or self.retry_max is None:
             self.runnable = False
+        if self.pressure_limits is not None and not self.pressure_limits.valid:
+            self.runnable = False
 
         self.hook_list_failed: 'Hook' = hook_list_failed
         self.hook_list_failed.set_parent_description(self.name)
@@ -220,7 +335,12 @@ class Job:
     def __eq__(self, other):
         return other.name == self.name
 
-    def run(self):
+    def __hash__(self):
+        return hash(self.name)
+
+    def run(self, on_finished: Callable[[bool], None],
+            on_progress: Union[None, Callable[[Dict[str, str]], None]] = None) -> NoReturn:
+        # Runs borg create followed by borg prune on the GLib main loop, on_finished is called with the result.
         if not self.runnable:
             raise RuntimeError('Job "{}" is not configured properly to be run.'.format(self.name))
 
@@ -233,77 +353,194 @@ class Job:
         now = time.time()
 
         archive_name = ('::{:%s}' % (self.borg_archive_name_template,)).format(datetime.datetime.fromtimestamp(now))
-        params = [Config.get('borg', 'binary', fallback='borg'), 'create'] + [archive_name] + self.borg_create_args
+        params = [Config.get('borg', 'binary', fallback='borg'), 'create', '--log-json', '--progress', '--json'] + \
+                 [archive_name] + self.borg_create_args
 
         tokens = [shlex.quote(token) for token in params]
         Logger.info('[JOB%s] Running \'%s\'', self.name, ' '.join(tokens))
 
-        p = self.demotion.Popen(
-            params,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            env=env
-        )
-        stdout, stderr = p.communicate()
-        stdout_ = stdout.decode()
-        stderr_ = stderr.decode()
+        self.progress = {}
+        run_state = {
+            'started': time.monotonic(),
+            'started_dt': datetime.datetime.fromtimestamp(now),
+            'archive': archive_name[2:],
+            'emitted': None,
+            'on_progress': on_progress,
+            'on_finished': on_finished,
+            'stdout': [],
+            'usage': {}
+        }
+        p = ChildProcess(self.demotion, params, env, on_exit=lambda p_: self.__create_finished(p_, env, run_state),
+                         on_line=lambda p_, stream, line: self.__borg_line(p_, stream, line, run_state),
+                         tail=Config.getint('borg', 'error_tail_lines', fallback=50))
+        if not p.start():
+            self.__finish(run_state, False, ['Could not launch borg'])
+
+    def __borg_line(self, p: 'ChildProcess', stream: str, line: str, run_state: Union[None, dict] = None):
+        # With --log-json, borg writes one JSON object per line to stderr. Lines are logged as they arrive, only a
+        # bounded tail is kept in p.output for BSRV_ERROR. With --json, stdout of borg create only carries the stats.
+        if stream == 'stdout' and run_state is not None:
+            run_state['stdout'].append(line)
+            return
 
-        if p.returncode == 0:
-            if stdout_ or stderr_:
-                for line in (stdout_ + stderr_).splitlines(keepends=False):
-                    Logger.info('[JOB%s] ' % (self.name,) + line)
+        msg = None
+        if stream == 'stderr' and line.startswith('{'):
+            try:
+                msg = json.loads(line)
+            except ValueError:
+                pass
+
+        if not isinstance(msg, dict):
+            Logger.info('[JOB%s] %s', self.name, line)
+            p.output.append(line)
+        elif msg.get('type') == 'log_message':
+            level = getattr(Logger, BORG_LOG_LEVELS.get(msg.get('levelname'), 'info'))
+            level('[JOB%s] %s', self.name, msg.get('message', ''))
+            p.output.append(msg.get('message', ''))
+            if run_state is not None and 'pruned' in run_state and msg.get('name') == 'borg.output.list':
+                match = PRUNED_ARCHIVE.match(msg.get('message', ''))
+                if match:
+                    run_state['pruned'].append(match.group('name'))
+        elif msg.get('type') == 'file_status':
+            Logger.info('[JOB%s] %s %s', self.name, msg.get('status', ''), msg.get('path', ''))
+        elif msg.get('type') == 'archive_progress' and run_state is not None:
+            self.__progress(msg, run_state)
+
+    def __progress(self, msg: dict, run_state: dict):
+        now = time.monotonic()
+        if msg.get('finished'):
+            run_state['emitted'] = None
+        elif 'original_size' in msg:
+            original_size = int(msg['original_size'])
+            elapsed = now - run_state['started']
+            rate = original_size / elapsed if elapsed > 0 else 0.0
+            self.progress = {
+                'progress_original_size': str(original_size),
+                'progress_compressed_size': str(msg.get('compressed_size', 0)),
+                'progress_deduplicated_size': str(msg.get('deduplicated_size', 0)),
+                'progress_nfiles': str(msg.get('nfiles', 0)),
+                'progress_path': str(msg.get('path', '')),
+                'progress_rate': str(int(rate))
+            }
+            # The size of the previous archive is the best guess for the size of this one
+            expected_size = Cache.get_job(self.name, 'last_size')
+            if expected_size and rate > 0 and original_size < expected_size:
+                self.progress['progress_percent'] = str(int(100 * original_size / expected_size))
+                self.progress['progress_eta'] = (datetime.datetime.now() + datetime.timedelta(
+                    seconds=(expected_size - original_size) / rate)).isoformat()
+
+            interval = Config.getfloat('borg', 'progress_interval', fallback=2.0)
+            if run_state['emitted'] is not None and now - run_state['emitted'] < interval:
+                return
         else:
+            return
+
+        run_state['emitted'] = now
+        if run_state['on_progress'] is not None and self.progress:
+            run_state['on_progress'](dict(self.progress, progress_finished=str(bool(msg.get('finished')))))
+
+    def __create_finished(self, p: 'ChildProcess', env: dict, run_state: dict):
+        run_state['create_duration'] = time.monotonic() - run_state['started']
+        run_state['usage']['create'] = p.usage
+        Logger.info('[JOB%s] borg create: %s', self.name, format_usage(p.usage))
+        try:
+            run_state['stats'] = json.loads('\n'.join(run_state['stdout'])) if run_state['stdout'] else None
+        except ValueError:
+            Logger.warning('[JOB%s] borg create returned non-parsable json' % (self.name,))
+            run_state['stats'] = None
+        original_size = None
+        if isinstance(run_state['stats'], dict):
+            original_size = run_state['stats'].get('archive', {}).get('stats', {}).get('original_size')
+        elif 'progress_original_size' in self.progress:
+            original_size = int(self.progress['progress_original_size'])
+        self.progress = {}
+
+        if p.returncode != 0:
             Logger.error('[JOB] borg returned with non-zero exitcode')
-            hook_lines = ''
-            if stdout_ or stderr_:
-                for line in (stdout_ + stderr_).splitlines(keepends=False):
-                    Logger.error('[JOB%s] ' % (self.name,) + line)
-                    hook_lines += line + '\\n'
             Logger.warn('[JOB%s] skipping borg prune due to previous error' % (self.name,))
-            self.hook_run_failed.trigger(env={'BSRV_JOB': self.name, 'BSRV_ERROR': hook_lines})
-            return False
+            self.__finish(run_state, False, p.output)
+            return
 
-        params = [Config.get('borg', 'binary', fallback='borg'), 'prune'] + self.borg_prune_args
+        if original_size is not None:
+            Cache.set_job(self.name, 'last_size', int(original_size))
+        archive = run_state['stats'].get('archive', {}) if isinstance(run_state['stats'], dict) else {}
+        self.__update_catalog([Archive.from_borg(dict(archive, name=run_state['archive'],
+                                                      start=archive.get('start') or run_state['started_dt']))], [])
+
+        # With --list, borg prune logs the name of every pruned archive
+        params = [Config.get('borg', 'binary', fallback='borg'), 'prune', '--log-json', '--list'] + \
+                 self.__glob_args() + self.borg_prune_args
 
         tokens = [shlex.quote(token) for token in params]
         Logger.info('[JOB%s] Running \'%s\'', self.name, ' '.join(tokens))
 
-        p = self.demotion.Popen(
-            params,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            env=env
-        )
-        stdout, stderr = p.communicate()
-        stdout_ = stdout.decode()
-        stderr_ = stderr.decode()
-
+        run_state['prune_started'] = time.monotonic()
+        run_state['pruned'] = []
+        p = ChildProcess(self.demotion, params, env, on_exit=lambda p_: self.__prune_finished(p_, run_state),
+                         on_line=lambda p_, stream, line: self.__borg_line(p_, stream, line, run_state),
+                         tail=Config.getint('borg', 'error_tail_lines', fallback=50))
+        if not p.start():
+            self.__finish(run_state, False, ['Could not launch borg'])
+
+    def __prune_finished(self, p: 'ChildProcess', run_state: dict):
+        run_state['prune_duration'] = time.monotonic() - run_state['prune_started']
+        run_state['usage']['prune'] = p.usage
+        Logger.info('[JOB%s] borg prune: %s', self.name, format_usage(p.usage))
         if p.returncode == 0:
-            if stdout_ or stderr_:
-                for line in (stdout_ + stderr_).splitlines(keepends=False):
-                    Logger.info('[JOB%s] ' % (self.name,) + line)
-            self.hook_run_successful.trigger(env={'BSRV_JOB': self.name})
-            return True
+            self.__update_catalog([], run_state['pruned'])
+            self.__finish(run_state, True)
         else:
             Logger.error('[JOB%s] borg returned with non-zero exitcode' % (self.name,))
-            hook_lines = ''
-            if stdout_ or stderr_:
-                for line in (stdout_ + stderr_).splitlines(keepends=False):
-                    Logger.error('[JOB%s] ' % (self.name,) + line)
-                    hook_lines += line + '\\n'
-            self.hook_run_failed.trigger(env={'BSRV_JOB': self.name, 'BSRV_ERROR': hook_lines})
-            return False
+            self.__finish(run_state, False, p.output)
+
+    def __finish(self, run_state: dict, successful: bool, error_lines: Iterable[str] = ()):
+        # Even a failed borg create may have left a checkpoint archive
+        self.invalidate_info()
+        error = format_hook_lines(error_lines)
+        stats = run_state.get('stats')
+        archive_stats = stats.get('archive', {}).get('stats', {}) if isinstance(stats, dict) else {}
+        run_id = History.add({
+            'job': self.name,
+            'started': run_state['started_dt'],
+            'finished': datetime.datetime.now(),
+            'successful': successful,
+            'retry': max(self.retry_count, 0),
+            'archive': run_state['archive'],
+            'create_duration': run_state.get('create_duration'),
+            'prune_duration': run_state.get('prune_duration'),
+            'original_size': archive_stats.get('original_size'),
+            'compressed_size': archive_stats.get('compressed_size'),
+            'deduplicated_size': archive_stats.get('deduplicated_size'),
+            'nfiles': archive_stats.get('nfiles'),
+            'error': error or None,
+            'stats': json.dumps(stats) if stats is not None else None,
+            'usage': json.dumps(run_state['usage']) if run_state['usage'] else None
+        })
+
+        finished = time.monotonic()
+        Metrics.set('bsrv_job_last_run_timestamp_seconds', time.time(), job=self.name)
+        Metrics.set('bsrv_job_last_run_success', successful, job=self.name)
+        Metrics.set('bsrv_job_last_run_duration_seconds', finished - run_state['started'], job=self.name)
+        if successful:
+            for key in ['original_size', 'compressed_size', 'deduplicated_size']:
+                if key in archive_stats:
+                    Metrics.set('bsrv_job_last_{}_bytes'.format(key[:-len('_size')]), archive_stats[key], job=self.name)
+            if 'nfiles' in archive_stats:
+                Metrics.set('bsrv_job_last_files', archive_stats['nfiles'], job=self.name)
+
+        on_hook_finished = lambda duration: History.set_hook_duration(run_id, duration)
+        if successful:
+            self.hook_run_successful.trigger(env={'BSRV_JOB': self.name}, on_finished=on_hook_finished)
+        else:
+            self.hook_run_failed.trigger(env={'BSRV_JOB': self.name, 'BSRV_ERROR': error},
+                                         on_finished=on_hook_finished)
+        run_state['on_finished'](successful)
 
     def get_last_archive_datetime(self, use_cache: bool = True):
         if not use_cache or not self.last_archive_date:
-            list_of_archives = self.list_archives()
-            if list_of_archives:
-                list_of_times = sorted([a['time'] for a in list_of_archives], reverse=True)
-                if list_of_times:
-                    v = list_of_times[0]
-                else:
-                    v = datetime.datetime.fromtimestamp(0)
-
+            catalog = self.refresh_catalog()
+            if catalog:
+                v = catalog.latest.time
                 self.set_last_archive_datetime(v)
                 return v
 
@@ -314,7 +551,8 @@ class Job:
 
     def set_last_archive_datetime(self, dt: 'datetime.datetime'):
         self.last_archive_date = dt
-        Cache.set('job_{}_last_dt'.format(self.name), dt)
+        Cache.set_job(self.name, 'last_dt', dt)
+        Metrics.set('bsrv_job_last_success_timestamp_seconds', dt.timestamp(), job=self.name)
 
     def get_next_archive_datetime(self, last: Union[None, 'datetime.datetime'] = None):
         if last is None:
@@ -324,50 +562,184 @@ class Job:
         else:
             return None
 
-    def list_archives(self):
+    def __glob_args(self) -> List[str]:
+        return ['--glob-archives', self.borg_archive_glob] if self.borg_archive_glob else []
+
+    def __load_catalog(self, reload: bool = False) -> Union[None, ArchiveCatalog]:
+        with self.catalog_lock:
+            if self.catalog is None or reload:
+                archives = Cache.get_archives(self.name)
+                if archives is not None:
+                    self.catalog = ArchiveCatalog(archives)
+                    self.catalog_state = Cache.get_job(self.name, 'repo_state')
+            return self.catalog
+
+    def __update_catalog(self, added: List[Archive], removed: List[str]):
+        # Only a catalog that was listed completely once is kept up to date, otherwise it would look complete
+        catalog = self.__load_catalog()
+        if catalog is None:
+            return
+        with self.catalog_lock:
+            removed = catalog.remove(removed)
+            for archive in added:
+                catalog.add(archive)
+            Cache.update_archives(self.name, added, removed)
+
+    def __replace_catalog(self, archives: Iterable[Archive]) -> ArchiveCatalog:
+        with self.catalog_lock:
+            self.catalog = ArchiveCatalog(archives)
+            Cache.update_archives(self.name, self.catalog.archives, [], replace=True)
+            return self.catalog
+
+    def probe_repository(self) -> Union[None, str]:
+        if self.probe_failed or time.monotonic() < self.probe_retry_at or \
+                not Config.getboolean('borg', 'repository_probe', fallback=True):
+            return None
+        state, failure = repository_state(self.demotion, self.borg_repo, self.borg_rsh, os.environ.copy(),
+                                          Config.getfloat('borg', 'repository_probe_timeout', fallback=10))
+        if failure == PROBE_UNREACHABLE:
+            delay = min(self.probe_retry_delay * 2 ** self.probe_retries, self.probe_retry_delay_max)
+            self.probe_retries += 1
+            self.probe_retry_at = time.monotonic() + delay
+            Logger.warning('[JOB%s] Could not reach the repository host to probe it, trying again in %d s', self.name,
+                           delay)
+        elif failure is not None:
+            # Usually a key restricted to borg serve, which would fail the same way every time
+            Logger.warning('[JOB%s] Could not probe the repository via ssh, not trying again', self.name)
+            self.probe_failed = True
+        else:
+            self.probe_retries = 0
+        return state
+
+    def refresh_catalog(self) -> Union[None, ArchiveCatalog]:
+        # borg list is skipped if the repository has not changed since the catalog was last listed. The state is
+        # probed before listing, so changes during borg list are noticed next time. Returns None if borg list failed.
+        state = self.probe_repository()
+        catalog = self.__load_catalog()
+        if catalog is not None and state is not None and state == Cache.get_job(self.name, 'repo_state'):
+            if state != self.catalog_state:
+                # Listed and stored by the other daemon sharing the cache
+                catalog = self.__load_catalog(reload=True)
+            Logger.debug('[JOB%s] Repository unchanged, not listing archives', self.name)
+            return catalog
+        catalog = self.__list_catalog(catalog)
+        if catalog is not None and state is not None:
+            with self.catalog_lock:
+                Cache.set_job(self.name, 'repo_state', state)
+                self.catalog_state = state
+        return catalog
+
+    def __list_catalog(self, catalog: Union[None, ArchiveCatalog]) -> Union[None, ArchiveCatalog]:
+        # Lists only the newest archives with borg list --last, unless the catalog is unknown, older than
+        # catalog_full_refresh or more archives were added than listed
+        last = Config.getint('borg', 'catalog_refresh_last', fallback=20)
+        full_refresh = parse_timeperiod(Config.get('borg', 'catalog_full_refresh', fallback='1d'))
+        catalog_dt = Cache.get_job(self.name, 'catalog_dt')
+        if catalog is not None and last > 0 and full_refresh is not None and catalog_dt is not None and \
+                datetime.datetime.now() - catalog_dt < full_refresh:
+            newest = self.list_archives(last=last)
+            if newest is None:
+                return None
+            newest = [Archive.from_borg(a) for a in newest]
+            if len(newest) >= last:
+                with self.catalog_lock:
+                    merged = catalog.merge_newest(newest)
+                    if merged is not None:
+                        Cache.update_archives(self.name, *merged)
+                        return catalog
+            else:
+                # All archives of the repository were listed
+                return self.__replace_catalog(newest)
+
+        archives = self.list_archives()
+        if archives is None:
+            return None
+        return self.__replace_catalog(Archive.from_borg(a) for a in archives)
+
+    def list_archives(self, last: int = 0):
         env = os.environ.copy()
         env['BORG_REPO'] = self.borg_repo
         env['BORG_RSH'] = self.borg_rsh
         env['BORG_PASSPHRASE'] = self.borg_passphrase
         env['BORG_BASE_DIR'] = self.borg_base_dir
 
-        params = ['borg', 'list', '--json']
+        params = [Config.get('borg', 'binary', fallback='borg'), 'list', '--json'] + self.__glob_args()
+        if last > 0:
+            params += ['--last', str(last)]
 
         tokens = [shlex.quote(token) for token in params]
         Logger.info('[JOB%s] Running \'%s\'', self.name,' '.join(tokens))
 
-        p = self.demotion.Popen(
-            params,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            env=env
-        )
-        stdout, stderr = p.communicate()
-        stdout_ = stdout.decode()
-        stderr_ = stderr.decode()
-        if p.returncode == 0:
+        tail = Config.getint('borg', 'error_tail_lines', fallback=50)
+        returncode, stdout, stderr = run_sync(self.demotion, params, env, tail=tail)
+        if returncode == 0:
             try:
-                borg_archives = parse_json(stdout_)['archives']
+                borg_archives = parse_json(stdout)['archives']
                 self.hook_list_successful.trigger(env={'BSRV_JOB': self.name})
                 return borg_archives
             except Exception:
-                hook_lines = ''
-                for line in stdout_.splitlines(keepends=False):
-                    hook_lines += line + '\\n'
-                self.hook_list_failed.trigger(env={'BSRV_JOB': self.name, 'BSRV_ERROR': hook_lines})
+                self.hook_list_failed.trigger(env={'BSRV_JOB': self.name,
+                                                   'BSRV_ERROR': format_hook_lines(stdout.splitlines()[-tail:])})
                 Logger.error('borg returned non-parsable json')
         else:
             Logger.error('borg returned with non-zero exitcode')
-            hook_lines = ''
-            if stdout_ or stderr_:
-                for line in (stdout_ + stderr_).splitlines(keepends=False):
-                    Logger.error(line)
-                    hook_lines += line + '\\n'
-            self.hook_list_failed.trigger(env={'BSRV_JOB': self.name, 'BSRV_ERROR': hook_lines})
+            lines = stdout.splitlines() + stderr
+            for line in lines:
+                Logger.error(line)
+            self.hook_list_failed.trigger(env={'BSRV_JOB': self.name, 'BSRV_ERROR': format_hook_lines(lines)})
             return None
 
-    def get_info(self):
-        archives = self.list_archives()
+    def get_info(self) -> dict:
+        # Concurrent callers share one borg invocation and the result is reused for info_ttl seconds, unless bsrv
+        # changed the repository meanwhile. info_dt and info_age tell when the data was fetched.
+        ttl = Config.getfloat('borg', 'info_ttl', fallback=60)
+        with self.info_lock:
+            if self.info is not None and time.monotonic() - self.info[0] < ttl:
+                Metrics.inc('bsrv_job_info_requests', job=self.name, result='cached')
+                return Job.__aged_info(self.info)
+            shared = self.info_pending
+            if shared is None:
+                pending = self.info_pending = concurrent.futures.Future()
+                generation = self.info_generation
+        if shared is not None:
+            Metrics.inc('bsrv_job_info_requests', job=self.name, result='shared')
+            return Job.__aged_info(shared.result())
+
+        Metrics.inc('bsrv_job_info_requests', job=self.name, result='fetched')
+        try:
+            info = (time.monotonic(), datetime.datetime.now(), self.__fetch_info())
+        except BaseException as e:
+            with self.info_lock:
+                if self.info_pending is pending:
+                    self.info_pending = None
+            pending.set_exception(e)
+            raise
+        with self.info_lock:
+            if self.info_pending is pending:
+                self.info_pending = None
+            # Failed borg calls are not cached
+            if generation == self.info_generation and ttl > 0 and 'cache' in info[2] and \
+                    info[2]['archives'] is not None:
+                self.info = info
+        pending.set_result(info)
+        return Job.__aged_info(info)
+
+    def invalidate_info(self):
+        # Callers after this do not get a result fetched before, not even one still in flight
+        with self.info_lock:
+            self.info = None
+            self.info_pending = None
+            self.info_generation += 1
+
+    @staticmethod
+    def __aged_info(info: Tuple[float, 'datetime.datetime', dict]) -> dict:
+        # A copy, callers add to it
+        return dict(info[2], info_dt=info[1], info_age=round(time.monotonic() - info[0], 1))
+
+    def __fetch_info(self) -> dict:
+        catalog = self.refresh_catalog()
+        with self.catalog_lock:
+            archives = [a.to_dict() for a in catalog.archives] if catalog is not None else None
 
         env = os.environ.copy()
         env['BORG_REPO'] = self.borg_repo
@@ -375,31 +747,23 @@ class Job:
         env['BORG_PASSPHRASE'] = self.borg_passphrase
         env['BORG_BASE_DIR'] = self.borg_base_dir
 
-        params = ['borg', 'info', '--json']
+        params = [Config.get('borg', 'binary', fallback='borg'), 'info', '--json']
 
         tokens = [shlex.quote(token) for token in params]
         Logger.info('[JOB%s] Running \'%s\'', self.name, ' '.join(tokens))
 
-        p = self.demotion.Popen(
-            params,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            env=env
-        )
-        stdout, stderr = p.communicate()
-        stdout_ = stdout.decode()
-        stderr_ = stderr.decode()
-        if p.returncode == 0:
+        returncode, stdout, stderr = run_sync(self.demotion, params, env,
+                                              tail=Config.getint('borg', 'error_tail_lines', fallback=50))
+        if returncode == 0:
             try:
-                borg_info = parse_json(stdout_)
+                borg_info = parse_json(stdout)
             except Exception:
                 Logger.error('borg returned non-parsable json')
                 borg_info = {}
         else:
             Logger.error('borg returned with non-zero exitcode')
-            if stdout_ or stderr_:
-                for line in (stdout_ + stderr_).splitlines(keepends=False):
-                    Logger.error(line)
+            for line in stdout.splitlines() + stderr:
+                Logger.error(line)
             borg_info = {}
 
         borg_info['archives'] = archives
@@ -412,64 +776,50 @@ class Job:
         env['BORG_BASE_DIR'] = self.borg_base_dir
 
         if Config.get_global('root'):
-            params = ['borg', 'mount', '-o', 'allow_other', self.borg_repo, self.mount_dir]
+            params = [Config.get('borg', 'binary', fallback='borg'), 'mount', '-o', 'allow_other', self.borg_repo,
+                      self.mount_dir]
         else:
-            params = ['borg', 'mount', self.borg_repo, self.mount_dir]
+            params = [Config.get('borg', 'binary', fallback='borg'), 'mount', self.borg_repo, self.mount_dir]
 
         tokens = [shlex.quote(token) for token in params]
         Logger.info('[JOB%s] Running \'%s\'', self.name, ' '.join(tokens))
 
-        p = self.demotion.Popen(
-            params,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            env=env
-        )
-        stdout, stderr = p.communicate()
-        stdout_ = stdout.decode()
-        stderr_ = stderr.decode()
-        if p.returncode == 0:
+        returncode, stdout, stderr = run_sync(self.demotion, params, env,
+                                              tail=Config.getint('borg', 'error_tail_lines', fallback=50))
+        # borg mount and umount may update the repository and its cache
+        self.invalidate_info()
+        if returncode == 0:
             self.hook_mount_successful.trigger(env={'BSRV_JOB': self.name})
             return True
         else:
             Logger.error('borg returned with non-zero exitcode')
-            hook_lines = ''
-            if stdout_ or stderr_:
-                for line in (stdout_ + stderr_).splitlines(keepends=False):
-                    Logger.error(line)
-                    hook_lines += line + '\\n'
-            self.hook_mount_failed.trigger(env={'BSRV_JOB': self.name, 'BSRV_ERROR': hook_lines})
+            lines = stdout.splitlines() + stderr
+            for line in lines:
+                Logger.error(line)
+            self.hook_mount_failed.trigger(env={'BSRV_JOB': self.name, 'BSRV_ERROR': format_hook_lines(lines)})
             return False
 
     def umount(self):
         env = os.environ.copy()
         env['BORG_BASE_DIR'] = self.borg_base_dir
 
-        params = ['borg', 'umount', self.mount_dir]
+        params = [Config.get('borg', 'binary', fallback='borg'), 'umount', self.mount_dir]
 
         tokens = [shlex.quote(token) for token in params]
         Logger.info('[JOB%s] Running \'%s\'', self.name, ' '.join(tokens))
 
-        p = self.demotion.Popen(
-            params,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            env=env
-        )
-        stdout, stderr = p.communicate()
-        stdout_ = stdout.decode()
-        stderr_ = stderr.decode()
-        if p.returncode == 0:
+        returncode, stdout, stderr = run_sync(self.demotion, params, env,
+                                              tail=Config.getint('borg', 'error_tail_lines', fallback=50))
+        self.invalidate_info()
+        if returncode == 0:
             self.hook_umount_successful.trigger(env={'BSRV_JOB': self.name})
             return True
         else:
             Logger.error('borg returned with non-zero exitcode')
-            hook_lines = ''
-            if stdout_ or stderr_:
-                for line in (stdout_ + stderr_).splitlines(keepends=False):
-                    Logger.error(line)
-                    hook_lines += line + '\\n'
-            self.hook_umount_failed.trigger(env={'BSRV_JOB': self.name, 'BSRV_ERROR': hook_lines})
+            lines = stdout.splitlines() + stderr
+            for line in lines:
+                Logger.error(line)
+            self.hook_umount_failed.trigger(env={'BSRV_JOB': self.name, 'BSRV_ERROR': format_hook_lines(lines)})
             return False
 
     def status(self):
@@ -487,79 +837,143 @@ class ScheduleParseError(Exception):
 
 class SchedulerQueue:
     def __init__(self):
-        self.waiting: 'OrderedDict' = OrderedDict()
+        # Heap entries are [dt, insertion counter, elem, alive]. Deleted entries are only marked as dead and dropped
+        # lazily, the index maps each element to its live entries.
+        self.heap: List[list] = []
+        self.index: Dict[Any, List[list]] = {}
+        self.counter = itertools.count()
+        self.dead: int = 0
         self.lock: 'threading.Lock' = threading.Lock()
         self.hook_update = lambda: []
 
     def set_update_hook(self, func):
         self.hook_update = func
 
-    def __reorder(self):
-        self.waiting = OrderedDict((key, self.waiting[key]) for key in sorted(self.waiting.keys()))
+    def __len__(self) -> int:
+        return len(self.heap) - self.dead
 
-    def when(self, elem: Any) -> Union[None, 'datetime.datetime']:
-        for this_dt, this_elems in self.waiting.items():
-            for k in range(len(this_elems)):
-                this_elem = this_elems[k]
-                if elem is not None and this_elem == elem:
-                    return this_dt
+    def __push(self, elem: Any, dt: 'datetime.datetime'):
+        entry = [dt, next(self.counter), elem, True]
+        heapq.heappush(self.heap, entry)
+        self.index.setdefault(elem, []).append(entry)
 
-        return None
+    def __remove(self, elem: Any) -> bool:
+        entries = self.index.get(elem)
+        if not entries:
+            return False
+        entry = min(entries)
+        entries.remove(entry)
+        if not entries:
+            del self.index[elem]
+        entry[3] = False
+        self.dead += 1
+        if self.dead > len(self.heap) // 2:
+            self.__compact()
+        return True
+
+    def __compact(self):
+        self.heap = [entry for entry in self.heap if entry[3]]
+        heapq.heapify(self.heap)
+        self.dead = 0
+
+    def __pop_dead(self):
+        while self.heap and not self.heap[0][3]:
+            heapq.heappop(self.heap)
+            self.dead -= 1
 
+    def when(self, elem: Any) -> Union[None, 'datetime.datetime']:
+        if elem is None:
+            return None
+        with self.lock:
+            entries = self.index.get(elem)
+            if not entries:
+                return None
+            return min(entries)[0]
+
+    @timed('bsrv_scheduler_queue_op_seconds', 'op')
     def put(self, elem: Any, dt: 'datetime.datetime', hook_enabled: bool = True) -> NoReturn:
         with self.lock:
-            if dt in self.waiting.keys():
-                self.waiting[dt].append(elem)
-            else:
-                self.waiting[dt] = [elem]
-            self.__reorder()
+            self.__push(elem, dt)
         if hook_enabled:
             self.hook_update()
 
+    @timed('bsrv_scheduler_queue_op_seconds', 'op')
     def delete(self, elem: Any, hook_enabled: bool = True) -> bool:
+        if elem is None:
+            return False
         with self.lock:
-            found = False
-            for this_dt, this_elems in self.waiting.items():
-                for k in range(len(this_elems)):
-                    this_elem = this_elems[k]
-                    if elem is not None and this_elem == elem:
-                        if len(this_elems) == 1:
-                            del self.waiting[this_dt]
-                        else:
-                            del self.waiting[this_dt][k]
-                        found = True
-                        break
-                if found:
-                    break
-            self.__reorder()
+            found = self.__remove(elem)
 
         if found and hook_enabled:
             self.hook_update()
 
         return found
 
+    @timed('bsrv_scheduler_queue_op_seconds', 'op')
     def move(self, elem: Any, dt: 'datetime.datetime', hook_enabled: bool = True) -> bool:
-        if self.delete(elem, hook_enabled=False):
-            self.put(elem, dt, hook_enabled=hook_enabled)
-            return True
-        else:
-            return False
+        with self.lock:
+            found = self.__remove(elem)
+            if found:
+                self.__push(elem, dt)
+
+        if found and hook_enabled:
+            self.hook_update()
+
+        return found
 
     def get_waiting(self) -> 'OrderedDict':
-        return self.waiting
+        with self.lock:
+            waiting = OrderedDict()
+            for dt, _, elem, alive in sorted(self.heap):
+                if alive:
+                    waiting.setdefault(dt, []).append(elem)
+            return waiting
 
-    def get_next_action(self) -> Tuple[Union[None, 'datetime.datetime'], List[Any]]:
+    def next_dt(self) -> Union[None, 'datetime.datetime']:
         with self.lock:
-            try:
-                dt, items = self.waiting.popitem(last=False)
-            except (IndexError, KeyError):
-                items = []
+            self.__pop_dead()
+            return self.heap[0][0] if self.heap else None
 
-            if items:
-                return dt, items
-            else:
+    @timed('bsrv_scheduler_queue_op_seconds', 'op')
+    def peek_next_action(self) -> Tuple[Union[None, 'datetime.datetime'], List[Any]]:
+        with self.lock:
+            self.__pop_dead()
+            if not self.heap:
                 return None, []
 
+            # Walk the heap from the top, only descending into subtrees that can still contain the minimum
+            dt = self.heap[0][0]
+            entries = []
+            todo = [0]
+            while todo:
+                k = todo.pop()
+                if k < len(self.heap) and self.heap[k][0] == dt:
+                    if self.heap[k][3]:
+                        entries.append(self.heap[k])
+                    todo += [2 * k + 1, 2 * k + 2]
+            return dt, [entry[2] for entry in sorted(entries)]
+
+    @timed('bsrv_scheduler_queue_op_seconds', 'op')
+    def get_next_action(self) -> Tuple[Union[None, 'datetime.datetime'], List[Any]]:
+        with self.lock:
+            self.__pop_dead()
+            if not self.heap:
+                return None, []
+
+            dt = self.heap[0][0]
+            items = []
+            while self.heap and self.heap[0][0] == dt:
+                entry = heapq.heappop(self.heap)
+                if not entry[3]:
+                    self.dead -= 1
+                    continue
+                items.append(entry[2])
+                entries = self.index[entry[2]]
+                entries.remove(entry)
+                if not entries:
+                    del self.index[entry[2]]
+            return dt, items
+
 
 class WakeupReason(enum.Enum):
     SHUTDOWN = enum.auto()
@@ -569,22 +983,36 @@ class WakeupReason(enum.Enum):
 
 
 class Scheduler:
-    def __init__(self):
+    # Upper bound for a single timer. Schedules follow the wall clock while GLib timers follow the monotonic clock,
+    # re-evaluating at least this often catches clock changes and suspend.
+    max_sleep: float = 60.0
+
+    def __init__(self, clock: Union[None, 'Clock'] = None):
+        # The clock provides the current time and the main loop sources, a VirtualClock is used for simulations
+        self.clock: 'Clock' = clock or Clock()
         self.jobs: List['Job'] = []
         self.queue: 'SchedulerQueue' = SchedulerQueue()
         self.queue.set_update_hook(self.__update_wakeup)
-        self.timer: Union[None, 'threading.Timer'] = None
-        self.timer_event: 'threading.Event' = threading.Event()
-        self.timer_reason: 'WakeupReason' = WakeupReason.TIMER
-        self.main_thread: 'threading.Thread' = threading.Thread(target=self.scheduler_thread)
-        self.threads_running: Dict[int, 'threading.Thread'] = {}
+        self.timer_source: Union[None, int] = None
+        self.wakeup_lock: 'threading.Lock' = threading.Lock()
+        self.wakeup_pending: bool = False
         self.jobs_running: List['Job'] = []
-        self.jobs_running_lock: 'threading.Lock' = threading.Lock()
+        self.jobs_queued: List['Job'] = []
+        self.queued_since: Dict['Job', 'datetime.datetime'] = {}
+        self.planned: Dict['Job', 'datetime.datetime'] = {}
+        self.started_dt: Union[None, 'datetime.datetime'] = None
+        self.admission: 'Admission' = Admission.from_config()
+        self.policy: 'SchedulingPolicy' = SchedulingPolicy.from_config()
+        self.breaker: 'CircuitBreaker' = CircuitBreaker.from_config()
+        self.deferrals: Dict['Job', Dict[str, Any]] = {}
+        self.deferrals_total: Dict['Job', int] = {}
         self.running: bool = False
         self.next_dt: Union['datetime.datetime', None] = None
         self.next_jobs: List['Job'] = []
         self.status_update_callback = lambda job_name, sched_status, retry: []
+        self.progress_callback = lambda job_name, progress: []
         self.pause_callback = lambda is_paused: []
+        self.stop_callback: Union[None, Callable[[], None]] = None
         self.paused = False
 
     def find_job_by_name(self, job_name: str) -> Union[None, 'Job']:
@@ -598,23 +1026,44 @@ class Scheduler:
                 return None
 
     def get_job_status(self, job: 'Job') -> Dict[str, str]:
-        job_status = job.status()
+        return self.add_schedule_status(job, job.status())
 
+    def add_schedule_status(self, job: 'Job', job_status: Dict[str, str]) -> Dict[str, str]:
+        # Main loop only. job.status() may run borg, callers on the main loop get it from the worker pool first.
         if job in self.jobs_running:
             job_status['schedule_status'] = 'running'
             job_status['schedule_dt'] = 'now'
-        elif job in self.next_jobs:
-            job_status['schedule_status'] = 'next'
-            job_status['schedule_dt'] = self.next_dt.isoformat()
+            job_status.update(job.progress)
+        elif job in self.jobs_queued:
+            job_status['schedule_status'] = 'queued'
+            job_status['schedule_dt'] = 'now'
+            job_status['schedule_reason'] = (self.admission.blocked_reason(job)
+                                             or self.breaker.blocked_reason(job, self.clock.now())
+                                             or 'waiting for admission')
+            queued_since = self.queued_since.get(job, self.clock.now())
+            job_status['schedule_queued_since'] = queued_since.isoformat()
+            job_status.update(self.policy.describe(job, queued_since, self.clock.now()))
+            queued = self.policy.order(self.jobs_queued, self.queued_since, self.clock.now())
+            if job in queued:
+                job_status['schedule_rank'] = str(queued.index(job) + 1)
         else:
             queue_dt = self.queue.when(job)
-            if queue_dt:
-                job_status['schedule_status'] = 'wait'
+            if queue_dt and job in self.deferrals:
+                job_status['schedule_status'] = 'deferred'
+                job_status['schedule_dt'] = queue_dt.isoformat()
+                job_status['schedule_reason'] = self.deferrals[job]['reason']
+                job_status['schedule_deferred_since'] = self.deferrals[job]['since'].isoformat()
+                job_status['schedule_deferrals'] = str(self.deferrals[job]['count'])
+            elif queue_dt:
+                job_status['schedule_status'] = 'next' if queue_dt == self.next_dt else 'wait'
                 job_status['schedule_dt'] = queue_dt.isoformat()
             else:
                 job_status['schedule_status'] = 'none'
                 job_status['schedule_dt'] = 'none'
 
+        if job in self.deferrals_total:
+            job_status['schedule_deferrals_total'] = str(self.deferrals_total[job])
+
         return job_status
 
     def schedule(self, job: 'Job', dt: 'datetime.datetime', hook_enabled: bool = True) -> bool:
@@ -633,6 +1082,9 @@ class Scheduler:
     def register(self, job: 'Job') -> NoReturn:
         self.jobs.append(job)
         next_dt = job.get_next_archive_datetime()
+        if job.last_archive_date:
+            Metrics.set('bsrv_job_last_success_timestamp_seconds', job.last_archive_date.timestamp(), job=job.name)
+        Metrics.set('bsrv_job_retry', job.retry_count, job=job.name)
         if next_dt is None:
             Logger.error('[Scheduler] Could not register job "{}", no last backup date.'.format(job.name))
         else:
@@ -642,127 +1094,206 @@ class Scheduler:
                 Logger.error('[Scheduler] Could not register job "{}", unknown error'.format(job.name))
 
     def advance_to_now(self, job: 'Job') -> bool:
-        if job in self.next_jobs:
-            self.next_jobs.remove(job)
-            self.queue.put(job, datetime.datetime.now())
+        if job in self.jobs_queued:
             return True
         else:
-            return self.queue.move(job, datetime.datetime.now())
+            return self.queue.move(job, self.clock.now())
 
     def start(self) -> NoReturn:
+        # The scheduler runs on the GLib main loop, evaluation starts as soon as the loop is running.
         self.running = True
-        self.main_thread.start()
+        self.started_dt = self.clock.now()
+        if len(self.jobs) == 0:
+            Logger.warning('No jobs registered, nothing to do')
+        self.__update_wakeup()
 
-    def stop(self) -> NoReturn:
+    def stop(self, on_stopped: Union[None, Callable[[], None]] = None) -> NoReturn:
         self.running = False
-        self.timer_reason = WakeupReason.SHUTDOWN
-        self.timer_event.set()
-        self.main_thread.join()
+        self.__wakeup(WakeupReason.SHUTDOWN)
+        if on_stopped is not None:
+            if self.jobs_running:
+                Logger.info('[Scheduler] Waiting for {} running job(s) to finish'.format(len(self.jobs_running)))
+                self.stop_callback = on_stopped
+            else:
+                on_stopped()
 
     def pause(self) -> NoReturn:
         if not self.paused:
             self.paused = True
+            Metrics.set('bsrv_scheduler_paused', True)
+            self.pause_callback(True)
             self.__pause_wakeup()
 
     def unpause(self) -> NoReturn:
         if self.paused:
-            self.__pause_wakeup()
             self.paused = False
-
-    def __timer_wakeup(self) -> NoReturn:
-        self.timer_reason = WakeupReason.TIMER
-        self.timer_event.set()
+            Metrics.set('bsrv_scheduler_paused', False)
+            self.pause_callback(False)
+            self.__pause_wakeup()
 
     def __update_wakeup(self) -> NoReturn:
-        self.timer_reason = WakeupReason.UPDATE
-        self.timer_event.set()
+        # Thread-safe, coalesces multiple updates into a single evaluation on the main loop.
+        with self.wakeup_lock:
+            if self.wakeup_pending:
+                return
+            self.wakeup_pending = True
+        self.clock.idle_add(self.__wakeup, WakeupReason.UPDATE)
 
     def __pause_wakeup(self) -> NoReturn:
-        self.timer_reason = WakeupReason.PAUSE
-        self.timer_event.set()
-
-    def scheduler_thread(self) -> NoReturn:
-        Logger.debug('[Scheduler] Launched thread')
-        while self.running:
-            if len(self.jobs) == 0:
-                Logger.warning('No jobs registered, nothing to do')
-                break
-
-            self.next_dt, self.next_jobs = self.queue.get_next_action()
-            for job in self.next_jobs:
-                self.status_update_callback(job.name, 'next', job.retry_count)
+        self.clock.idle_add(self.__wakeup, WakeupReason.PAUSE)
 
-            if self.next_dt is not None:
-                sleep_time = max(0.0, (self.next_dt - datetime.datetime.now()).total_seconds())
-                self.timer = threading.Timer(sleep_time, self.__timer_wakeup)
+    def __wakeup(self, reason: 'WakeupReason') -> bool:
+        Metrics.inc('bsrv_scheduler_wakeups', reason=reason.name.lower())
+        if reason == WakeupReason.UPDATE:
+            with self.wakeup_lock:
+                self.wakeup_pending = False
+        elif reason == WakeupReason.TIMER:
+            self.timer_source = None
 
-                Logger.debug(
-                    '[Scheduler] Determined next action at {}, waiting for {} s.'.format(self.next_dt, sleep_time))
-                self.timer_event.clear()
-                self.timer.start()
-            else:
-                Logger.debug('[Scheduler] All jobs currently running, waiting for one to finish')
+        if self.timer_source is not None:
+            self.clock.source_remove(self.timer_source)
+            self.timer_source = None
 
-            # Wait to be woken up
-            self.timer_event.wait()
+        if reason == WakeupReason.SHUTDOWN or not self.running:
+            return False
+        elif self.paused:
+            Logger.debug('[Scheduler] Paused, not launching any jobs.')
+            return False
 
-            if self.timer_reason == WakeupReason.SHUTDOWN:
-                if self.timer:
-                    self.timer.cancel()
+        Logger.debug('[Scheduler] Wakeup due to {}, re-evaluating todos.'.format(reason.name.lower()))
+        self.__evaluate()
+        return False
+
+    @timed('bsrv_scheduler_evaluate_seconds')
+    def __evaluate(self) -> NoReturn:
+        now = self.clock.now()
+        due_jobs = []
+        while True:
+            next_dt = self.queue.next_dt()
+            if next_dt is None or next_dt > now:
                 break
-            elif self.timer_reason == WakeupReason.UPDATE:
-                Logger.debug('[Scheduler] Wakeup due to update, re-evaluating todos.')
-                self.timer_event.clear()
-                if self.timer:
-                    self.timer.cancel()
-                while self.next_jobs:
-                    job = self.next_jobs.pop()
-                    self.queue.put(job, self.next_dt)
-                    self.status_update_callback(job.name, 'wait', job.retry_count)
+            due_dt, items = self.queue.get_next_action()
+            for job in items:
+                if job not in self.jobs_queued and job not in due_jobs:
+                    due_jobs.append(job)
+                    # Jobs overdue at startup are caught up, count their lag from the start of the scheduler.
+                    # Deferrals keep the originally planned time, so the launch lag includes them.
+                    planned = max(due_dt, self.started_dt)
+                    Metrics.observe('bsrv_scheduler_dispatch_lag_seconds', (now - planned).total_seconds())
+                    self.planned.setdefault(job, planned)
+
+        for job in due_jobs:
+            self.jobs_queued.append(job)
+            self.queued_since[job] = now
+        self.__launch_queued()
+
+        for job in due_jobs:
+            if job in self.jobs_queued:
+                Logger.info('[JOB{}] Queued, {}'.format(job.name, self.admission.blocked_reason(job)
+                                                        or self.breaker.blocked_reason(job, now)))
+                self.status_update_callback(job.name, 'queued', job.retry_count)
+
+        next_dt, next_jobs = self.queue.peek_next_action()
+        wakeup_dt = min(filter(None, [next_dt, self.breaker.next_probe_dt(now)]), default=None)
+        for job in self.next_jobs:
+            if job not in next_jobs and self.queue.when(job) is not None:
+                self.status_update_callback(job.name, 'wait', job.retry_count)
+        for job in next_jobs:
+            if job not in self.next_jobs:
+                self.status_update_callback(job.name, 'next', job.retry_count)
+        self.next_jobs = next_jobs
+
+        if wakeup_dt is not None:
+            sleep_time = max(0.0, (wakeup_dt - self.clock.now()).total_seconds())
+            if next_dt != self.next_dt:
+                Logger.debug('[Scheduler] Determined next action at {}, waiting for {} s.'.format(wakeup_dt, sleep_time))
+            self.timer_source = self.clock.timeout_add(math.ceil(min(sleep_time, self.max_sleep) * 1000),
+                                                       self.__wakeup, WakeupReason.TIMER)
+        elif self.jobs_running or self.jobs_queued:
+            Logger.debug('[Scheduler] All jobs currently running, waiting for one to finish')
+        self.next_dt = next_dt
+        self.__update_metrics()
+
+    def __update_metrics(self) -> NoReturn:
+        Metrics.set('bsrv_scheduler_jobs', len(self.jobs))
+        Metrics.set('bsrv_scheduler_running_jobs', len(self.jobs_running))
+        Metrics.set('bsrv_scheduler_queued_jobs', len(self.jobs_queued))
+        Metrics.set('bsrv_scheduler_scheduled_jobs', len(self.queue))
+        Metrics.set('bsrv_scheduler_paused', self.paused)
+
+    def __launch_queued(self) -> NoReturn:
+        now = self.clock.now()
+        for job in self.policy.order(self.jobs_queued, self.queued_since, now):
+            if (self.admission.blocked_reason(job) is not None or self.breaker.blocked_reason(job, now) is not None
+                    or self.__defer(job, now)):
                 continue
-            elif self.timer_reason == WakeupReason.PAUSE:
-                Logger.debug('[Scheduler] Wakeup due to pause trigger. Clearing timer and going to pause...')
-                self.timer_event.clear()
-                if self.timer:
-                    self.timer.cancel()
-
-                self.pause_callback(True)
+            if self.admission.try_acquire(job):
+                self.breaker.acquire(job)
+                self.jobs_queued.remove(job)
+                del self.queued_since[job]
+                self.__launch(job)
+
+    def __defer(self, job: 'Job', now: 'datetime.datetime') -> bool:
+        # Puts the job back into the queue if the host is under pressure, returns True if the job was deferred
+        limits = job.pressure_limits
+        if limits is None or not limits.enabled:
+            return False
 
-                self.timer_event.wait()
-                Logger.debug('[Scheduler] Wakeup from pause, re-evaluating todos.')
-                self.timer_event.clear()
+        deferral = self.deferrals.get(job)
+        if deferral is not None and now - deferral['since'] >= limits.defer_max:
+            Logger.warning('[JOB{}] Deferred {} times since {}, starting regardless of pressure'.format(
+                job.name, deferral['count'], deferral['since']))
+            return False
 
-                self.pause_callback(False)
+        reason = limits.exceeded()
+        if reason is None:
+            return False
 
-                while self.next_jobs:
-                    job = self.next_jobs.pop()
-                    self.queue.put(job, self.next_dt)
-                    self.status_update_callback(job.name, 'wait', job.retry_count)
-                continue
-            elif self.timer_reason == WakeupReason.TIMER:
-                Logger.debug('[Scheduler] Wakeup due to timer, launching jobs...')
-                if self.timer:
-                    self.timer.cancel()
-
-            while self.next_jobs:
-                job = self.next_jobs.pop()
-                thread = threading.Thread(target=self.job_thread, args=(job,))
-                thread.start()
-                with self.jobs_running_lock:
-                    self.threads_running[thread.ident] = thread
-                    self.jobs_running.append(job)
-                self.status_update_callback(job.name, 'running', job.retry_count)
-
-            self.timer_event.clear()
-        Logger.debug('[Scheduler] Exit thread')
-
-    def job_thread(self, job: 'Job') -> NoReturn:
+        if deferral is None:
+            deferral = {'since': now, 'count': 0, 'reason': reason}
+            self.deferrals[job] = deferral
+        delay = limits.backoff(deferral['count'])
+        deferral['count'] += 1
+        deferral['reason'] = reason
+        self.deferrals_total[job] = self.deferrals_total.get(job, 0) + 1
+
+        self.jobs_queued.remove(job)
+        del self.queued_since[job]
+        Logger.info('[JOB{}] Deferred for {}, {}'.format(job.name, delay, reason))
+        # Called during evaluation, which re-arms the timer afterwards anyway
+        self.queue.put(job, min(now + delay, deferral['since'] + limits.defer_max), hook_enabled=False)
+        self.status_update_callback(job.name, 'deferred', job.retry_count)
+        return True
+
+    def __launch(self, job: 'Job') -> NoReturn:
+        self.deferrals.pop(job, None)
+        planned = self.planned.pop(job, None)
+        if planned is not None:
+            Metrics.observe('bsrv_scheduler_launch_lag_seconds', (self.clock.now() - planned).total_seconds())
         if job.retry_count > 0:
             Logger.info('[JOB{}] Launching retry {}...'.format(job.name, job.retry_count))
         else:
             Logger.info('[JOB{}] Launching job...'.format(job.name))
 
-        successful = job.run()
+        self.jobs_running.append(job)
+        self.status_update_callback(job.name, 'running', job.retry_count)
+        try:
+            job.run(on_finished=lambda successful: self.__job_finished(job, successful),
+                    on_progress=lambda progress: self.progress_callback(job.name, progress))
+        except RuntimeError as e:
+            Logger.error('[JOB{}] {}'.format(job.name, str(e)))
+            self.__job_finished(job, False)
+
+    def __schedule_next(self, job: 'Job', dt: Union[None, 'datetime.datetime']) -> NoReturn:
+        if dt is None:
+            Logger.error('[JOB{}] Schedule has no future occurrence, job will not be run again'.format(job.name))
+        else:
+            self.queue.put(job, dt)
+
+    def __job_finished(self, job: 'Job', successful: bool) -> NoReturn:
+        self.admission.release(job)
+        self.breaker.record(job, successful, self.clock.now())
+
         if successful:
             if job.retry_count > 0:
                 Logger.info(
@@ -772,12 +1303,8 @@ class Scheduler:
                 Logger.info('[JOB{}] job completed successfully'.format(job.name))
                 job.retry_count = 0
 
-            job.set_last_archive_datetime(datetime.datetime.now())
-            self.queue.put(job, job.get_next_archive_datetime())
-            with self.jobs_running_lock:
-                del self.threads_running[threading.get_ident()]
-                self.jobs_running.remove(job)
-            self.status_update_callback(job.name, 'wait', job.retry_count)
+            job.set_last_archive_datetime(self.clock.now())
+            self.__schedule_next(job, job.get_next_archive_datetime())
         else:
             give_up = job.retry_count >= job.retry_max
             if job.retry_count > 0:
@@ -800,24 +1327,38 @@ class Scheduler:
                     job.retry_count += 1
 
             if not give_up:
-                scheduled_retry_dt = datetime.datetime.now() + datetime.timedelta(seconds=job.retry_delay)
-                Logger.debug('[JOB{}] Retry scheduled in {}'.format(job.name, datetime.timedelta(
-                    seconds=job.retry_delay)))
+                # Random jitter keeps retries of jobs that failed together from running together again
+                retry_delay = job.retry_delay * job.retry_backoff ** (job.retry_count - 1)
+                if job.retry_delay_max > 0:
+                    retry_delay = min(retry_delay, job.retry_delay_max)
+                retry_delay = datetime.timedelta(seconds=retry_delay + random.uniform(0, job.retry_jitter))
+                scheduled_retry_dt = self.clock.now() + retry_delay
+                Logger.debug('[JOB{}] Retry scheduled in {}'.format(job.name, retry_delay))
                 self.queue.put(job, scheduled_retry_dt)
             else:
                 job.hook_give_up.trigger(env={'BSRV_JOB': job.name})
-                scheduled_next_dt = job.get_next_archive_datetime(datetime.datetime.now())
-                self.queue.put(job, scheduled_next_dt)
+                scheduled_next_dt = job.get_next_archive_datetime(self.clock.now())
+                self.__schedule_next(job, scheduled_next_dt)
 
-            with self.jobs_running_lock:
-                del self.threads_running[threading.get_ident()]
-                self.jobs_running.remove(job)
+        self.jobs_running.remove(job)
+        # The freed slot may admit queued jobs, __schedule_next does not wake up if the job has no next occurrence
+        self.__update_wakeup()
+        self.status_update_callback(job.name, 'wait', job.retry_count)
+        Metrics.set('bsrv_job_retry', job.retry_count, job=job.name)
+        self.__update_metrics()
 
-            self.status_update_callback(job.name, 'wait', job.retry_count)
+        if not self.running and not self.jobs_running and self.stop_callback is not None:
+            Logger.info('[Scheduler] All running jobs finished')
+            self.stop_callback()
+            self.stop_callback = None
 
 
 class Schedule:
-    def __init__(self, txt: str):
+    def __init__(self, txt: str, seed: Union[None, str] = None, spread: Union[None, 'datetime.timedelta'] = None):
+        # seed makes H fields and the spread offset stable but distinct, e.g. for each job on each host
+        self.seed: str = seed if seed is not None else socket.gethostname()
+        self.offset: 'datetime.timedelta' = datetime.timedelta(0)
+
         every_expr = re.compile(r'^\s*@every\s*((?P<weeks>\d+)\s*w(eeks?)?)?'
                                 r'\s*((?P<days>\d+)\s*d(ays?)?)?'
                                 r'\s*((?P<hours>\d+)\s*h(ours?)?)?'
@@ -825,13 +1366,15 @@ class Schedule:
         weekly_expr = re.compile(r'^\s*@weekly\s*$', re.IGNORECASE)
         daily_expr = re.compile(r'^\s*@daily\s*$', re.IGNORECASE)
         hourly_expr = re.compile(r'^\s*@hourly\s*$', re.IGNORECASE)
-        cron_expr = re.compile(r'^\s*(?P<min>\d+(-\d+)?(,\d+(-\d+)?)*|\*(/\d+)?)'
-                               r'\s+(?P<hour>\d+(-\d+)?(,\d+(-\d+)?)*|\*(/\d+)?)'
-                               r'\s+(?P<mday>\d+(-\d+)?(,\d+(-\d+)?)*|\*(/\d+)?)'
-                               r'\s+(?P<month>\d+(-\d+)?(,\d+(-\d+)?)*|\*(/\d+)?)'
-                               r'\s+(?P<wday>\d+(-\d+)?(,\d+(-\d+)?)*|\*(/\d+)?)\s*$', re.IGNORECASE)
+        cron_elem = r'\d+(-\d+)?(,\d+(-\d+)?)*|\*(/\d+)?|H(\(\d+-\d+\))?(/\d+)?'
+        cron_expr = re.compile(r'^\s*(?P<min>{0})'
+                               r'\s+(?P<hour>{0})'
+                               r'\s+(?P<mday>{0})'
+                               r'\s+(?P<month>{0})'
+                               r'\s+(?P<wday>{0})\s*$'.format(cron_elem))
 
-        self.cron_type_expr = re.compile(r'^(?P<fixed>\d+(-\d+)?(,\d+(-\d+)?)*)|(?P<div>\*/\d+)|(?P<all>\*)$')
+        self.cron_type_expr = re.compile(r'^(?P<fixed>\d+(-\d+)?(,\d+(-\d+)?)*)|(?P<div>\*/\d+)|(?P<all>\*)'
+                                         r'|(?P<hash>H(\((?P<hash_from>\d+)-(?P<hash_to>\d+)\))?(/(?P<hash_div>\d+))?)$')
 
         self.interval: Union[None, 'datetime.timedelta'] = None
         self.crontab: Union[None, Dict[str, Iterable[int]]] = None
@@ -861,17 +1404,26 @@ class Schedule:
             info = match.groupdict()
 
             self.crontab = {
-                'min': self.__parse_cron_elem(info['min'], range(0, 59 + 1)),
-                'hour': self.__parse_cron_elem(info['hour'], range(0, 23 + 1)),
-                'mday': self.__parse_cron_elem(info['mday'], range(1, 31 + 1), onebased=True),
-                'month': self.__parse_cron_elem(info['month'], range(1, 12 + 1), onebased=True),
-                'wday': self.__parse_cron_elem(info['wday'], range(0, 7))
+                'min': self.__parse_cron_elem(info['min'], range(0, 59 + 1), name='min'),
+                'hour': self.__parse_cron_elem(info['hour'], range(0, 23 + 1), name='hour'),
+                # H in day(month) only picks from days every month has
+                'mday': self.__parse_cron_elem(info['mday'], range(1, 31 + 1), onebased=True, name='mday',
+                                               hash_vals=range(1, 28 + 1)),
+                'month': self.__parse_cron_elem(info['month'], range(1, 12 + 1), onebased=True, name='month'),
+                'wday': self.__parse_cron_elem(info['wday'], range(0, 7), name='wday')
             }
+            self.__compile()
+
+            if spread:
+                # Shift all occurrences by a stable offset within [0, spread)
+                self.offset = datetime.timedelta(
+                    seconds=stable_hash(self.seed, 'spread') % max(1, int(spread.total_seconds())))
             return
 
         raise ScheduleParseError('Invalid schedule specification.')
 
-    def __parse_cron_elem(self, elem: str, possible_vals: Iterable[int], onebased: bool = False) -> Iterable[int]:
+    def __parse_cron_elem(self, elem: str, possible_vals: Iterable[int], onebased: bool = False, name: str = '',
+                          hash_vals: Union[None, range] = None) -> Iterable[int]:
         match = self.cron_type_expr.fullmatch(elem)
         if not match:
             raise ScheduleParseError('Invalid schedule specification.')
@@ -899,47 +1451,163 @@ class Schedule:
         elif sub_info['all'] is not None:
             vals = possible_vals
 
+        elif sub_info['hash'] is not None:
+            if sub_info['hash_from'] is not None:
+                hash_vals = range(int(sub_info['hash_from']), int(sub_info['hash_to']) + 1)
+            elif hash_vals is None:
+                hash_vals = possible_vals
+            if len(hash_vals) == 0 or hash_vals[0] not in possible_vals or hash_vals[-1] not in possible_vals:
+                raise ScheduleParseError('Invalid schedule specification.')
+
+            h = stable_hash(self.seed, name)
+            if sub_info['hash_div'] is not None:
+                factor = int(sub_info['hash_div'])
+                if factor < 1:
+                    raise ScheduleParseError('Invalid schedule specification.')
+                start = hash_vals[0] + h % min(factor, len(hash_vals))
+                vals = list(range(start, hash_vals[-1] + 1, factor))
+            else:
+                vals = [hash_vals[h % len(hash_vals)]]
+
         else:
             raise ScheduleParseError('Invalid schedule specification.')
 
         return vals
 
-    def next(self, last: 'datetime.datetime') -> 'datetime.datetime':
-        if self.interval is not None:
-            return last + self.interval
-        elif self.crontab is not None:
-            for year in [last.year, last.year + 1]:
-                start_month = 1 if year > last.year else last.month
-
-                for month in sorted(set(range(start_month, 12 + 1)).intersection(self.crontab['month'])):
-                    start_day = 1 if month > last.month or year > last.year else last.day
-                    end_day = monthrange(year, month)[1]
-
-                    allday_list = sorted(range(start_day, end_day + 1))
-
-                    weekday_list = []
-                    for day in allday_list:
-                        if (datetime.date(year=year, month=month, day=day).weekday() + 1) % 7 in self.crontab['wday']:
-                            weekday_list.append(day)
+    @staticmethod
+    def __mask(vals: Iterable[int], possible_vals: range) -> int:
+        mask = 0
+        for v in vals:
+            if v not in possible_vals:
+                raise ScheduleParseError('Invalid schedule specification, {} out of range.'.format(v))
+            mask |= 1 << v
+        return mask
 
-                    monthday_list = sorted(set(allday_list).intersection(self.crontab['mday']))
+    @staticmethod
+    def __lowest_bit_from(mask: int, start: int) -> Union[None, int]:
+        # Position of the lowest set bit in mask at or above start
+        mask >>= start
+        if not mask:
+            return None
+        return start + (mask & -mask).bit_length() - 1
+
+    def __compile(self):
+        # Fields are compiled into bitmasks once, bit n set means value n is allowed
+        self.__min_mask = self.__mask(self.crontab['min'], range(0, 59 + 1))
+        self.__hour_mask = self.__mask(self.crontab['hour'], range(0, 23 + 1))
+        self.__mday_mask = self.__mask(self.crontab['mday'], range(1, 31 + 1))
+        self.__month_mask = self.__mask(self.crontab['month'], range(1, 12 + 1))
+        # Sunday may also be given as 7
+        self.__wday_mask = self.__mask([0 if v == 7 else v for v in self.crontab['wday']], range(0, 7))
+
+        # Like cron, a restricted day of month and a restricted day of week are combined, a day matching either is used
+        self.__mday_restricted = self.__mday_mask != self.__mask(range(1, 31 + 1), range(1, 31 + 1))
+        self.__wday_restricted = self.__wday_mask != self.__mask(range(0, 7), range(0, 7))
+
+        # Day of month masks matching the day of week field, indexed by the day of week (0: sunday) of the 1st
+        self.__wday_month_masks = []
+        for first_wday in range(7):
+            mask = 0
+            for day in range(1, 31 + 1):
+                if self.__wday_mask & (1 << ((first_wday + day - 1) % 7)):
+                    mask |= 1 << day
+            self.__wday_month_masks.append(mask)
+
+        # Without a day of week restriction, e.g. February 30th never occurs
+        max_days = [31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+        self.__possible = self.__wday_restricted or any(
+            self.__month_mask & (1 << month) and self.__mday_mask & ((1 << (max_days[month - 1] + 1)) - 2)
+            for month in range(1, 12 + 1))
+
+        self.__day_masks = {}
+
+    def __day_mask(self, year: int, month: int) -> int:
+        key = (year, month)
+        mask = self.__day_masks.get(key)
+        if mask is None:
+            first_wday, ndays = monthrange(year, month)
+            wday_mask = self.__wday_month_masks[(first_wday + 1) % 7]
+            if self.__mday_restricted and self.__wday_restricted:
+                mask = self.__mday_mask | wday_mask
+            elif self.__wday_restricted:
+                mask = wday_mask
+            else:
+                mask = self.__mday_mask
+            mask &= (1 << (ndays + 1)) - 2
+            if len(self.__day_masks) > 256:
+                self.__day_masks.clear()
+            self.__day_masks[key] = mask
+        return mask
+
+    def __next_cron(self, last: 'datetime.datetime') -> Union[None, 'datetime.datetime']:
+        if not self.__possible:
+            return None
 
-                    relevant_day_list = set([])
-                    if len(weekday_list) < len(allday_list):
-                        relevant_day_list = relevant_day_list.union(weekday_list)
-                    if len(monthday_list) < len(allday_list):
-                        relevant_day_list = relevant_day_list.union(monthday_list)
-                    if len(relevant_day_list) == 0:
-                        relevant_day_list = allday_list
+        t = last.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        year, month, day, hour, minute = t.year, t.month, t.day, t.hour, t.minute
 
-                    for day in sorted(relevant_day_list):
-                        start_hour = 0 if day > last.day or month > last.month or year > last.year else last.hour
+        # The day of week and leap year pattern repeats after 400 years, if nothing matched until then, nothing will
+        for _ in range(400 * 12 + 1):
+            next_month = self.__lowest_bit_from(self.__month_mask, month)
+            if next_month is None:
+                year, month, day, hour, minute = year + 1, 1, 1, 0, 0
+                if year > datetime.MAXYEAR:
+                    return None
+                continue
+            if next_month != month:
+                month, day, hour, minute = next_month, 1, 0, 0
 
-                        for hour in sorted(set(range(start_hour, 23 + 1)).intersection(self.crontab['hour'])):
-                            start_minute = 0 if hour > last.hour or day > last.day or month > last.month or year > last.year else last.minute + 1
+            while True:
+                next_day = self.__lowest_bit_from(self.__day_mask(year, month), day)
+                if next_day is None:
+                    break
+                if next_day != day:
+                    day, hour, minute = next_day, 0, 0
+
+                next_hour = self.__lowest_bit_from(self.__hour_mask, hour)
+                if next_hour is not None:
+                    if next_hour != hour:
+                        hour, minute = next_hour, 0
+
+                    next_minute = self.__lowest_bit_from(self.__min_mask, minute)
+                    if next_minute is not None:
+                        return datetime.datetime(year=year, month=month, day=day, hour=hour, minute=next_minute)
+
+                    next_hour = self.__lowest_bit_from(self.__hour_mask, hour + 1)
+                    if next_hour is not None:
+                        hour, minute = next_hour, 0
+                        return datetime.datetime(year=year, month=month, day=day, hour=hour,
+                                                 minute=self.__lowest_bit_from(self.__min_mask, 0))
+
+                day, hour, minute = day + 1, 0, 0
+
+            if month == 12:
+                year, month = year + 1, 1
+                if year > datetime.MAXYEAR:
+                    return None
+            else:
+                month += 1
+            day, hour, minute = 1, 0, 0
 
-                            for minute in sorted(set(range(start_minute, 59 + 1)).intersection(self.crontab['min'])):
-                                return datetime.datetime(year=year, month=month, day=day, hour=hour, minute=minute)
+        return None
 
+    def next(self, last: 'datetime.datetime') -> Union[None, 'datetime.datetime']:
+        if self.interval is not None:
+            return last + self.interval
+        elif self.crontab is not None:
+            next_dt = self.__next_cron(last - self.offset)
+            return next_dt + self.offset if next_dt is not None else None
         else:
             raise RuntimeError('Invalid internal schedule configuration.')
+
+    def iter(self, start: 'datetime.datetime') -> Iterator['datetime.datetime']:
+        dt = self.next(start)
+        while dt is not None:
+            yield dt
+            try:
+                dt = self.next(dt)
+            except OverflowError:
+                return
+
+    def upcoming(self, n: int, start: Union[None, 'datetime.datetime'] = None) -> Iterator['datetime.datetime']:
+        return itertools.islice(self.iter(start if start is not None else datetime.datetime.now()), n)
@@ -0,0 +1,303 @@
+import bisect
+import concurrent.futures
+import functools
+import http.server
+import os
+import socket
+import socketserver
+import threading
+import time
+from typing import Any, Callable, Dict, List, Tuple, Union
+
+from gi.repository import GLib
+
+from .config import Config
+from .logger import Logger
+
+METRICS = {
+    'bsrv_job_last_success_timestamp_seconds': 'Time of the last successful run of the job',
+    'bsrv_job_last_run_timestamp_seconds': 'Time the last run of the job finished',
+    'bsrv_job_last_run_success': 'Whether the last run of the job was successful',
+    'bsrv_job_last_run_duration_seconds': 'Duration of the last run of the job',
+    'bsrv_job_last_original_bytes': 'Original size of the last archive of the job',
+    'bsrv_job_last_compressed_bytes': 'Compressed size of the last archive of the job',
+    'bsrv_job_last_deduplicated_bytes': 'Deduplicated size of the last archive of the job',
+    'bsrv_job_last_files': 'Number of files in the last archive of the job',
+    'bsrv_job_retry': 'Retry counter of the job, 0: success, >0: retry, <0: gave up',
+    'bsrv_scheduler_jobs': 'Number of loaded jobs',
+    'bsrv_scheduler_running_jobs': 'Number of running jobs',
+    'bsrv_scheduler_queued_jobs': 'Number of due jobs waiting to be started',
+    'bsrv_scheduler_scheduled_jobs': 'Number of jobs scheduled for a later time',
+    'bsrv_scheduler_paused': 'Whether the scheduler is paused',
+    'bsrv_scheduler_wakeups': 'Wakeups of the scheduler by reason',
+    'bsrv_scheduler_dispatch_lag_seconds': 'Delay between the planned time of a job and the scheduler noticing it is due',
+    'bsrv_scheduler_launch_lag_seconds': 'Delay between the planned time of a job and its launch, including queueing',
+    'bsrv_scheduler_evaluate_seconds': 'Time spent evaluating the schedule per wakeup',
+    'bsrv_scheduler_queue_op_seconds': 'Time spent in scheduler queue operations',
+    'bsrv_hook_seconds': 'Time from triggering a hook until it finished',
+    'bsrv_dbus_method_seconds': 'Time until DBus method calls are answered, including work in the worker pool'
+}
+
+# Fixed bucket bounds from 10 us to about 6 h, so each histogram has a constant size
+BUCKETS = tuple(1e-5 * 2 ** i for i in range(32))
+
+# The textfile collector of node_exporter only reads the Prometheus text format, OpenMetrics is served via HTTP if the
+# scraper asks for it
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+def format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for key, value in labels) + '}'
+
+
+def format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Histogram:
+    def __init__(self, bounds: Tuple[float, ...] = BUCKETS):
+        self.bounds: Tuple[float, ...] = bounds
+        self.counts: List[int] = [0] * (len(bounds) + 1)
+        self.count: int = 0
+        self.sum: float = 0.0
+        self.max: float = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        # Upper bound of the bucket containing the quantile, this overestimates by at most a factor of 2
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            if cumulative >= rank and cumulative > 0:
+                return min(bound, self.max)
+        return self.max
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        buckets = []
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            buckets.append((format_value(bound), cumulative))
+        buckets.append(('+Inf', self.count))
+        return buckets
+
+
+def timed(name: str, label: Union[None, str] = None, value: Union[None, str] = None) -> Callable:
+    # Records the runtime of the decorated function in the histogram name, labeled with value or the function name. If
+    # it returns a Future, e.g. of a DBus method running in the worker pool, the time until the Future is done.
+    def decorator(func: Callable) -> Callable:
+        labels = {label: value or func.__name__.lstrip('_')} if label else {}
+
+        def observe(started: float):
+            Metrics.observe(name, time.perf_counter() - started, **labels)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except BaseException:
+                observe(started)
+                raise
+            if isinstance(result, concurrent.futures.Future):
+                result.add_done_callback(lambda _: observe(started))
+            else:
+                observe(started)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ['/', '/metrics']:
+            self.send_error(404)
+            return
+        openmetrics = 'application/openmetrics-text' in self.headers.get('Accept', '')
+        body = Metrics.render(openmetrics).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', OPENMETRICS_CONTENT_TYPE if openmetrics else CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ('unix', 0)
+
+
+class IPv6HTTPServer(http.server.ThreadingHTTPServer):
+    address_family = socket.AF_INET6
+
+
+class Metrics:
+    # Values are always recorded for GetMetrics, enabled only controls the exporter
+    values: Dict[str, Dict[Tuple[Tuple[str, str], ...], float]] = {}
+    counters: Dict[str, Dict[Tuple[Tuple[str, str], ...], float]] = {}
+    histograms: Dict[str, Dict[Tuple[Tuple[str, str], ...], 'Histogram']] = {}
+    lock = threading.Lock()
+    enabled: bool = False
+    version: int = 0
+    # Version and text of the last rendering, by format
+    rendered: Dict[bool, Tuple[int, str]] = {}
+    textfile: Union[None, str] = None
+    write_source: Union[None, int] = None
+    server: Union[None, 'socketserver.BaseServer'] = None
+
+    @staticmethod
+    def initialize():
+        textfile_dir = Config.get('metrics', 'textfile_dir', fallback=None)
+        listen = Config.get('metrics', 'listen', fallback=None)
+        if textfile_dir:
+            Metrics.textfile = os.path.join(textfile_dir, Config.get('metrics', 'textfile_name', fallback='bsrvd.prom'))
+        if listen:
+            try:
+                if listen.startswith('unix:'):
+                    path = listen[len('unix:'):]
+                    if os.path.exists(path):
+                        os.unlink(path)
+                    Metrics.server = UnixHTTPServer(path, MetricsRequestHandler)
+                else:
+                    host, _, port = listen.rpartition(':')
+                    host = host.strip('[]') or '127.0.0.1'
+                    # ThreadingHTTPServer only binds IPv4 addresses, e.g. [::1]:9469 needs an AF_INET6 socket
+                    server_class = IPv6HTTPServer if ':' in host else http.server.ThreadingHTTPServer
+                    Metrics.server = server_class((host, int(port)), MetricsRequestHandler)
+            except (OSError, ValueError) as e:
+                Logger.error('Could not listen for metrics requests on "{}": {}'.format(listen, str(e)))
+                Metrics.server = None
+            else:
+                threading.Thread(target=Metrics.server.serve_forever, name='metrics', daemon=True).start()
+                Logger.info('Serving metrics on "{}"'.format(listen))
+        Metrics.enabled = Metrics.textfile is not None or Metrics.server is not None
+        if Metrics.enabled:
+            Metrics.changed()
+
+    @staticmethod
+    def set(name: str, value: Union[int, float, bool], **labels: str):
+        # Cheap if unchanged, callers do not need to track changes themselves
+        key = tuple(sorted(labels.items()))
+        value = float(value)
+        with Metrics.lock:
+            series = Metrics.values.setdefault(name, {})
+            if series.get(key) == value:
+                return
+            series[key] = value
+            Metrics.version += 1
+        Metrics.changed()
+
+    @staticmethod
+    def inc(name: str, amount: float = 1, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with Metrics.lock:
+            series = Metrics.counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + amount
+            Metrics.version += 1
+        Metrics.changed()
+
+    @staticmethod
+    def observe(name: str, value: float, **labels: str):
+        key = tuple(sorted(labels.items()))
+        with Metrics.lock:
+            series = Metrics.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(max(0.0, value))
+            Metrics.version += 1
+        Metrics.changed()
+
+    @staticmethod
+    def snapshot() -> Dict[str, Any]:
+        with Metrics.lock:
+            return {
+                'gauges': {name: [{'labels': dict(labels), 'value': value} for labels, value in series.items()]
+                           for name, series in Metrics.values.items()},
+                'counters': {name: [{'labels': dict(labels), 'value': value} for labels, value in series.items()]
+                             for name, series in Metrics.counters.items()},
+                'histograms': {name: [{
+                    'labels': dict(labels),
+                    'count': histogram.count,
+                    'sum': histogram.sum,
+                    'max': histogram.max,
+                    'p50': histogram.quantile(0.5),
+                    'p90': histogram.quantile(0.9),
+                    'p99': histogram.quantile(0.99),
+                    'buckets': dict(histogram.cumulative())
+                } for labels, histogram in series.items()] for name, series in Metrics.histograms.items()}
+            }
+
+    @staticmethod
+    def changed():
+        if Metrics.textfile is None or not Metrics.enabled:
+            return
+        with Metrics.lock:
+            if Metrics.write_source is not None:
+                return
+            # Coalesce changes into at most one write per second
+            Metrics.write_source = GLib.timeout_add_seconds(1, Metrics.__write)
+
+    @staticmethod
+    def render(openmetrics: bool = False) -> str:
+        # Prometheus text format, or OpenMetrics. They differ in the name of counters in # TYPE and in # EOF.
+        with Metrics.lock:
+            rendered = Metrics.rendered.get(openmetrics)
+            if rendered is not None and rendered[0] == Metrics.version:
+                return rendered[1]
+            lines = []
+            for name, series in Metrics.values.items():
+                lines.append('# HELP {} {}'.format(name, METRICS.get(name, name)))
+                lines.append('# TYPE {} gauge'.format(name))
+                for labels, value in series.items():
+                    lines.append('{}{} {}'.format(name, format_labels(labels), format_value(value)))
+            for name, series in Metrics.counters.items():
+                family = name if openmetrics else name + '_total'
+                lines.append('# HELP {} {}'.format(family, METRICS.get(name, name)))
+                lines.append('# TYPE {} counter'.format(family))
+                for labels, value in series.items():
+                    lines.append('{}_total{} {}'.format(name, format_labels(labels), format_value(value)))
+            for name, series in Metrics.histograms.items():
+                lines.append('# HELP {} {}'.format(name, METRICS.get(name, name)))
+                lines.append('# TYPE {} histogram'.format(name))
+                for labels, histogram in series.items():
+                    for bound, count in histogram.cumulative():
+                        lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', bound),)), count))
+                    lines.append('{}_count{} {}'.format(name, format_labels(labels), histogram.count))
+                    lines.append('{}_sum{} {}'.format(name, format_labels(labels), format_value(histogram.sum)))
+            if openmetrics:
+                lines.append('# EOF')
+            Metrics.rendered[openmetrics] = (Metrics.version, '\n'.join(lines) + '\n')
+            return Metrics.rendered[openmetrics][1]
+
+    @staticmethod
+    def __write() -> bool:
+        with Metrics.lock:
+            Metrics.write_source = None
+        tmp_file = '{}.{}.tmp'.format(Metrics.textfile, os.getpid())
+        try:
+            with open(tmp_file, 'w') as f:
+                f.write(Metrics.render())
+            # Atomic, so the collector never reads a partially written file
+            os.replace(tmp_file, Metrics.textfile)
+        except OSError as e:
+            Logger.error('Could not write metrics file "{}": {}'.format(Metrics.textfile, str(e)))
+        return False
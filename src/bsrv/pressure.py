@@ -0,0 +1,88 @@
+import datetime
+import os
+from typing import Dict, Union
+
+from .config import Config
+from .logger import Logger
+from .tools import parse_timeperiod
+
+PSI_PATH = '/proc/pressure'
+PSI_RESOURCES = ['cpu', 'io', 'memory']
+
+
+def read_psi(resource: str) -> Union[None, float]:
+    # Share of time in % (avg10) in which at least some tasks were stalled on the given resource
+    try:
+        with open(os.path.join(PSI_PATH, resource), 'r') as f:
+            for line in f:
+                fields = line.split()
+                if fields and fields[0] == 'some':
+                    for field in fields[1:]:
+                        key, _, value = field.partition('=')
+                        if key == 'avg10':
+                            return float(value)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def read_loadavg() -> Union[None, float]:
+    try:
+        return os.getloadavg()[0]
+    except OSError:
+        return None
+
+
+class PressureLimits:
+    @staticmethod
+    def from_config(cfg_section: str):
+        def get(key: str) -> Union[None, str]:
+            return Config.get(cfg_section, key, fallback=Config.get('borg', key, fallback=None))
+
+        def getfloat(key: str) -> Union[None, float]:
+            value = get(key)
+            return float(value) if value else None
+
+        try:
+            psi_max = {resource: getfloat('pressure_{}_max'.format(resource)) for resource in PSI_RESOURCES}
+            loadavg_max = getfloat('loadavg_max')
+        except ValueError as e:
+            Logger.error('Error in config file: Invalid pressure settings for "{}": {}'.format(cfg_section, str(e)))
+            # Keeps the job from being registered instead of running it without the configured limits
+            return PressureLimits(psi_max={}, loadavg_max=None, backoff_max=None, defer_max=None, valid=False)
+
+        return PressureLimits(
+            psi_max=psi_max,
+            loadavg_max=loadavg_max,
+            backoff_max=parse_timeperiod(get('pressure_backoff_max') or '15m'),
+            defer_max=parse_timeperiod(get('pressure_defer_max') or '2h')
+        )
+
+    def __init__(self, psi_max: Dict[str, Union[None, float]], loadavg_max: Union[None, float],
+                 backoff_max: 'datetime.timedelta', defer_max: 'datetime.timedelta', valid: bool = True):
+        self.valid: bool = valid
+        self.psi_max: Dict[str, Union[None, float]] = psi_max
+        self.loadavg_max: Union[None, float] = loadavg_max
+        self.backoff_max: 'datetime.timedelta' = backoff_max or datetime.timedelta(minutes=15)
+        self.defer_max: 'datetime.timedelta' = defer_max or datetime.timedelta(0)
+
+    @property
+    def enabled(self) -> bool:
+        return self.loadavg_max is not None or any(v is not None for v in self.psi_max.values())
+
+    def exceeded(self) -> Union[None, str]:
+        # Returns a description of the first exceeded threshold, None if the job may start
+        for resource, limit in self.psi_max.items():
+            if limit is not None:
+                value = read_psi(resource)
+                if value is not None and value > limit:
+                    return '{} pressure {:.1f}% > {:.1f}%'.format(resource, value, limit)
+        if self.loadavg_max is not None:
+            value = read_loadavg()
+            if value is not None and value > self.loadavg_max:
+                return 'load average {:.2f} > {:.2f}'.format(value, self.loadavg_max)
+        return None
+
+    def backoff(self, deferrals: int) -> 'datetime.timedelta':
+        # 1 min, 2 min, 4 min, ... up to backoff_max
+        return min(datetime.timedelta(minutes=2 ** min(deferrals, 16)), self.backoff_max)
@@ -0,0 +1,253 @@
+import collections
+import os
+import selectors
+import subprocess
+import time
+from typing import Callable, Deque, Dict, List, Tuple, Union
+
+from gi.repository import GLib
+
+from .demote import DemotionSubprocess
+from .logger import Logger
+from .tools import pretty_size
+
+PROC_IO_FIELDS = {
+    'read_bytes': 'read_bytes',
+    'write_bytes': 'write_bytes',
+    'rchar': 'read_chars',
+    'wchar': 'write_chars'
+}
+
+
+def read_proc_io(pid: int) -> Dict[str, int]:
+    # read_bytes/write_bytes hit the storage layer, read_chars/write_chars include pipes and sockets, e.g. ssh
+    try:
+        with open('/proc/{}/io'.format(pid)) as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+    except OSError:
+        return {}
+    return {PROC_IO_FIELDS[key]: int(value) for key, value in fields.items() if key in PROC_IO_FIELDS}
+
+
+def exitcode(status: int) -> int:
+    # Like subprocess, the negative signal number if the child was killed. os.waitstatus_to_exitcode needs python 3.9.
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    if os.WIFEXITED(status):
+        return os.WEXITSTATUS(status)
+    raise ValueError('Invalid wait status {}'.format(status))
+
+
+def reap(popen: 'subprocess.Popen', started: float) -> Dict[str, float]:
+    # Waits for the child, sets its returncode and returns its resource usage. /proc/<pid>/io is read while the child
+    # is a zombie, it then includes all its threads and reaped descendants, just like the rusage of wait4.
+    try:
+        os.waitid(os.P_PID, popen.pid, os.WEXITED | os.WNOWAIT)
+        usage = {'wall_time': time.monotonic() - started}
+        usage.update(read_proc_io(popen.pid))
+        _, status, rusage = os.wait4(popen.pid, 0)
+    except ChildProcessError:
+        popen.wait()
+        return {'wall_time': time.monotonic() - started}
+    popen.returncode = exitcode(status)
+    usage.update(cpu_user=rusage.ru_utime, cpu_system=rusage.ru_stime, max_rss=rusage.ru_maxrss * 1024)
+    return usage
+
+
+def format_usage(usage: Dict[str, float]) -> str:
+    out = 'wall {:.1f} s'.format(usage.get('wall_time', 0.0))
+    if 'cpu_user' in usage:
+        cpu = usage['cpu_user'] + usage['cpu_system']
+        out += ', cpu {:.1f} s user, {:.1f} s sys'.format(usage['cpu_user'], usage['cpu_system'])
+        if usage.get('wall_time'):
+            out += ' ({:.0f}%)'.format(100 * cpu / usage['wall_time'])
+        out += ', max rss {}'.format(pretty_size(usage['max_rss']))
+    if 'read_bytes' in usage:
+        out += ', read {} from disk ({} total), written {} to disk ({} total)'.format(
+            pretty_size(usage['read_bytes']), pretty_size(usage['read_chars']),
+            pretty_size(usage['write_bytes']), pretty_size(usage['write_chars']))
+    return out
+
+
+class ChildProcess:
+    def __init__(
+            self,
+            demotion: DemotionSubprocess,
+            args: List[str],
+            env: dict,
+            on_exit: Callable[['ChildProcess'], None],
+            on_line: Union[None, Callable[['ChildProcess', str, str], None]] = None,
+            timeout: Union[None, int] = None,
+            tail: Union[None, int] = None
+    ):
+        self.demotion = demotion
+        self.args = args
+        self.env = env
+        self.on_exit = on_exit
+        self.on_line = on_line
+        self.timeout = timeout
+
+        self.popen: Union[None, 'subprocess.Popen'] = None
+        self.returncode: Union[None, int] = None
+        self.started: Union[None, float] = None
+        # Wall time, cpu time, max rss and io counters of the child, see reap()
+        self.usage: Dict[str, float] = {}
+        self.timed_out: bool = False
+        # Lines are collected here unless on_line is given, which then decides what to keep. Only the last tail lines
+        # are kept, if tail is given.
+        self.output: Deque[str] = collections.deque(maxlen=tail)
+
+        self.__streams: Dict[int, str] = {}
+        self.__buffers: Dict[int, bytes] = {}
+        self.__pending: int = 0
+        self.__timeout_source: Union[None, int] = None
+
+    @property
+    def pid(self) -> Union[None, int]:
+        return self.popen.pid if self.popen else None
+
+    def start(self) -> bool:
+        # Must be called from the thread running the GLib main loop.
+        self.started = time.monotonic()
+        try:
+            self.popen = self.demotion.Popen(self.args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                             stderr=subprocess.PIPE, env=self.env)
+        except (OSError, subprocess.SubprocessError) as e:
+            Logger.error('Exception occured during Popen: {}'.format(str(e)))
+            return False
+
+        for name, stream in [('stdout', self.popen.stdout), ('stderr', self.popen.stderr)]:
+            fd = stream.fileno()
+            os.set_blocking(fd, False)
+            self.__streams[fd] = name
+            self.__buffers[fd] = b''
+            self.__pending += 1
+            GLib.io_add_watch(fd, GLib.PRIORITY_DEFAULT, GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self.__read)
+
+        self.__pending += 1
+        try:
+            pidfd = os.pidfd_open(self.popen.pid)
+        except (AttributeError, OSError):
+            # No pidfd support (python < 3.9 or linux < 5.3), let GLib reap the child instead
+            GLib.child_watch_add(GLib.PRIORITY_DEFAULT, self.popen.pid, self.__child_exited)
+        else:
+            GLib.io_add_watch(pidfd, GLib.PRIORITY_DEFAULT, GLib.IO_IN, self.__pidfd_ready)
+
+        if self.timeout:
+            self.__timeout_source = GLib.timeout_add_seconds(self.timeout, self.__timeout_expired)
+        return True
+
+    def terminate(self):
+        if self.popen and self.returncode is None:
+            try:
+                self.popen.terminate()
+            except ProcessLookupError:
+                pass
+
+    def kill(self):
+        if self.popen and self.returncode is None:
+            try:
+                self.popen.kill()
+            except ProcessLookupError:
+                pass
+
+    def __line(self, fd: int, line: bytes):
+        line_ = line.decode(errors='replace')
+        if self.on_line:
+            self.on_line(self, self.__streams[fd], line_)
+        else:
+            self.output.append(line_)
+
+    def __read(self, fd: int, condition: int) -> bool:
+        try:
+            data = os.read(fd, 65536)
+        except BlockingIOError:
+            return True
+        except OSError:
+            data = b''
+
+        if data:
+            *lines, self.__buffers[fd] = (self.__buffers[fd] + data).split(b'\n')
+            for line in lines:
+                self.__line(fd, line)
+            return True
+
+        if self.__buffers[fd]:
+            self.__line(fd, self.__buffers[fd])
+            self.__buffers[fd] = b''
+        if self.__streams[fd] == 'stdout':
+            self.popen.stdout.close()
+        else:
+            self.popen.stderr.close()
+        self.__done()
+        return False
+
+    def __pidfd_ready(self, fd: int, condition: int) -> bool:
+        os.close(fd)
+        self.usage = reap(self.popen, self.started)
+        self.returncode = self.popen.returncode
+        self.__done()
+        return False
+
+    def __child_exited(self, pid: int, status: int):
+        # Already reaped by GLib, only the wall time is known
+        self.usage = {'wall_time': time.monotonic() - self.started}
+        self.returncode = exitcode(status)
+        self.popen.returncode = self.returncode
+        self.__done()
+
+    def __timeout_expired(self) -> bool:
+        self.__timeout_source = None
+        self.timed_out = True
+        self.kill()
+        return False
+
+    def __done(self):
+        self.__pending -= 1
+        if self.__pending > 0:
+            return
+        if self.__timeout_source is not None:
+            GLib.source_remove(self.__timeout_source)
+            self.__timeout_source = None
+        self.on_exit(self)
+
+
+def run_sync(demotion: DemotionSubprocess, args: List[str], env: dict, tail: Union[None, int] = None,
+             timeout: Union[None, float] = None) -> Tuple[int, str, List[str]]:
+    # Runs a child to completion, for use outside of the main loop. Returns the exit code, the complete stdout and the
+    # last tail lines of stderr. The child is killed if it does not finish within timeout seconds, which then raises
+    # subprocess.TimeoutExpired like communicate().
+    started = time.monotonic()
+    deadline = started + timeout if timeout is not None else None
+    p = demotion.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    stdout: List[bytes] = []
+    stderr: Deque[str] = collections.deque(maxlen=tail)
+    buffer = b''
+    with selectors.DefaultSelector() as selector:
+        selector.register(p.stdout, selectors.EVENT_READ)
+        selector.register(p.stderr, selectors.EVENT_READ)
+        while selector.get_map():
+            ready = selector.select(None if deadline is None else max(0.0, deadline - time.monotonic()))
+            if deadline is not None and time.monotonic() >= deadline:
+                p.kill()
+                p.stdout.close()
+                p.stderr.close()
+                reap(p, started)
+                raise subprocess.TimeoutExpired(args, timeout)
+            for key, _ in ready:
+                data = os.read(key.fd, 65536)
+                if not data:
+                    selector.unregister(key.fileobj)
+                elif key.fileobj is p.stdout:
+                    stdout.append(data)
+                else:
+                    *lines, buffer = (buffer + data).split(b'\n')
+                    stderr.extend(line.decode(errors='replace') for line in lines)
+    if buffer:
+        stderr.append(buffer.decode(errors='replace'))
+    p.stdout.close()
+    p.stderr.close()
+    usage = reap(p, started)
+    Logger.debug('Parent: "{}". {} {}: {}'.format(demotion.parent_descr, os.path.basename(args[0]),
+                                                 args[1] if len(args) > 1 else '', format_usage(usage)))
+    return p.returncode, b''.join(stdout).decode(errors='replace'), list(stderr)
@@ -0,0 +1,103 @@
+import os
+import re
+import math
+import shlex
+import subprocess
+from typing import Iterable, Tuple, Union
+
+from .demote import DemotionSubprocess
+from .logger import Logger
+from .process import run_sync
+
+# ssh://[user@]host[:port]/path, where /~/path and /./path are relative to the home directory
+ssh_location_expr = re.compile(r'^ssh://(?P<user>[^@/]+@)?(?P<host>\[[^\]]+\]|[^:/]+)(?::(?P<port>\d+))?(?P<path>/.*)$')
+# [user@]host:path
+scp_location_expr = re.compile(r'^(?P<user>[^@/:]+@)?(?P<host>[^:/]+):(?P<path>.+)$')
+file_location_expr = re.compile(r'^file://(?P<path>/.*)$')
+
+# Failures of the ssh probe. An unreachable host may be back later, an unsupported probe, e.g. because the key is
+# restricted to borg serve, fails the same way every time.
+PROBE_UNREACHABLE = 'unreachable'
+PROBE_UNSUPPORTED = 'unsupported'
+
+# ssh exits with 255 on its own errors, like a refused or timed out connection
+SSH_ERROR = 255
+
+# borg writes a new index.N on every commit of the repository, N being the transaction id
+index_file_expr = re.compile(r'^index\.(?P<transaction>\d+)$')
+
+
+def parse_location(borg_repo: str) -> Tuple[Union[None, str], Union[None, str], str]:
+    # Returns the ssh destination, which is None for local repositories, the ssh port and the path
+    match = file_location_expr.match(borg_repo)
+    if match:
+        return None, None, match.group('path')
+    for expr in [ssh_location_expr, scp_location_expr]:
+        match = expr.match(borg_repo)
+        if match:
+            destination = (match.group('user') or '') + match.group('host').strip('[]')
+            port = match.group('port') if 'port' in expr.groupindex else None
+            return destination, port, match.group('path')
+    return None, None, borg_repo
+
+
+def latest_index(names: Iterable[str]) -> Union[None, str]:
+    indices = [(int(match.group('transaction')), name) for name in names for match in [index_file_expr.match(name)]
+               if match]
+    return max(indices)[1] if indices else None
+
+
+def remote_path(path: str) -> str:
+    # Shell word for cd on the remote host, keeping ~ unquoted
+    if path.startswith('/~') or path.startswith('/./'):
+        path = path[1:]
+    if path == '~':
+        return '~'
+    if path.startswith('~/'):
+        return '~/' + shlex.quote(path[2:])
+    return shlex.quote(path)
+
+
+def probe_local(path: str) -> Union[None, str]:
+    try:
+        index = latest_index(os.listdir(path))
+        if index is None:
+            return None
+        st = os.stat(os.path.join(path, index))
+    except OSError:
+        return None
+    return '{} {} {}'.format(index, st.st_size, st.st_mtime_ns)
+
+
+def probe_ssh(demotion: DemotionSubprocess, borg_rsh: str, destination: str, port: Union[None, str], path: str,
+              env: dict, timeout: float) -> Tuple[Union[None, str], Union[None, str]]:
+    # One ssh command listing the index files, which fails if the key is restricted to borg serve. A forced borg serve
+    # waits for input, stdin is /dev/null and the command is killed after timeout seconds. Returns the state and the
+    # failure, PROBE_UNREACHABLE or PROBE_UNSUPPORTED, if there is no state.
+    params = shlex.split(borg_rsh) + ['-oBatchMode=yes', '-oConnectTimeout={}'.format(max(1, math.ceil(timeout)))] + \
+             (['-p', port] if port else []) + [destination, 'cd {} && ls -ln index.*'.format(remote_path(path))]
+    try:
+        returncode, stdout, stderr = run_sync(demotion, params, env, tail=5, timeout=timeout)
+    except OSError as e:
+        Logger.debug('Could not run "{}": {}'.format(params[0], str(e)))
+        return None, PROBE_UNSUPPORTED
+    except subprocess.TimeoutExpired:
+        Logger.debug('"{}" did not finish within {} s'.format(params[0], timeout))
+        return None, PROBE_UNREACHABLE
+    if returncode != 0:
+        for line in stderr:
+            Logger.debug(line)
+        return None, PROBE_UNREACHABLE if returncode == SSH_ERROR else PROBE_UNSUPPORTED
+    lines = {line.split()[-1]: ' '.join(line.split()) for line in stdout.splitlines() if line.strip()}
+    index = latest_index(lines)
+    return (lines[index], None) if index is not None else (None, PROBE_UNSUPPORTED)
+
+
+def repository_state(demotion: DemotionSubprocess, borg_repo: str, borg_rsh: str, env: dict,
+                     timeout: float = 10) -> Tuple[Union[None, str], Union[None, str]]:
+    # Name, size and modification time of the newest index file, which changes with every transaction, without
+    # running borg. Returns the state, or None if it could not be determined, and the failure of an ssh probe.
+    destination, port, path = parse_location(borg_repo)
+    if destination is None:
+        return probe_local(path), None
+    return probe_ssh(demotion, borg_rsh, destination, port, path, env, timeout)
@@ -0,0 +1,156 @@
+import ctypes
+import datetime
+import os
+import platform
+from typing import Callable, Dict, List, Set, Union, TYPE_CHECKING
+
+from .config import Config
+from .logger import Logger
+
+if TYPE_CHECKING:
+    from .demote import DemotionSubprocess
+
+IOPRIO_CLASSES = {
+    'realtime': 1,
+    'best-effort': 2,
+    'idle': 3
+}
+
+# ioprio_set has no wrapper in python or glibc
+SYS_IOPRIO_SET = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'riscv64': 30,
+    'armv7l': 314,
+    'ppc64le': 273,
+    's390x': 282
+}
+
+# Config key -> systemd resource control property of the transient scope (cgroup v2 cpu.max, memory.high, io.max)
+CGROUP_PROPERTIES = {
+    'cpu_quota': 'CPUQuota',
+    'memory_high': 'MemoryHigh',
+    'io_read_bandwidth_max': 'IOReadBandwidthMax',
+    'io_write_bandwidth_max': 'IOWriteBandwidthMax'
+}
+
+
+def parse_int_list(txt: str) -> Set[int]:
+    # Parses lists like "0-3,6"
+    vals = set()
+    for block in txt.split(','):
+        b = block.strip().split('-')
+        if len(b) == 1:
+            vals.add(int(b[0]))
+        elif len(b) == 2:
+            vals.update(range(int(b[0]), int(b[1]) + 1))
+        else:
+            raise ValueError('Invalid list "{}"'.format(txt))
+    return vals
+
+
+class ResourceControl:
+    @staticmethod
+    def from_config(cfg_section: str):
+        def get(key: str) -> Union[None, str]:
+            value = Config.get(cfg_section, key, fallback=Config.get('borg', key, fallback=None))
+            return value.strip() if value and value.strip() else None
+
+        try:
+            nice = get('nice')
+            ionice_class = get('ionice_class')
+            ionice_level = get('ionice_level')
+            cpu_affinity = get('cpu_affinity')
+            hours = get('resource_hours')
+            resources = ResourceControl(
+                nice=int(nice) if nice is not None else None,
+                ionice_class=ionice_class,
+                ionice_level=int(ionice_level) if ionice_level is not None else 4,
+                cpu_affinity=parse_int_list(cpu_affinity) if cpu_affinity is not None else None,
+                cgroup_properties={prop: get(key) for key, prop in CGROUP_PROPERTIES.items() if get(key) is not None},
+                hours=parse_int_list(hours) if hours is not None else None
+            )
+        except ValueError as e:
+            Logger.error('Error in config file: Invalid resource control settings for "{}": {}'.format(cfg_section,
+                                                                                                       str(e)))
+            return None
+
+        return resources if resources.enabled else None
+
+    def __init__(
+            self,
+            nice: Union[None, int] = None,
+            ionice_class: Union[None, str] = None,
+            ionice_level: int = 4,
+            cpu_affinity: Union[None, Set[int]] = None,
+            cgroup_properties: Union[None, Dict[str, str]] = None,
+            hours: Union[None, Set[int]] = None
+    ):
+        if ionice_class is not None and ionice_class not in IOPRIO_CLASSES:
+            raise ValueError('ionice_class can only be one of {}'.format(', '.join(IOPRIO_CLASSES.keys())))
+        if not 0 <= ionice_level <= 7:
+            raise ValueError('ionice_level has to be between 0 and 7')
+
+        self.nice: Union[None, int] = nice
+        self.cpu_affinity: Union[None, Set[int]] = cpu_affinity
+        self.cgroup_properties: Dict[str, str] = cgroup_properties or {}
+        # Limits are only applied if a child is spawned during one of these hours, None means always
+        self.hours: Union[None, Set[int]] = hours
+
+        self.ioprio: Union[None, int] = None
+        self.ioprio_syscall: Union[None, Callable] = None
+        if ionice_class is not None:
+            nr = SYS_IOPRIO_SET.get(platform.machine())
+            if nr is None:
+                Logger.warning('Setting ionice_class is not supported on "{}"'.format(platform.machine()))
+            else:
+                self.ioprio = IOPRIO_CLASSES[ionice_class] << 13 | ionice_level
+                # Resolve the syscall before forking, the preexec function should not need to load anything
+                libc_syscall = ctypes.CDLL(None, use_errno=True).syscall
+                self.ioprio_syscall = lambda: libc_syscall(nr, 1, 0, self.ioprio)
+
+    @property
+    def enabled(self) -> bool:
+        return (self.nice is not None or self.ioprio is not None or self.cpu_affinity is not None
+                or bool(self.cgroup_properties))
+
+    def active(self, now: Union[None, 'datetime.datetime'] = None) -> bool:
+        if self.hours is None:
+            return True
+        if now is None:
+            now = datetime.datetime.now()
+        return now.hour in self.hours
+
+    def scope_command(self, demotion: 'DemotionSubprocess') -> List[str]:
+        # Runs the command in a transient systemd scope, which gets its own cgroup with the configured limits
+        cmd = ['systemd-run', '--scope', '--quiet', '--collect']
+        if os.getuid() != 0:
+            cmd.append('--user')
+        if demotion.is_demotion:
+            cmd += ['--uid={}'.format(demotion.uid), '--gid={}'.format(demotion.gid)]
+        for prop, value in self.cgroup_properties.items():
+            cmd += ['-p', '{}={}'.format(prop, value)]
+        cmd.append('--')
+        return cmd
+
+    def limit_fn(self, then: Union[None, Callable[[], None]] = None) -> Callable[[], None]:
+        # Process attributes are inherited by the command, this is best effort and never fails the spawn
+        def limit_():
+            if self.nice is not None:
+                try:
+                    os.nice(self.nice)
+                except OSError:
+                    pass
+            if self.ioprio_syscall is not None:
+                self.ioprio_syscall()
+            if self.cpu_affinity is not None:
+                try:
+                    os.sched_setaffinity(0, self.cpu_affinity)
+                except OSError:
+                    pass
+            if then is not None:
+                then()
+
+        return limit_
@@ -0,0 +1,198 @@
+import datetime
+import functools
+import logging
+import math
+import random
+import time
+from typing import Any, Callable, Dict, IO, Tuple, Union
+
+from texttable import Texttable
+
+from .clock import VirtualClock
+from .config import Config
+from .hook import Hook
+from .job import Job, Scheduler
+from .logger import Logger
+from .metrics import Metrics
+from .tools import parse_timeperiod, pretty_datetime
+
+
+def whole_seconds(td: 'datetime.timedelta') -> 'datetime.timedelta':
+    return datetime.timedelta(seconds=int(td.total_seconds()))
+
+
+def parse_duration_range(txt: str) -> Tuple[float, float]:
+    # "10m" or "5m-1h", returns the bounds in seconds
+    bounds = [parse_timeperiod(part) for part in txt.split('-')]
+    if len(bounds) > 2 or None in bounds:
+        raise ValueError('Invalid duration "{}"'.format(txt))
+    return bounds[0].total_seconds(), bounds[-1].total_seconds()
+
+
+class Simulation:
+    # Drives the real Scheduler with a VirtualClock, Job.run is replaced by a stub that finishes after a random duration
+    # with a random result, according to [simulate] duration and success_rate or the simulate_* keys of the job.
+    @staticmethod
+    def from_config(start: 'datetime.datetime', end: 'datetime.datetime', timeline: Union[None, IO] = None):
+        simulation = Simulation(start, end, timeline, seed=Config.getint('simulate', 'seed', fallback=0))
+        for s in Config.sections():
+            if s[0] == ':':
+                job = Job.from_bsrvd_config(s)
+                if job and job.runnable:
+                    try:
+                        duration = parse_duration_range(Config.get(
+                            s, 'simulate_duration', fallback=Config.get('simulate', 'duration', fallback='10m')))
+                        success_rate = Config.getfloat(
+                            s, 'simulate_success_rate', fallback=Config.getfloat('simulate', 'success_rate',
+                                                                                 fallback=1.0))
+                    except ValueError as e:
+                        Logger.error('Error in config file: Invalid simulation parameters for job "{}": {}'.format(
+                            s, str(e)))
+                        continue
+                    simulation.add(job, duration, success_rate)
+        return simulation
+
+    def __init__(self, start: 'datetime.datetime', end: 'datetime.datetime', timeline: Union[None, IO] = None,
+                 seed: int = 0):
+        self.start: 'datetime.datetime' = start
+        self.end: 'datetime.datetime' = end
+        self.timeline: Union[None, IO] = timeline
+        self.clock = VirtualClock(start)
+        self.scheduler = Scheduler(clock=self.clock)
+        # Virtual time has no clock changes or suspend to catch up with
+        self.scheduler.max_sleep = math.inf
+        self.scheduler.status_update_callback = self.__status_update
+        self.random = random.Random(seed)
+        # Retry jitter of the scheduler
+        random.seed(seed)
+        self.jobs: Dict[str, Dict[str, Any]] = {}
+        self.peak_running: Tuple[int, Union[None, 'datetime.datetime']] = (0, None)
+        self.peak_queued: Tuple[int, Union[None, 'datetime.datetime']] = (0, None)
+        self.running_area: float = 0.0
+        self.last_change: 'datetime.datetime' = start
+        self.elapsed: float = 0.0
+
+    def add(self, job: 'Job', duration: Tuple[float, float], success_rate: float):
+        # Every job starts with a backup at the start of the simulation, without side effects of hooks or the cache
+        job.last_archive_date = self.start
+        job.pressure_limits = None
+        for value in vars(job).values():
+            if isinstance(value, Hook):
+                value.command = []
+        job.run = functools.partial(self.__run, job)
+        job.set_last_archive_datetime = functools.partial(setattr, job, 'last_archive_date')
+        self.jobs[job.name] = {
+            'job': job,
+            'duration': duration,
+            'success_rate': success_rate,
+            'runs': 0,
+            'failed': 0,
+            'gave_up': 0,
+            'last_success': self.start,
+            'max_age': datetime.timedelta(0),
+            'max_age_dt': None,
+            'over_maxage': datetime.timedelta(0)
+        }
+        self.scheduler.register(job)
+
+    def run(self):
+        # Log messages of the scheduler would carry the real time, the timeline replaces them
+        level = Logger.getEffectiveLevel()
+        Logger.setLevel(logging.CRITICAL)
+        started = time.perf_counter()
+        try:
+            self.scheduler.start()
+            self.clock.run_until(self.end)
+        finally:
+            Logger.setLevel(level)
+        self.elapsed = time.perf_counter() - started
+        self.__account_running()
+        for stats in self.jobs.values():
+            self.__account_age(stats, self.end)
+
+    def __event(self, event: str, job_name: str, detail: str = ''):
+        if self.timeline is not None:
+            self.timeline.write('{}\t{}\t{}\t{}\n'.format(self.clock.now().isoformat(), event, job_name, detail))
+
+    def __account_running(self, started: int = 0):
+        # Time integral of the number of running jobs, without the jobs started just now
+        now = self.clock.now()
+        self.running_area += (len(self.scheduler.jobs_running) - started) * (now - self.last_change).total_seconds()
+        self.last_change = now
+
+    def __account_peaks(self):
+        running = len(self.scheduler.jobs_running)
+        queued = len(self.scheduler.jobs_queued)
+        if running > self.peak_running[0]:
+            self.peak_running = (running, self.clock.now())
+        if queued > self.peak_queued[0]:
+            self.peak_queued = (queued, self.clock.now())
+
+    def __account_age(self, stats: Dict[str, Any], now: 'datetime.datetime'):
+        # Age of the newest backup right before a new one is created, or at the end of the simulation
+        age = now - stats['last_success']
+        if age > stats['max_age']:
+            stats['max_age'] = age
+            stats['max_age_dt'] = now
+        maxage = stats['job'].stat_maxage
+        if maxage and age > maxage:
+            stats['over_maxage'] += age - maxage
+
+    def __status_update(self, job_name: str, sched_status: str, retry: int):
+        if sched_status == 'queued':
+            self.__event('queued', job_name)
+            self.__account_peaks()
+
+    def __run(self, job: 'Job', on_finished: Callable[[bool], None], on_progress=None):
+        # Called by the scheduler, which already counts the job as running
+        stats = self.jobs[job.name]
+        low, high = stats['duration']
+        duration = round(self.random.uniform(low, high))
+        successful = self.random.random() < stats['success_rate']
+        self.__account_running(started=1)
+        self.__event('start', job.name, 'retry {}'.format(job.retry_count) if job.retry_count > 0 else '')
+        self.__account_peaks()
+        self.clock.timeout_add(duration * 1000, self.__finished, job, successful, duration, on_finished)
+
+    def __finished(self, job: 'Job', successful: bool, duration: int, on_finished: Callable[[bool], None]) -> bool:
+        stats = self.jobs[job.name]
+        now = self.clock.now()
+        self.__account_running()
+        stats['runs'] += 1
+        if successful:
+            self.__account_age(stats, now)
+            stats['last_success'] = now
+        else:
+            stats['failed'] += 1
+        self.__event('success' if successful else 'failure', job.name, str(datetime.timedelta(seconds=duration)))
+        on_finished(successful)
+        if job.retry_count < 0:
+            stats['gave_up'] += 1
+            self.__event('give_up', job.name)
+        return False
+
+    def report(self) -> str:
+        runs = sum(stats['runs'] for stats in self.jobs.values())
+        span = (self.end - self.start).total_seconds()
+        lag = Metrics.snapshot()['histograms'].get('bsrv_scheduler_launch_lag_seconds', [{}])[0]
+        out = 'Simulated {} to {} ({}) in {:.1f} s\n'.format(pretty_datetime(self.start), pretty_datetime(self.end),
+                                                            self.end - self.start, self.elapsed)
+        out += 'Runs: {}, failed: {}, gave up: {}\n'.format(
+            runs, sum(stats['failed'] for stats in self.jobs.values()),
+            sum(stats['gave_up'] for stats in self.jobs.values()))
+        out += 'Peak concurrency: {} running at {}, {} queued at {}\n'.format(
+            self.peak_running[0], pretty_datetime(self.peak_running[1]) if self.peak_running[1] else '-',
+            self.peak_queued[0], pretty_datetime(self.peak_queued[1]) if self.peak_queued[1] else '-')
+        out += 'Mean running jobs: {:.2f}\n'.format(self.running_area / span if span > 0 else 0.0)
+        if lag.get('count'):
+            out += 'Delay from planned to actual start: p50 {}, p99 {}, max {}\n'.format(
+                *[whole_seconds(datetime.timedelta(seconds=lag[key])) for key in ['p50', 'p99', 'max']])
+
+        tbl = Texttable(max_width=0)
+        tbl.header(['Job', 'Runs', 'Failed', 'Gave up', 'Max backup age', 'At', 'stat_maxage', 'Time over stat_maxage'])
+        for name, stats in sorted(self.jobs.items(), key=lambda item: item[1]['max_age'], reverse=True):
+            maxage = stats['job'].stat_maxage
+            tbl.add_row([name, str(stats['runs']), str(stats['failed']), str(stats['gave_up']), str(whole_seconds(stats['max_age'])),
+                         pretty_datetime(stats['max_age_dt']) if stats['max_age_dt'] else '-',
+                         str(maxage) if maxage else '-', str(whole_seconds(stats['over_maxage'])) if maxage else '-'])
+        return out + tbl.draw()
@@ -2,52 +2,77 @@ import datetime
 import json
 import math
 import os
-from typing import Union
+import re
+from typing import Any, FrozenSet, Union
 
 from texttable import Texttable
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def parse_json(json_source: str):
-    source = json.loads(json_source)
-    return json_iso2datetime(source)
 
+# Keys whose values are ISO datetimes in the output of borg and in the JSON of bsrv
+DATETIME_KEYS = frozenset(['start', 'end', 'time', 'last_modified', 'started', 'finished', 'info_dt',
+                           'job_last_successful', 'job_next_suggested', 'schedule_dt', 'schedule_deadline',
+                           'progress_eta'])
 
-def gen_json(obj: dict):
-    obj = json_datetime2iso(obj)
-    return json.dumps(obj)
 
+def parse_json(json_source: Union[str, bytes], datetime_keys: FrozenSet[str] = DATETIME_KEYS):
+    # Only values of datetime_keys are converted, other strings like archive names stay as they are. Converting the
+    # datetimes costs more than parsing, orjson would not be faster here.
+    return json.loads(json_source, object_hook=lambda obj: iso2datetime(obj, datetime_keys))
 
-def json_datetime2iso(obj: dict):
-    for k, v in obj.items():
-        if isinstance(v, list):
-            for a in v:
-                json_datetime2iso(a)
-        elif isinstance(v, dict):
-            json_datetime2iso(v)
-        elif isinstance(v, datetime.datetime):
-            obj[k] = v.isoformat()
-    return obj
 
+def gen_json(obj: dict) -> str:
+    # Does not modify obj. orjson writes datetimes like isoformat() does, but without spaces after separators. It does
+    # not accept everything json does, e.g. integers of more than 64 bit, these are written by json instead.
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+        except (TypeError, orjson.JSONEncodeError):
+            pass
+    return json.dumps(obj, default=json_datetime2iso)
 
-def json_iso2datetime(source: dict):
-    for k, v in source.items():
-        if isinstance(v, list):
-            for a in v:
-                json_iso2datetime(a)
-        elif isinstance(v, dict):
-            json_iso2datetime(v)
-        elif isinstance(v, str) and not v.isdigit():
-            try:
-                float(v)
-                continue
-            except ValueError:
-                pass
+
+def json_datetime2iso(value: Any) -> str:
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(value).__name__))
+
+
+def iso2datetime(obj: dict, datetime_keys: FrozenSet[str]) -> dict:
+    for k in datetime_keys.intersection(obj):
+        if isinstance(obj[k], str):
             try:
-                source[k] = datetime.datetime.fromisoformat(v)
+                obj[k] = datetime.datetime.fromisoformat(obj[k])
             except (ValueError, OverflowError):
                 pass
+    return obj
+
 
-    return source
+def every_expr2dt(match: re.Match) -> datetime.timedelta:
+    info = match.groupdict()
+    return datetime.timedelta(
+        weeks=int(info['weeks'] if info['weeks'] is not None else 0),
+        days=int(info['days'] if info['days'] is not None else 0),
+        hours=int(info['hours'] if info['hours'] is not None else 0),
+        minutes=int(info['minutes'] if info['minutes'] is not None else 0),
+    )
+
+
+def parse_timeperiod(txt: str) -> Union[None, datetime.timedelta]:
+    every_expr = re.compile(r'^\s*((?P<weeks>\d+)\s*w(eeks?)?)?'
+                            r'\s*((?P<days>\d+)\s*d(ays?)?)?'
+                            r'\s*((?P<hours>\d+)\s*h(ours?)?)?'
+                            r'\s*((?P<minutes>\d+)\s*m(in(utes?)?)?)?\s*$', re.IGNORECASE)
+
+    match = every_expr.fullmatch(txt)
+    if match:
+        return every_expr2dt(match)
+    else:
+        return None
 
 
 def pretty_datetime(dt: Union[datetime.datetime, str]):
@@ -64,6 +89,8 @@ def pretty_datetime(dt: Union[datetime.datetime, str]):
 
 def pretty_size(sz: int):
     names = ['B', 'KiB', 'MiB', 'GiB', 'TiB', 'PiB', 'EiB', 'ZiB', 'YiB']
+    if sz <= 0:
+        return '0 B'
     idx = math.floor(math.log(sz, 1024))
     sz = sz / math.pow(1024, idx)
     if idx == 0:
@@ -72,6 +99,77 @@ def pretty_size(sz: int):
         return '%.1f %s' % (sz, names[idx])
 
 
+def pretty_progress(progress: dict):
+    out = '{} read, {} deduplicated, {} files, {}/s'.format(
+        pretty_size(int(progress['progress_original_size'])),
+        pretty_size(int(progress['progress_deduplicated_size'])),
+        progress['progress_nfiles'],
+        pretty_size(int(progress['progress_rate'])))
+    if 'progress_percent' in progress:
+        out += ', {}%, ETA {}'.format(progress['progress_percent'], pretty_datetime(progress['progress_eta']))
+    return out
+
+
+def pretty_duration(seconds: Union[None, float]):
+    if seconds is None:
+        return '-'
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+def pretty_history(runs: list):
+    tbl = Texttable(max_width=120)
+    tbl.header(['Id', 'Job', 'Started', 'Result', 'Create', 'Prune', 'Hook', 'Original', 'Deduplicated', 'Files', 'CPU',
+                'Disk read'])
+    for run in runs:
+        # Resource usage of borg create, cpu time relative to wall time tells cpu bound from io bound runs
+        usage = (run.get('usage') or {}).get('create', {})
+        tbl.add_row([
+            str(run['id']),
+            run['job'],
+            pretty_datetime(run['started']),
+            ('ok' if run['successful'] else 'failed') + (' (retry {})'.format(run['retry']) if run['retry'] else ''),
+            pretty_duration(run['create_duration']),
+            pretty_duration(run['prune_duration']),
+            pretty_duration(run['hook_duration']),
+            pretty_size(run['original_size']) if run['original_size'] is not None else '-',
+            pretty_size(run['deduplicated_size']) if run['deduplicated_size'] is not None else '-',
+            str(run['nfiles']) if run['nfiles'] is not None else '-',
+            '{:.0f}%'.format(100 * (usage['cpu_user'] + usage['cpu_system']) / usage['wall_time'])
+            if 'cpu_user' in usage and usage.get('wall_time') else '-',
+            pretty_size(usage['read_bytes']) if 'read_bytes' in usage else '-'
+        ])
+    return tbl.draw()
+
+
+def pretty_latency(seconds: float):
+    if seconds < 1:
+        return '%.2f ms' % (seconds * 1000)
+    return '%.2f s' % seconds
+
+
+def pretty_metrics(metrics: dict):
+    def labels(series):
+        return ', '.join('{}={}'.format(k, v) for k, v in sorted(series['labels'].items()))
+
+    tbl = Texttable(max_width=0)
+    tbl.header(['Histogram', 'Labels', 'Count', 'Mean', 'p50', 'p90', 'p99', 'Max'])
+    for name, series_list in sorted(metrics['histograms'].items()):
+        for series in series_list:
+            tbl.add_row([name, labels(series), str(series['count']),
+                         pretty_latency(series['sum'] / series['count']) if series['count'] else '-',
+                         pretty_latency(series['p50']), pretty_latency(series['p90']), pretty_latency(series['p99']),
+                         pretty_latency(series['max'])])
+    out = tbl.draw() + '\n'
+
+    tbl = Texttable(max_width=0)
+    tbl.header(['Metric', 'Labels', 'Value'])
+    for name, series_list in sorted(list(metrics['counters'].items()) + list(metrics['gauges'].items())):
+        for series in series_list:
+            tbl.add_row([name, labels(series), '%g' % series['value']])
+    out += tbl.draw()
+    return out
+
+
 def pretty_info(info: dict):
     out = ''
     out += 'Scheduler info about this job:\n'
@@ -84,6 +182,19 @@ def pretty_info(info: dict):
     tbl.add_row(['Retry counter (0: success, >0: retry, <0: gave up)', info['scheduler']['job_retry']])
     tbl.add_row(['Scheduling status of this job', info['scheduler']['schedule_status']])
     tbl.add_row(['Next action time for this job', pretty_datetime(info['scheduler']['schedule_dt'])])
+    if 'schedule_reason' in info['scheduler']:
+        tbl.add_row(['Reason for waiting', info['scheduler']['schedule_reason']])
+    if 'schedule_deferrals' in info['scheduler']:
+        tbl.add_row(['Deferrals due to system pressure', info['scheduler']['schedule_deferrals']])
+    if 'schedule_rank' in info['scheduler']:
+        tbl.add_row(['Position among waiting jobs ({})'.format(info['scheduler']['schedule_policy']),
+                     info['scheduler']['schedule_rank']])
+    if 'schedule_deadline' in info['scheduler']:
+        tbl.add_row(['Deadline used for scheduling', pretty_datetime(info['scheduler']['schedule_deadline'])])
+        tbl.add_row(['Priority including aging', info['scheduler']['schedule_priority']])
+    if 'progress_original_size' in info['scheduler']:
+        tbl.add_row(['Progress of running backup', pretty_progress(info['scheduler'])])
+        tbl.add_row(['Currently processed path', info['scheduler']['progress_path']])
     out += tbl.draw() + '\n\n'
 
     out += 'The Repository for this job contains the following archives:\n'
@@ -93,7 +204,11 @@ def pretty_info(info: dict):
         tbl.add_row([archive['name'], pretty_datetime(archive['start']), pretty_datetime(archive['time'])])
     out += tbl.draw() + '\n\n'
 
-    out += 'Repository stats:\n'
+    if 'info_age' in info:
+        out += 'Repository stats as of {} ({} s ago):\n'.format(pretty_datetime(info['info_dt']),
+                                                               round(float(info['info_age'])))
+    else:
+        out += 'Repository stats:\n'
     tbl = Texttable(max_width=80)
     tbl.header(['Name', 'Value'])
     tbl.set_cols_align(['l', 'c'])
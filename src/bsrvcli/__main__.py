@@ -5,9 +5,10 @@ import sys
 import time
 
 from dasbus.error import DBusError
+from dasbus.loop import EventLoop
 
 from bsrv import SYSTEM_BUS, SESSION_BUS, get_dbus_service_identifier
-from bsrv.tools import parse_json, pretty_info
+from bsrv.tools import parse_json, pretty_history, pretty_info, pretty_metrics, pretty_progress
 
 
 def main():
@@ -19,6 +20,14 @@ def main():
                          help='Display information about the job, including last archive dates, repository size and scheduling status')
     m_group.add_argument('-r', '--run', metavar='JOB_NAME', default=None, action='store', type=str,
                          help='Manually run a job now. This may have an influence on future scheduled actions for this job.')
+    m_group.add_argument('-p', '--progress', metavar='JOB_NAME', default=None, action='store', type=str,
+                         help='Follow the progress of a running, queued or deferred job until it finished')
+    m_group.add_argument('--history', metavar='JOB_NAME', nargs='?', const='', default=None, type=str,
+                         help='Display past runs of the job, or of all jobs if no name is given, newest first')
+    m_group.add_argument('--metrics', action='store_true', default=False,
+                         help='Display scheduler metrics, including scheduling lag and latency histograms')
+    m_group.add_argument('--diagnostics', action='store_true', default=False,
+                         help='Make the daemon write a diagnostic dump (thread stacks, queue, jobs) to its base_dir')
     m_group.add_argument('-m', '--mount', metavar='JOB_NAME', action='store', default=None, type=str,
                          help='Mount repository for given job using "borg mount"')
     m_group.add_argument('-u', '--umount', metavar='JOB_NAME', action='store', default=None, type=str,
@@ -32,6 +41,16 @@ def main():
     parser.add_argument('--session-bus', action='store_true', default=False,
                         help='Connect to daemon dbus interface via SESSION_BUS, default is SYSTEM_BUS')
 
+    parser.add_argument('--limit', metavar='N', action='store', default=20, type=int,
+                        help='Number of runs displayed by --history, default is 20')
+    parser.add_argument('--before', metavar='ID', action='store', default=0, type=int,
+                        help='Only display runs older than the run with this id with --history, to page through them')
+
+    parser.add_argument('--profile', metavar='SECONDS', action='store', default=0, type=int,
+                        help='Include a profile of the daemon main loop over this many seconds with --diagnostics')
+    parser.add_argument('--tracemalloc', metavar='N', action='store', default=0, type=int,
+                        help='Include the top N memory allocation sites with --diagnostics')
+
     parser.add_argument('--json', action='store_true', default=False,
                         help='Instead of outputting nicely formatted data, output data as JSON')
 
@@ -66,6 +85,47 @@ def main():
         elif args.run:
             if not proxy.RunJob(args.run):
                 sys.exit(1)
+        elif args.progress:
+            status = proxy.GetJobStatus(args.progress)
+            if not status:
+                sys.exit(1)
+            if status['schedule_status'] not in ['running', 'queued', 'deferred']:
+                print('Job "{}" is not running'.format(args.progress))
+                sys.exit(1)
+
+            def print_progress(progress):
+                if args.json:
+                    print(json.dumps(progress), flush=True)
+                elif 'progress_original_size' in progress:
+                    print(pretty_progress(progress), flush=True)
+
+            def progress_update(job_name, progress):
+                if job_name == args.progress:
+                    print_progress(progress)
+
+            def status_update(job_name, sched, retry):
+                if job_name == args.progress and sched not in ['running', 'queued', 'deferred']:
+                    loop.quit()
+
+            loop = EventLoop()
+            proxy.ProgressNotifier.connect(progress_update)
+            proxy.StatusUpdateNotifier.connect(status_update)
+            print_progress(status)
+            loop.run()
+        elif args.history is not None:
+            history_json = proxy.GetHistory(args.history, args.before, args.limit)
+            if args.json:
+                print(history_json)
+            else:
+                print(pretty_history(parse_json(history_json)['runs']))
+        elif args.metrics:
+            metrics_json = proxy.GetMetrics()
+            if args.json:
+                print(metrics_json)
+            else:
+                print(pretty_metrics(parse_json(metrics_json)))
+        elif args.diagnostics:
+            print(proxy.DumpDiagnostics(args.profile, args.tracemalloc))
         elif args.mount:
             ret = proxy.MountRepo(args.mount)
             if not ret:
@@ -1,7 +1,41 @@
 #!/usr/bin/env python3
 import argparse
+import datetime
+import logging
+import sys
 
-from bsrv import Config, Logger, Job, Scheduler, MainLoop, Cache, SESSION_BUS, SYSTEM_BUS
+from bsrv import Config, Logger, Job, Scheduler, MainLoop, Cache, Diagnostics, History, Metrics, Simulation, \
+    SESSION_BUS, SYSTEM_BUS
+from bsrv.logger import log_formatter
+
+
+def simulate(args):
+    try:
+        start, end = [datetime.datetime.fromisoformat(arg) for arg in args.simulate]
+    except ValueError as e:
+        print('Invalid date: {}'.format(str(e)), file=sys.stderr)
+        sys.exit(2)
+
+    # Nothing is written: no log file, cache, history, metrics or DBus. Only configuration errors are logged.
+    Logger.initialize()
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(log_formatter)
+    Logger.addHandler(handler)
+    Logger.setLevel(logging.WARNING)
+    Config.initialize(args.c)
+    Cache.initialize(persistent=False)
+
+    timeline = open(args.timeline, 'w') if args.timeline else None
+    try:
+        simulation = Simulation.from_config(start, end, timeline)
+        simulation.run()
+    except RuntimeError as e:
+        print('Simulation stopped: {}'.format(str(e)), file=sys.stderr)
+        sys.exit(1)
+    finally:
+        if timeline is not None:
+            timeline.close()
+    print(simulation.report())
 
 
 def main():
@@ -11,9 +45,18 @@ def main():
                         help='Path to configuration file.')
     parser.add_argument('--session-bus', action='store_true', default=False,
                         help='Use SESSION_BUS to publish dbus interface. Default is SYSTEM_BUS.')
+    parser.add_argument('--simulate', metavar=('START', 'END'), nargs=2, type=str,
+                        help='Simulate scheduling of the configured jobs between two ISO dates with a virtual clock '
+                             'instead of running the daemon.')
+    parser.add_argument('--timeline', metavar='FILE', type=str,
+                        help='Write the events of the simulation to FILE, tab separated.')
 
     args = parser.parse_args()
 
+    if args.simulate:
+        simulate(args)
+        return
+
     try:
 
         # Initialize primitive logging
@@ -34,6 +77,15 @@ def main():
         # Initialize Cache
         Cache.initialize()
 
+        # Initialize run history
+        History.initialize()
+
+        # Start metrics exporter, if configured
+        Metrics.initialize()
+
+        # Prepare diagnostic dumps on SIGUSR1 or DumpDiagnostics
+        Diagnostics.initialize()
+
         # Extract Jobs from Config
         for s in Config.sections():
             if s[0] == ':':
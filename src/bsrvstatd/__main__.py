@@ -1,11 +1,12 @@
 import argparse
 import datetime
+import math
 import os
 import signal
 import sys
-import threading
 from typing import List, NoReturn, Union
 
+from gi.repository import GLib
 from texttable import Texttable
 
 from bsrv import Logger, Config, Cache, Job, Schedule, ScheduleParseError, Hook
@@ -13,101 +14,118 @@ from bsrv.tools import gen_json
 
 
 class BorgStatService:
+    # Upper bound for a single timer, see Scheduler.max_sleep
+    max_sleep: float = 60.0
+
     def __init__(self, jobs: List[Job], schedule: Schedule):
-        self.running = True
         self.jobs = jobs
         self.schedule = schedule
 
-        self.timer_event = threading.Event()
-        self.timer: Union['threading.Timer', None] = None
+        self.loop = GLib.MainLoop()
+        self.timer_source: Union[int, None] = None
+        self.last_stat: Union[datetime.datetime, None] = None
+        self.next_stat: Union[datetime.datetime, None] = None
 
         self.hook_satisfied = Hook.from_config('stat', 'hook_satisfied')
         self.hook_satisfied.set_parent_description('BorgStatService')
         self.hook_failed = Hook.from_config('stat', 'hook_failed')
         self.hook_failed.set_parent_description('BorgStatService')
 
-        signal.signal(signal.SIGTERM, self.__sigterm_handler)
-
-    def __timer_wakeup(self) -> NoReturn:
-        self.timer_event.set()
+        GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGTERM, self.__sigterm_handler)
 
-    def __sigterm_handler(self, signal_number, frame) -> NoReturn:
+    def __sigterm_handler(self) -> bool:
         Logger.info('Received SIGTERM')
-        self.running = False
-        self.__timer_wakeup()
+        self.loop.quit()
+        return True
+
+    def __arm_timer(self) -> NoReturn:
+        sleep_time = max(0.0, (self.next_stat - datetime.datetime.now()).total_seconds())
+        self.timer_source = GLib.timeout_add(math.ceil(min(sleep_time, self.max_sleep) * 1000), self.__timer_wakeup)
+
+    def __plan_next(self) -> NoReturn:
+        if self.last_stat:
+            self.next_stat = self.schedule.next(self.last_stat)
+        else:
+            self.next_stat = self.schedule.next(datetime.datetime.now())
+
+        Logger.debug('Determined next stat at {}, waiting for {} s.'.format(
+            self.next_stat, max(0.0, (self.next_stat - datetime.datetime.now()).total_seconds())))
+        self.__arm_timer()
+
+    def __timer_wakeup(self) -> bool:
+        self.timer_source = None
+        if datetime.datetime.now() < self.next_stat:
+            self.__arm_timer()
+            return False
+
+        Logger.info('Timer wakeup.')
+        self.stat()
+
+        self.last_stat = datetime.datetime.now()
+        Cache.set('stat_dt', self.last_stat)
+        self.__plan_next()
+        return False
 
     def run(self):
+        self.last_stat = Cache.get('stat_dt')
+        Logger.debug('Loaded last stat datetime: {}'.format(self.last_stat))
+        self.__plan_next()
         try:
-            last_stat = Cache.get('stat_dt')
-            Logger.debug('Loaded last stat datetime: {}'.format(last_stat))
-            while self.running:
-                if last_stat:
-                    next_stat = self.schedule.next(last_stat)
-                else:
-                    next_stat = self.schedule.next(datetime.datetime.now())
-
-                sleep_time = max(0.0, (next_stat - datetime.datetime.now()).total_seconds())
-                Logger.debug(
-                    'Determined next stat at {}, waiting for {} s.'.format(next_stat, sleep_time))
-
-                self.timer = threading.Timer(sleep_time, self.__timer_wakeup)
-                self.timer.start()
-                self.timer_event.wait()
-
-                Logger.info('Timer wakeup.'.format(next_stat))
-                self.timer_event.clear()
-                if not self.running:
-                    Logger.info('Exiting')
-                    return
-
-                now = datetime.datetime.now()
-
-                infos = dict()
-
-                tbl = Texttable()
-                tbl.set_cols_align(['l', 'c', 'l', 'l', 'l'])
-                tbl.set_max_width(80)
-                tbl.header(['Job', 'Status', 'Last', 'Age', 'Max Age'])
-
-                satisfied = True
-
-                for job in self.jobs:
-                    last = job.get_last_archive_datetime(use_cache=False)
-                    age = now - last
-                    infos[job.name] = {}
-                    if last:
-                        if age > job.stat_maxage:
-                            satisfied = False
-                            infos[job.name]['status'] = 'failed'
-                        else:
-                            infos[job.name]['status'] = 'satisfied'
-                    else:
-                        satisfied = False
-                        infos[job.name]['status'] = 'unknown'
-
-                    tbl.add_row([job.name, infos[job.name]['status'], last, age, job.stat_maxage])
-                    infos[job.name]['last'] = last
-                    infos[job.name]['age'] = age.total_seconds()
-                    infos[job.name]['maxage'] = job.stat_maxage.total_seconds()
-
-                tbl_str = tbl.draw()
-                tbl_str = tbl_str.replace(' ', '\u00a0')
-
-                env = os.environ.copy()
-                env['BSRV_INFO_TXT'] = tbl_str.replace('\n', '\\n')
-                env['BSRV_INFO_JSON'] = gen_json(infos)
-                if satisfied:
-                    self.hook_satisfied.trigger(env=env)
-                else:
-                    self.hook_failed.trigger(env=env)
-
-                last_stat = datetime.datetime.now()
-                Cache.set('stat_dt', last_stat)
+            self.loop.run()
         finally:
-            try:
-                self.timer.cancel()
-            except:
-                pass
+            if self.timer_source is not None:
+                GLib.source_remove(self.timer_source)
+        Logger.info('Exiting')
+
+    def stat(self):
+        now = datetime.datetime.now()
+
+        infos = dict()
+
+        tbl = Texttable()
+        tbl.set_cols_align(['l', 'c', 'l', 'l', 'l'])
+        tbl.set_max_width(80)
+        tbl.header(['Job', 'Status', 'Last', 'Age', 'Max Age'])
+
+        satisfied = True
+
+        for job in self.jobs:
+            last = None
+            if Cache.shared():
+                # Recorded by bsrvd after a successful run, the repository is only asked if that is too old
+                last = Cache.get_job(job.name, 'last_dt')
+                if last is not None and now - last > job.stat_maxage:
+                    last = None
+            if last is None:
+                last = job.get_last_archive_datetime(use_cache=False)
+            age = now - last
+            infos[job.name] = {}
+            if last:
+                if age > job.stat_maxage:
+                    satisfied = False
+                    infos[job.name]['status'] = 'failed'
+                else:
+                    infos[job.name]['status'] = 'satisfied'
+            else:
+                satisfied = False
+                infos[job.name]['status'] = 'unknown'
+
+            tbl.add_row([job.name, infos[job.name]['status'], last, age, job.stat_maxage])
+            infos[job.name]['last'] = last
+            infos[job.name]['age'] = age.total_seconds()
+            infos[job.name]['maxage'] = job.stat_maxage.total_seconds()
+            Cache.set_stat(job.name, dict(infos[job.name], checked=now))
+
+        tbl_str = tbl.draw()
+        tbl_str = tbl_str.replace(' ', '\u00a0')
+
+        env = os.environ.copy()
+        env['BSRV_INFO_TXT'] = tbl_str.replace('\n', '\\n')
+        env['BSRV_INFO_JSON'] = gen_json(infos)
+        if satisfied:
+            self.hook_satisfied.trigger(env=env)
+        else:
+            self.hook_failed.trigger(env=env)
 
 
 def main():
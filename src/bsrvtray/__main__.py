@@ -13,7 +13,7 @@ from dasbus.error import DBusError
 from pkg_resources import resource_filename
 
 from bsrv import SYSTEM_BUS, SESSION_BUS, get_dbus_service_identifier
-from bsrv.tools import parse_json, pretty_info
+from bsrv.tools import parse_json, pretty_info, pretty_progress, pretty_size
 
 ASSETS_PATH = '/usr/share/bsrv/assets/'
 
@@ -310,6 +310,8 @@ class MainApp:
 
                 if self.__status_update not in self.proxy.StatusUpdateNotifier._callbacks:
                     self.proxy.StatusUpdateNotifier.connect(self.__status_update)
+                if self.__progress not in self.proxy.ProgressNotifier._callbacks:
+                    self.proxy.ProgressNotifier.connect(self.__progress)
                 if self.__pause not in self.proxy.PauseNotifier._callbacks:
                     self.proxy.PauseNotifier.connect(self.__pause)
                 if self.__callback_info not in self.proxy.JobInfoNotifier._callbacks:
@@ -360,6 +362,18 @@ class MainApp:
             else:
                 self.__store_status(job_name, sched, retry)
 
+    def __progress(self, job_name: str, progress: Dict[str, str]):
+        with QMutexLocker(self.job_mutex):
+            if job_name in self.job_submenu and 'progress_original_size' in progress:
+                text = pretty_progress(progress)
+                if 'progress_percent' in progress:
+                    short = '{}%'.format(progress['progress_percent'])
+                else:
+                    short = pretty_size(int(progress['progress_original_size']))
+                self.job_submenu[job_name].setTitle('Job {} ({})'.format(job_name, short))
+                self.job_submenu[job_name].setToolTip(text)
+                self.tray.setToolTip('Job {}: {}'.format(job_name, text))
+
     def __pause(self, is_paused: bool):
         if is_paused:
             self.status = Status.PAUSE
@@ -367,9 +381,13 @@ class MainApp:
             self.status = Status.OK
 
     def __store_status(self, job_name: str, sched: str, retry: int):
+        if sched != 'running' and self.job_status.get(job_name) == Status.RUNNING:
+            self.job_submenu[job_name].setTitle('Job {}'.format(job_name))
+            self.job_submenu[job_name].setToolTip('')
+            self.tray.setToolTip('')
         if sched == 'running':
             self.job_status[job_name] = Status.RUNNING
-        elif sched == 'next' or sched == 'wait':
+        elif sched == 'next' or sched == 'wait' or sched == 'queued' or sched == 'deferred':
             if retry == 0:
                 self.job_status[job_name] = Status.OK
             elif retry < 0:
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+
+from bsrv import Cache, Config, Logger
+
+Logger.initialize()
+
+CONFIG_HEAD = '''
+[logging]
+target: stdout
+[borg]
+base_dir: {base_dir}
+mount_dir: {base_dir}/mnt
+{borg}
+'''
+
+
+@pytest.fixture
+def config(tmp_path):
+    # Loads the given sections after [logging] and [borg], borg adds keys to [borg]. The cache is not written.
+    def load(text: str = '', borg: str = ''):
+        path = tmp_path / 'bsrvd.conf'
+        path.write_text(CONFIG_HEAD.format(base_dir=tmp_path, borg=borg) + text)
+        Config.initialize(str(path))
+        Cache.initialize(persistent=False)
+
+    return load
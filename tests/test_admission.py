@@ -0,0 +1,98 @@
+import datetime
+from types import SimpleNamespace
+
+from bsrv import Simulation
+from bsrv.admission import CircuitBreaker, SchedulingPolicy
+
+T0 = datetime.datetime(2025, 1, 1, 2, 0)
+
+NIGHTLY_JOB = '''
+[simulate]
+duration: 10m
+success_rate: 0
+[:nightly]
+borg_repo: ssh://backup@host1/nightly
+borg_passphrase: x
+borg_create_args: /home
+borg_prune_args: --keep-last 3
+schedule: 0 2 * * *
+retry_max: 0
+'''
+
+
+def make_job(name: str, host: str = 'host1'):
+    return SimpleNamespace(name=name, borg_repo='ssh://backup@{}/{}'.format(host, name))
+
+
+def test_circuit_opens_after_threshold():
+    breaker = CircuitBreaker(threshold=2, cooldown=datetime.timedelta(minutes=5))
+    job = make_job('a')
+    breaker.record(job, False, T0)
+    assert breaker.blocked_reason(job, T0) is None
+    breaker.record(job, False, T0)
+    assert breaker.blocked_reason(job, T0) is not None
+    assert breaker.blocked_reason(make_job('b', 'host2'), T0) is None
+    breaker.record(job, True, T0)
+    assert breaker.blocked_reason(job, T0) is None
+
+
+def test_canary_backoff():
+    breaker = CircuitBreaker(threshold=1, cooldown=datetime.timedelta(minutes=5),
+                             cooldown_max=datetime.timedelta(minutes=15))
+    canary, other = make_job('a'), make_job('b')
+    breaker.record(canary, False, T0)
+    probe = T0 + datetime.timedelta(minutes=5)
+    assert breaker.blocked_reason(canary, probe) is None
+    breaker.acquire(canary)
+    assert breaker.circuits['host1']['canary'] == 'a'
+    assert 'canary' in breaker.blocked_reason(other, probe)
+    breaker.record(canary, False, probe)
+    assert breaker.circuits['host1']['probe_dt'] == probe + datetime.timedelta(minutes=10)
+    assert breaker.backoff(5) == datetime.timedelta(minutes=15)
+
+
+def test_next_probe_dt_only_in_future():
+    breaker = CircuitBreaker(threshold=1, cooldown=datetime.timedelta(minutes=5))
+    breaker.record(make_job('a'), False, T0)
+    probe = T0 + datetime.timedelta(minutes=5)
+    assert breaker.next_probe_dt(T0) == probe
+    # Past probe times would arm a 0 ms wakeup on every evaluation
+    assert breaker.next_probe_dt(probe) is None
+    assert breaker.next_probe_dt(probe + datetime.timedelta(hours=1)) is None
+
+
+def test_open_circuit_does_not_spin(config):
+    # The nightly job gives up and opens the circuit of its host, after the cooldown nothing is due until the next
+    # night. Each evaluation must not arm another wakeup at the same time.
+    config(NIGHTLY_JOB, borg='circuit_breaker_failures: 1')
+    start = datetime.datetime(2025, 1, 1)
+    simulation = Simulation.from_config(start, start + datetime.timedelta(days=4))
+    simulation.run()
+    assert simulation.jobs[':nightly']['failed'] > 0
+    assert simulation.scheduler.breaker.circuits
+    # About one wakeup per job start and max_sleep
+    assert next(simulation.clock.counter) < 1000
+
+
+def test_edf_order_with_priority_and_aging():
+    policy = SchedulingPolicy(SchedulingPolicy.EDF, aging=datetime.timedelta(hours=1))
+    maxage = datetime.timedelta(hours=24)
+
+    class QueuedJob:
+        # Hashable, the policy maps jobs to their queue times
+        def __init__(self, name: str, last_hours_ago: float, priority: int = 0):
+            self.name = name
+            self.priority = priority
+            self.stat_maxage = maxage
+            self.last_archive_date = T0 - datetime.timedelta(hours=last_hours_ago)
+
+    job = QueuedJob
+
+    urgent, high, low = job('urgent', 23), job('high', 10, priority=2), job('low', 11)
+    queued = {urgent: T0, high: T0, low: T0}
+    # A priority of 2 moves the deadline of high 2 h earlier, before low but not before urgent
+    assert policy.order([low, high, urgent], queued, T0) == [urgent, high, low]
+    # Waiting ages low, 5 h of waiting beat the head start of high
+    queued[low] = T0 - datetime.timedelta(hours=5)
+    assert policy.order([low, high, urgent], queued, T0) == [urgent, low, high]
+    assert policy.describe(high, T0, T0)['schedule_deadline'] == (T0 + datetime.timedelta(hours=12)).isoformat()
@@ -0,0 +1,67 @@
+import datetime
+
+import pytest
+
+from bsrv.cache import JsonCacheBackend, SqliteCacheBackend
+from bsrv.catalog import Archive
+
+DT = datetime.datetime(2025, 1, 2, 3, 4, 5, 678901)
+
+
+def archive(name: str, day: int) -> Archive:
+    dt = datetime.datetime(2025, 1, day, 12)
+    return Archive(name, name * 4, dt, dt + datetime.timedelta(minutes=5))
+
+
+@pytest.fixture(params=['json', 'sqlite'])
+def backend(request, tmp_path):
+    def open_backend():
+        if request.param == 'json':
+            return JsonCacheBackend(str(tmp_path / 'bsrvd.cache'))
+        return SqliteCacheBackend(str(tmp_path / 'bsrv.state.sqlite'))
+
+    return open_backend
+
+
+def test_roundtrip(backend):
+    cache = backend()
+    cache.set('stat_dt', DT)
+    cache.set('name_dt_like', '2025-01-01T00:00:00')
+    cache.set('counts', {'a': 1})
+    cache.set_job(':a', 'last_dt', DT)
+    cache.set_job(':a', 'last_size', 1234)
+    cache.set_job(':a', 'repo_state', 'index.12 2048 1')
+    cache.update_archives(':a', [archive('a1', 1), archive('a2', 2), archive('a3', 3)], [])
+    cache.update_archives(':a', [archive('a4', 4)], ['a2'])
+    cache.flush()
+
+    # A new instance reads what the previous one wrote
+    for cache in [cache, backend()]:
+        assert cache.get('stat_dt') == DT
+        # Only keys ending in _dt hold datetimes
+        assert cache.get('name_dt_like') == '2025-01-01T00:00:00'
+        assert cache.get('counts') == {'a': 1}
+        assert cache.get('unknown') is None
+        assert cache.get_job(':a', 'last_dt') == DT
+        assert cache.get_job(':a', 'last_size') == 1234
+        assert cache.get_job(':a', 'repo_state') == 'index.12 2048 1'
+        assert cache.get_job(':b', 'last_dt') is None
+        archives = sorted(cache.get_archives(':a'), key=lambda a: a.time)
+        assert [(a.name, a.id, a.start, a.time) for a in archives] == [
+            (a.name, a.id, a.start, a.time) for a in [archive('a1', 1), archive('a3', 3), archive('a4', 4)]]
+        assert cache.get_archives(':b') == []
+
+
+def test_replace_archives(backend):
+    cache = backend()
+    cache.update_archives(':a', [archive('a1', 1), archive('a2', 2)], [])
+    cache.update_archives(':a', [archive('b1', 5)], [], replace=True)
+    assert [a.name for a in cache.get_archives(':a')] == ['b1']
+
+
+def test_corrupt_json_cache(tmp_path):
+    path = tmp_path / 'bsrvd.cache'
+    path.write_text('[1, 2')
+    cache = JsonCacheBackend(str(path))
+    assert cache.data == {}
+    assert (tmp_path / 'bsrvd.cache.corrupt').read_text() == '[1, 2'
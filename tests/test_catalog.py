@@ -0,0 +1,110 @@
+import datetime
+import json
+
+from bsrv import Cache, Config, Logger
+from bsrv.catalog import Archive, ArchiveCatalog
+from bsrv.job import Job
+
+JOB = '''
+[:a]
+borg_repo: {repo}
+borg_passphrase: x
+borg_create_args: /a
+borg_prune_args: --keep-last 3
+schedule: @every 1d
+'''
+
+
+def archive(name: str, day: int) -> dict:
+    dt = '2025-01-{:02d}T00:00:00.000000'.format(day)
+    return {'name': name, 'archive': name, 'barchive': name, 'id': name * 8, 'start': dt, 'time': dt}
+
+
+def at(day: int) -> Archive:
+    dt = datetime.datetime(2025, 1, day)
+    return Archive('a{}'.format(day), None, dt, dt)
+
+
+def names(catalog: ArchiveCatalog):
+    return [a.name for a in catalog.archives]
+
+
+def test_catalog_order():
+    catalog = ArchiveCatalog([at(3), at(1)])
+    catalog.add(at(2))
+    catalog.add(at(4))
+    assert names(catalog) == ['a1', 'a2', 'a3', 'a4']
+    assert catalog.latest.name == 'a4'
+    assert catalog.remove(['a2', 'unknown']) == ['a2']
+    assert names(catalog) == ['a1', 'a3', 'a4']
+    assert catalog.times == [a.time for a in catalog.archives]
+
+
+def test_merge_newest():
+    catalog = ArchiveCatalog(at(day) for day in range(1, 8))
+    # a6 was pruned and a8, a9 were created, older archives than the listed ones are kept
+    added, deleted = catalog.merge_newest([at(4), at(5), at(7), at(8), at(9)])
+    assert [a.name for a in added] == ['a8', 'a9']
+    assert deleted == ['a6']
+    assert names(catalog) == ['a1', 'a2', 'a3', 'a4', 'a5', 'a7', 'a8', 'a9']
+
+
+def test_merge_newest_needs_full_listing():
+    catalog = ArchiveCatalog(at(day) for day in range(1, 4))
+    # None of the listed archives is known, archives between them and the catalog may be missing
+    assert catalog.merge_newest([at(10), at(11)]) is None
+    assert catalog.merge_newest([]) is None
+    assert names(catalog) == ['a1', 'a2', 'a3']
+
+
+def fake_borg(tmp_path) -> str:
+    # borg list prints list.json and counts its calls in list.log
+    path = tmp_path / 'borg'
+    path.write_text('#!/bin/sh\necho "$@" >> {0}/list.log\ncat {0}/list.json\n'.format(tmp_path))
+    path.chmod(0o755)
+    return str(path)
+
+
+def commit(tmp_path, transaction: int, archives: list):
+    # A new transaction of the local repository, as seen by the probe
+    (tmp_path / 'repo' / 'index.{}'.format(transaction)).write_text(str(transaction))
+    (tmp_path / 'list.json').write_text(json.dumps({'archives': archives}))
+
+
+def borg_list_calls(tmp_path) -> int:
+    return len((tmp_path / 'list.log').read_text().splitlines())
+
+
+def test_shared_cache_catalog_listed_by_other_daemon(config, tmp_path):
+    (tmp_path / 'repo').mkdir()
+    config(JOB.format(repo=tmp_path / 'repo'), borg='cache_backend: sqlite\nbinary: {}'.format(fake_borg(tmp_path)))
+    Cache.initialize()
+    # bsrvd and bsrvstatd, each with its own catalog in memory
+    bsrvd, bsrvstatd = Job.from_bsrvd_config(':a'), Job.from_bsrvd_config(':a')
+
+    commit(tmp_path, 1, [archive('a1', 1)])
+    assert [a.name for a in bsrvd.refresh_catalog().archives] == ['a1']
+    assert borg_list_calls(tmp_path) == 1
+
+    commit(tmp_path, 2, [archive('a1', 1), archive('a2', 2)])
+    assert [a.name for a in bsrvstatd.refresh_catalog().archives] == ['a1', 'a2']
+    assert borg_list_calls(tmp_path) == 2
+
+    # The repository state matches the stored one, the catalog comes from the store instead of borg list
+    assert [a.name for a in bsrvd.refresh_catalog().archives] == ['a1', 'a2']
+    assert borg_list_calls(tmp_path) == 2
+
+
+def test_changed_archive_template_warns(config, tmp_path, monkeypatch):
+    warnings = []
+    monkeypatch.setattr(Logger, 'warning', lambda msg, *args: warnings.append(msg))
+    config(JOB.format(repo=tmp_path) + 'borg_archive_name_template: host1-%Y-%m-%d\n')
+    assert Job.from_bsrvd_config(':a').borg_archive_glob == 'host1-*-*-*'
+    assert Job.from_bsrvd_config(':a') and not warnings
+
+    # Reload only the config, the cache keeps the glob of the previous start
+    (tmp_path / 'bsrvd.conf').write_text((tmp_path / 'bsrvd.conf').read_text().replace('host1-', 'host2-'))
+    Config.initialize(str(tmp_path / 'bsrvd.conf'))
+    Job.from_bsrvd_config(':a')
+    assert len(warnings) == 1 and '"host1-*-*-*" to "host2-*-*-*"' in warnings[0]
+    assert Cache.get_job(':a', 'archive_glob') == 'host2-*-*-*'
@@ -0,0 +1,57 @@
+import concurrent.futures
+import threading
+from types import SimpleNamespace
+
+from dasbus.error import ErrorMapper
+from gi.repository import GLib
+
+from bsrv.dbus import AsyncServerObjectHandler, run_in_pool
+
+
+def run_loop(future: 'concurrent.futures.Future'):
+    loop = GLib.MainLoop()
+    future.add_done_callback(lambda _: GLib.idle_add(loop.quit))
+    GLib.timeout_add_seconds(5, loop.quit)
+    loop.run()
+
+
+def test_run_in_pool_finishes_on_main_loop():
+    threads = []
+
+    def work():
+        threads.append(threading.get_ident())
+        return 2
+
+    def finish(result):
+        threads.append(threading.get_ident())
+        return result * 3
+
+    future = run_in_pool(work, finish)
+    run_loop(future)
+    assert future.result() == 6
+    assert threads[0] != threading.get_ident()
+    assert threads[1] == threading.get_ident()
+
+
+def test_async_reply():
+    replies = []
+    handler = AsyncServerObjectHandler.__new__(AsyncServerObjectHandler)
+    handler._error_mapper = ErrorMapper()
+    handler._server = SimpleNamespace(
+        set_call_reply=lambda invocation, out_type, value: replies.append((invocation, value)),
+        set_call_error=lambda invocation, name, message: replies.append((invocation, 'error ' + message)))
+    method_spec = SimpleNamespace(name='Method', interface_name='de.alxg.bsrvd', out_type='s')
+
+    handler._handle_method_result('sync', method_spec, 'now')
+    failed = run_in_pool(lambda: 1 / 0)
+    handler._handle_method_result('failed', method_spec, failed)
+    done = run_in_pool(lambda: 'later')
+    handler._handle_method_result('async', method_spec, done)
+    assert replies == [('sync', 'now')]
+    run_loop(done)
+    run_loop(failed)
+    # The reply is sent in an idle callback after the future is done
+    context = GLib.MainContext.default()
+    while context.pending():
+        context.iteration(False)
+    assert sorted(replies) == [('async', 'later'), ('failed', 'error division by zero'), ('sync', 'now')]
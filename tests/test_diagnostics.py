@@ -0,0 +1,17 @@
+import datetime
+from types import SimpleNamespace
+
+from bsrv import Diagnostics
+from bsrv.clock import VirtualClock
+from bsrv.job import Scheduler
+
+
+def test_scheduler_section_with_probing_circuit(config):
+    config(borg='circuit_breaker_failures: 1')
+    now = datetime.datetime(2025, 1, 1)
+    scheduler = Scheduler(clock=VirtualClock(now))
+    job = SimpleNamespace(name=':a', borg_repo='ssh://backup@host1/a')
+    scheduler.breaker.record(job, False, now)
+    scheduler.breaker.acquire(job)
+    lines = Diagnostics._Diagnostics__scheduler(scheduler)
+    assert any('circuit open for host1' in line and 'canary :a' in line for line in lines)
@@ -0,0 +1,99 @@
+import concurrent.futures
+import http.client
+import socket
+import threading
+import time
+
+import pytest
+
+from bsrv.metrics import Metrics, MetricsRequestHandler, UnixHTTPServer, timed
+
+
+@pytest.fixture
+def metrics(monkeypatch):
+    for name in ['values', 'counters', 'histograms', 'rendered']:
+        monkeypatch.setattr(Metrics, name, {})
+    Metrics.set('bsrv_scheduler_jobs', 2)
+    Metrics.inc('bsrv_scheduler_wakeups', reason='timer')
+    Metrics.observe('bsrv_hook_seconds', 0.5, hook='h')
+    return Metrics
+
+
+def test_prometheus_text_format(metrics):
+    text = metrics.render()
+    assert '# TYPE bsrv_scheduler_jobs gauge\nbsrv_scheduler_jobs 2\n' in text
+    # The textfile collector needs the name of the counter samples in # TYPE and no # EOF
+    assert '# TYPE bsrv_scheduler_wakeups_total counter\nbsrv_scheduler_wakeups_total{reason="timer"} 1\n' in text
+    assert 'bsrv_hook_seconds_bucket{hook="h",le="+Inf"} 1\n' in text
+    assert '# EOF' not in text
+
+
+def test_openmetrics_format(metrics):
+    text = metrics.render(openmetrics=True)
+    assert '# TYPE bsrv_scheduler_wakeups counter\nbsrv_scheduler_wakeups_total{reason="timer"} 1\n' in text
+    assert text.endswith('# EOF\n')
+    # Both renderings are cached separately
+    assert '# EOF' not in metrics.render()
+
+
+def test_http_negotiation(metrics, tmp_path):
+    path = str(tmp_path / 'metrics.sock')
+    server = UnixHTTPServer(path, MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        for accept, content_type in [('*/*', 'text/plain'),
+                                     ('application/openmetrics-text; version=1.0.0', 'application/openmetrics-text')]:
+            connection = http.client.HTTPConnection('localhost')
+            connection.sock = socket.socket(socket.AF_UNIX)
+            connection.sock.connect(path)
+            connection.request('GET', '/metrics', headers={'Accept': accept})
+            response = connection.getresponse()
+            assert response.getheader('Content-Type').startswith(content_type)
+            assert response.read().decode().endswith('# EOF\n') == (content_type != 'text/plain')
+            connection.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def has_ipv6_loopback() -> bool:
+    try:
+        with socket.socket(socket.AF_INET6) as s:
+            s.bind(('::1', 0))
+    except OSError:
+        return False
+    return True
+
+
+@pytest.mark.skipif(not has_ipv6_loopback(), reason='No IPv6 loopback address')
+def test_listen_ipv6(metrics, config, monkeypatch):
+    for name in ['server', 'textfile', 'enabled']:
+        monkeypatch.setattr(Metrics, name, getattr(Metrics, name))
+    config('[metrics]\nlisten: [::1]:0\n')
+    Metrics.initialize()
+    assert Metrics.server is not None
+    try:
+        assert Metrics.server.address_family == socket.AF_INET6
+        connection = http.client.HTTPConnection('::1', Metrics.server.server_address[1], timeout=5)
+        connection.request('GET', '/metrics')
+        assert 'bsrv_scheduler_jobs 2' in connection.getresponse().read().decode()
+        connection.close()
+    finally:
+        Metrics.server.shutdown()
+        Metrics.server.server_close()
+
+
+def test_timed_future(metrics):
+    future = concurrent.futures.Future()
+
+    @timed('bsrv_dbus_method_seconds', 'method')
+    def Method():
+        return future
+
+    assert Method() is future
+    assert 'bsrv_dbus_method_seconds' not in metrics.histograms
+    time.sleep(0.05)
+    future.set_result('done')
+    histogram = metrics.histograms['bsrv_dbus_method_seconds'][(('method', 'Method'),)]
+    assert histogram.count == 1
+    assert histogram.sum >= 0.05
@@ -0,0 +1,30 @@
+from bsrv.job import Job
+
+JOB = '''
+[:a]
+borg_repo: /srv/repo
+borg_passphrase: x
+borg_create_args: /a
+borg_prune_args: --keep-last 3
+schedule: @every 1d
+{limits}
+'''
+
+
+def test_pressure_limits_from_config(config):
+    config(JOB.format(limits='pressure_io_max: 40\nloadavg_max: 4.5'), borg='pressure_cpu_max: 80')
+    job = Job.from_bsrvd_config(':a')
+    assert job.runnable
+    assert job.pressure_limits.enabled
+    assert job.pressure_limits.psi_max == {'cpu': 80.0, 'io': 40.0, 'memory': None}
+    assert job.pressure_limits.loadavg_max == 4.5
+
+
+def test_malformed_pressure_limit_is_not_runnable(config):
+    config(JOB.format(limits='pressure_memory_max: 40%'))
+    job = Job.from_bsrvd_config(':a')
+    assert not job.runnable
+    assert not job.pressure_limits.enabled
+
+    config(JOB.format(limits=''), borg='loadavg_max: high')
+    assert not Job.from_bsrvd_config(':a').runnable
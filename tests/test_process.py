@@ -0,0 +1,49 @@
+import os
+import signal
+import subprocess
+
+from gi.repository import GLib
+
+from bsrv.demote import DemotionSubprocess
+from bsrv.process import ChildProcess, exitcode, run_sync
+
+
+def test_exitcode():
+    assert exitcode(0) == 0
+    assert exitcode(3 << 8) == 3
+    assert exitcode(signal.SIGKILL) == -signal.SIGKILL
+
+
+def test_run_sync_returncode():
+    demotion = DemotionSubprocess(None, 'test')
+    env = os.environ.copy()
+    returncode, stdout, stderr = run_sync(demotion, ['sh', '-c', 'echo out; echo err >&2; exit 3'], env)
+    assert (returncode, stdout, stderr) == (3, 'out\n', ['err'])
+    returncode, _, _ = run_sync(demotion, ['sh', '-c', 'kill -9 $$'], env)
+    assert returncode == -signal.SIGKILL
+
+
+class RecordingDemotion(DemotionSubprocess):
+    def __init__(self):
+        super().__init__(None, 'test')
+        self.kwargs = []
+
+    def Popen(self, args, **kwargs):
+        self.kwargs.append(kwargs)
+        return super().Popen(args, **kwargs)
+
+
+def test_children_do_not_inherit_stdin():
+    # Children must not read the stdin of the daemon, e.g. a terminal
+    demotion = RecordingDemotion()
+    loop = GLib.MainLoop()
+    finished = []
+    p = ChildProcess(demotion, ['sh', '-c', 'cat; echo end'], os.environ.copy(),
+                     on_exit=lambda child: (finished.append(child), loop.quit()))
+    assert p.start()
+    GLib.timeout_add_seconds(5, loop.quit)
+    loop.run()
+    assert finished and finished[0].returncode == 0
+    assert list(finished[0].output) == ['end']
+    run_sync(demotion, ['true'], os.environ.copy())
+    assert [kwargs['stdin'] for kwargs in demotion.kwargs] == [subprocess.DEVNULL] * 2
@@ -0,0 +1,92 @@
+import os
+import time
+
+from bsrv.demote import DemotionSubprocess
+from bsrv.job import Job
+from bsrv.repository import PROBE_UNREACHABLE, PROBE_UNSUPPORTED, parse_location, probe_local, probe_ssh, \
+    remote_path
+
+LS_OUTPUT = '''-rw------- 1 1000 1000 1024 Jan  1 00:00 index.9
+-rw------- 1 1000 1000 2048 Jan  2 00:00 index.12
+'''
+
+
+def fake_ssh(tmp_path, script: str) -> str:
+    # Stands in for borg_rsh, ignores the options, the destination and the command
+    path = tmp_path / 'ssh'
+    path.write_text('#!/bin/sh\n' + script + '\n')
+    path.chmod(0o755)
+    return str(path)
+
+
+def probe(rsh: str, timeout: float = 5):
+    return probe_ssh(DemotionSubprocess(None, 'test'), rsh, 'backup@host', None, '/./repo', os.environ.copy(), timeout)
+
+
+def test_parse_location():
+    assert parse_location('ssh://backup@host:2222/./repo') == ('backup@host', '2222', '/./repo')
+    assert parse_location('backup@host:repo') == ('backup@host', None, 'repo')
+    assert parse_location('file:///srv/repo') == (None, None, '/srv/repo')
+    assert parse_location('/srv/repo') == (None, None, '/srv/repo')
+    assert remote_path('/./my repo') == "'./my repo'"
+    assert remote_path('/~/repo') == '~/repo'
+
+
+def test_probe_local(tmp_path):
+    assert probe_local(str(tmp_path)) is None
+    (tmp_path / 'index.9').write_bytes(b'x')
+    (tmp_path / 'index.12').write_bytes(b'xy')
+    assert probe_local(str(tmp_path)).startswith('index.12 2 ')
+
+
+def test_probe_ssh(tmp_path):
+    rsh = fake_ssh(tmp_path, "cat <<'EOF'\n" + LS_OUTPUT + "EOF")
+    assert probe(rsh) == ('-rw------- 1 1000 1000 2048 Jan 2 00:00 index.12', None)
+
+
+def test_probe_ssh_forced_borg_serve(tmp_path):
+    # borg serve reads its commands from stdin and only exits at its end
+    assert probe(fake_ssh(tmp_path, 'cat > /dev/null; exit 2')) == (None, PROBE_UNSUPPORTED)
+    assert probe(fake_ssh(tmp_path, 'cat > /dev/null')) == (None, PROBE_UNSUPPORTED)
+
+
+def test_probe_ssh_timeout(tmp_path):
+    started = time.monotonic()
+    assert probe(fake_ssh(tmp_path, 'exec sleep 30'), timeout=0.5) == (None, PROBE_UNREACHABLE)
+    assert time.monotonic() - started < 5
+    # ssh itself failed, e.g. the connection was refused
+    assert probe(fake_ssh(tmp_path, 'exit 255')) == (None, PROBE_UNREACHABLE)
+
+
+JOB = '''
+[:a]
+borg_repo: ssh://backup@host/./repo
+borg_rsh: {rsh}
+borg_passphrase: x
+borg_create_args: /a
+borg_prune_args: --keep-last 3
+schedule: @every 1d
+'''
+
+
+def test_unreachable_host_is_probed_again(config, tmp_path):
+    rsh = fake_ssh(tmp_path, 'exit 255')
+    config(JOB.format(rsh=rsh))
+    job = Job.from_bsrvd_config(':a')
+    assert job.probe_repository() is None
+    assert not job.probe_failed
+    assert job.probe_retry_at - time.monotonic() > Job.probe_retry_delay - 5
+    # Not before the backoff has passed
+    fake_ssh(tmp_path, "echo '-rw------- 1 1000 1000 2048 Jan  2 00:00 index.12'")
+    assert job.probe_repository() is None
+    job.probe_retry_at = time.monotonic()
+    assert job.probe_repository().endswith('index.12')
+    assert job.probe_retries == 0
+
+
+def test_unsupported_probe_is_not_tried_again(config, tmp_path):
+    rsh = fake_ssh(tmp_path, 'exit 1')
+    config(JOB.format(rsh=rsh))
+    job = Job.from_bsrvd_config(':a')
+    assert job.probe_repository() is None
+    assert job.probe_failed
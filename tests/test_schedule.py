@@ -0,0 +1,86 @@
+import datetime
+
+import pytest
+
+from bsrv import Schedule, ScheduleParseError
+
+START = datetime.datetime(2025, 1, 1)
+
+
+def day_matches(schedule: Schedule, day: 'datetime.date') -> bool:
+    # Plain cron semantics on the resolved fields, a restricted day of month and day of week are combined
+    crontab = schedule.crontab
+    wdays = {0 if v == 7 else v for v in crontab['wday']}
+    mday_restricted = set(crontab['mday']) != set(range(1, 32))
+    wday_restricted = wdays != set(range(7))
+    mday_match = day.day in crontab['mday']
+    wday_match = (day.weekday() + 1) % 7 in wdays
+    if mday_restricted and wday_restricted:
+        return day.month in crontab['month'] and (mday_match or wday_match)
+    return day.month in crontab['month'] and mday_match and wday_match
+
+
+def brute_force(schedule: Schedule, start: 'datetime.datetime', n: int):
+    day = start.date()
+    while True:
+        if day_matches(schedule, day):
+            for hour in sorted(schedule.crontab['hour']):
+                for minute in sorted(schedule.crontab['min']):
+                    dt = datetime.datetime(day.year, day.month, day.day, hour, minute)
+                    if dt > start:
+                        yield dt
+                        n -= 1
+                        if n == 0:
+                            return
+        day += datetime.timedelta(days=1)
+
+
+@pytest.mark.parametrize('txt', ['*/15 * * * *', '0 2 * * *', '30 4 1,15 * 5', '0 0 * * 0', '0 0 * * 7',
+                                 '5 */6 1-7 */2 *', 'H H * * *', 'H/20 H(8-17) * * 1-5', '0 0 29 2 *', '59 23 31 * *'])
+def test_next_matches_brute_force(txt):
+    schedule = Schedule(txt, seed='host:job')
+    assert list(schedule.upcoming(50, START)) == list(brute_force(schedule, START, 50))
+
+
+def test_next():
+    daily = Schedule('0 2 * * *')
+    assert daily.next(datetime.datetime(2025, 1, 1, 1, 0)) == datetime.datetime(2025, 1, 1, 2, 0)
+    assert daily.next(datetime.datetime(2025, 1, 1, 2, 0)) == datetime.datetime(2025, 1, 2, 2, 0)
+    assert daily.next(datetime.datetime(2025, 12, 31, 2, 0, 30)) == datetime.datetime(2026, 1, 1, 2, 0)
+    assert Schedule('0 0 29 2 *').next(datetime.datetime(2025, 3, 1)) == datetime.datetime(2028, 2, 29)
+    # February 30th never occurs
+    assert Schedule('0 0 30 2 *').next(START) is None
+    assert Schedule('@every 1d 2h').next(START) == START + datetime.timedelta(days=1, hours=2)
+    assert Schedule('@weekly').next(START) == START + datetime.timedelta(weeks=1)
+
+
+def test_hash_fields():
+    schedule = Schedule('H H(8-17) * * *', seed='host1:job')
+    minute, hour = schedule.crontab['min'], schedule.crontab['hour']
+    assert len(minute) == 1 and 0 <= minute[0] <= 59
+    assert len(hour) == 1 and 8 <= hour[0] <= 17
+    # Stable for the same seed, spread over different seeds
+    assert Schedule('H H(8-17) * * *', seed='host1:job').crontab == schedule.crontab
+    assert len({tuple(Schedule('H * * * *', seed='job{}'.format(k)).crontab['min']) for k in range(20)}) > 5
+    # H in day of month only picks days every month has
+    assert all(1 <= Schedule('0 0 H * *', seed=str(k)).crontab['mday'][0] <= 28 for k in range(50))
+    steps = Schedule('H/15 * * * *', seed='host1:job').crontab['min']
+    assert len(steps) == 4 and steps[0] < 15 and all(b - a == 15 for a, b in zip(steps, steps[1:]))
+
+
+def test_spread():
+    spread = datetime.timedelta(minutes=30)
+    offsets = set()
+    for k in range(20):
+        schedule = Schedule('0 2 * * *', seed='job{}'.format(k), spread=spread)
+        next_dt = schedule.next(START)
+        assert datetime.datetime(2025, 1, 1, 2, 0) <= next_dt < datetime.datetime(2025, 1, 1, 2, 30)
+        assert schedule.next(next_dt) == next_dt + datetime.timedelta(days=1)
+        offsets.add(next_dt)
+    assert len(offsets) > 1
+
+
+@pytest.mark.parametrize('txt', ['', '60 * * * *', '* * 0 * *', '* * * 13 *', 'H(5-70) * * * *', '* * *', '@monthly'])
+def test_invalid(txt):
+    with pytest.raises(ScheduleParseError):
+        Schedule(txt)
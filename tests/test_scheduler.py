@@ -0,0 +1,110 @@
+import datetime
+import random
+
+from bsrv import Simulation
+from bsrv.job import SchedulerQueue
+
+START = datetime.datetime(2025, 1, 1)
+
+ONCE_JOBS = '''
+[simulate]
+duration: 10m
+[:a]
+borg_repo: ssh://backup@host1/a
+borg_passphrase: x
+borg_create_args: /a
+borg_prune_args: --keep-last 3
+schedule: 0 2 * * *
+[:b]
+borg_repo: ssh://backup@host2/b
+borg_passphrase: x
+borg_create_args: /b
+borg_prune_args: --keep-last 3
+schedule: 0 2 * * *
+'''
+
+
+def test_finished_job_without_next_occurrence_launches_queued(config):
+    # Both jobs are due at once, one has to wait for the other. Neither has another occurrence, so finishing the first
+    # does not put anything into the queue.
+    config(ONCE_JOBS, borg='max_concurrent: 1')
+    simulation = Simulation.from_config(START, START + datetime.timedelta(days=1))
+    for stats in simulation.jobs.values():
+        stats['job'].get_next_archive_datetime = lambda last=None: None
+    simulation.run()
+    assert simulation.peak_queued[0] == 1
+    assert [stats['runs'] for stats in simulation.jobs.values()] == [1, 1]
+
+
+def test_queue_order_and_grouping():
+    queue = SchedulerQueue()
+    t1, t2 = START + datetime.timedelta(hours=1), START + datetime.timedelta(hours=2)
+    for elem, dt in [('c', t2), ('a', t1), ('b', t1)]:
+        queue.put(elem, dt)
+    assert len(queue) == 3
+    assert queue.when('c') == t2
+    assert queue.next_dt() == t1
+    # Equal times are returned together, in insertion order
+    assert queue.peek_next_action() == (t1, ['a', 'b'])
+    assert queue.get_next_action() == (t1, ['a', 'b'])
+    assert queue.when('a') is None
+    assert queue.get_next_action() == (t2, ['c'])
+    assert queue.get_next_action() == (None, [])
+
+
+def test_queue_lazy_deletion():
+    queue = SchedulerQueue()
+    hook_calls = []
+    queue.set_update_hook(lambda: hook_calls.append(1))
+    for k in range(10):
+        queue.put(k, START + datetime.timedelta(minutes=k), hook_enabled=False)
+    assert queue.delete(0)
+    assert not queue.delete(0)
+    assert queue.move(1, START + datetime.timedelta(hours=1))
+    assert not queue.move('unknown', START)
+    assert hook_calls == [1, 1]
+    assert len(queue) == 9
+    assert queue.next_dt() == START + datetime.timedelta(minutes=2)
+    # Dead entries are dropped once they are the majority
+    for k in range(2, 9):
+        queue.delete(k, hook_enabled=False)
+    assert len(queue) == 2
+    assert len(queue.heap) < 10
+    assert list(queue.get_waiting().values()) == [[9], [1]]
+
+
+def test_queue_matches_sorted_list():
+    # Random operations against a plain dict of the earliest time per element
+    rnd = random.Random(0)
+    queue = SchedulerQueue()
+    model = {}
+    for _ in range(2000):
+        elem = rnd.randrange(20)
+        dt = START + datetime.timedelta(minutes=rnd.randrange(50))
+        op = rnd.random()
+        if op < 0.4:
+            queue.put(elem, dt, hook_enabled=False)
+            model.setdefault(elem, []).append(dt)
+        elif op < 0.6:
+            assert queue.delete(elem, hook_enabled=False) == (elem in model)
+            if elem in model:
+                model[elem].remove(min(model[elem]))
+                if not model[elem]:
+                    del model[elem]
+        elif op < 0.8:
+            assert queue.move(elem, dt, hook_enabled=False) == (elem in model)
+            if elem in model:
+                model[elem].remove(min(model[elem]))
+                model[elem].append(dt)
+        else:
+            expected_dt = min((min(dts) for dts in model.values()), default=None)
+            due_dt, items = queue.get_next_action()
+            assert due_dt == expected_dt
+            for item in items:
+                model[item].remove(due_dt)
+                if not model[item]:
+                    del model[item]
+            assert all(min(dts) > due_dt for dts in model.values()) if due_dt else not model
+        assert len(queue) == sum(len(dts) for dts in model.values())
+        for elem, dts in model.items():
+            assert queue.when(elem) == min(dts)
@@ -0,0 +1,93 @@
+import datetime
+
+import pytest
+
+from bsrv import Simulation
+from bsrv.clock import VirtualClock
+
+START = datetime.datetime(2025, 1, 1)
+
+JOBS = '''
+[simulate]
+duration: 10m-2h
+success_rate: 0.7
+seed: 1
+[:home]
+borg_repo: ssh://backup@host1/home
+borg_passphrase: x
+borg_create_args: /home
+borg_prune_args: --keep-last 3
+schedule: 0 * * * *
+retry_delay: 300
+retry_max: 2
+stat_maxage: 2h
+[:etc]
+borg_repo: ssh://backup@host2/etc
+borg_passphrase: x
+borg_create_args: /etc
+borg_prune_args: --keep-last 3
+schedule: @every 1d
+retry_delay: 600
+retry_max: 3
+simulate_duration: 5m
+[:media]
+borg_repo: ssh://backup@host1/media
+borg_passphrase: x
+borg_create_args: /media
+borg_prune_args: --keep-last 3
+schedule: 30 2 * * *
+retry_delay: 1800
+simulate_duration: 3h-8h
+simulate_success_rate: 0.5
+'''
+
+
+def test_virtual_clock_order():
+    clock = VirtualClock(START)
+    calls = []
+    clock.timeout_add(2000, lambda: calls.append(('b', clock.now())))
+    clock.idle_add(lambda: calls.append(('a', clock.now())))
+    removed = clock.timeout_add(1000, lambda: calls.append(('removed', clock.now())))
+    clock.source_remove(removed)
+    clock.run_until(START + datetime.timedelta(seconds=1))
+    assert calls == [('a', START)]
+    clock.run_until(START + datetime.timedelta(seconds=10))
+    assert calls[1] == ('b', START + datetime.timedelta(seconds=2))
+    assert clock.now() == START + datetime.timedelta(seconds=10)
+
+
+def test_virtual_clock_detects_busy_loop():
+    clock = VirtualClock(START)
+    clock.max_sources_per_instant = 100
+
+    def rearm():
+        clock.timeout_add(0, rearm)
+        return False
+
+    clock.idle_add(rearm)
+    with pytest.raises(RuntimeError):
+        clock.run_until(START + datetime.timedelta(days=1))
+
+
+def test_simulation_with_failures(config):
+    # Failures open circuits of the shared host, jobs queue behind each other with max_concurrent
+    config(JOBS, borg='max_concurrent: 1\ncircuit_breaker_failures: 2')
+    simulation = Simulation.from_config(START, START + datetime.timedelta(days=90))
+    simulation.run()
+    stats = simulation.jobs
+    assert set(stats) == {':home', ':etc', ':media'}
+    assert all(s['runs'] > 0 for s in stats.values())
+    assert sum(s['failed'] for s in stats.values()) > 0
+    assert simulation.peak_running[0] == 1
+    assert simulation.peak_queued[0] >= 1
+    assert ':media' in simulation.report()
+
+
+def test_simulation_is_reproducible(config):
+    config(JOBS, borg='max_concurrent: 1\ncircuit_breaker_failures: 2')
+    results = []
+    for _ in range(2):
+        simulation = Simulation.from_config(START, START + datetime.timedelta(days=14))
+        simulation.run()
+        results.append({name: (s['runs'], s['failed']) for name, s in simulation.jobs.items()})
+    assert results[0] == results[1]
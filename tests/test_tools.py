@@ -0,0 +1,36 @@
+import datetime
+
+from bsrv.tools import gen_json, parse_json
+
+DT = datetime.datetime(2025, 1, 2, 3, 4, 5, 678901)
+
+
+def test_parse_json_converts_known_keys():
+    data = parse_json('{"archives": [{"name": "2025-01-02T03:04:05", "start": "2025-01-02T03:04:05.678901", '
+                      '"time": "not a date"}], "repository": {"last_modified": "2025-01-02T03:04:05.678901"}, '
+                      '"id": "1e5"}')
+    archive = data['archives'][0]
+    # Archive names look like datetimes but are kept, as are numbers in strings
+    assert archive['name'] == '2025-01-02T03:04:05'
+    assert archive['start'] == DT
+    assert archive['time'] == 'not a date'
+    assert data['repository']['last_modified'] == DT
+    assert data['id'] == '1e5'
+
+
+def test_parse_json_custom_keys():
+    assert parse_json('{"start": "2025-01-02T03:04:05.678901", "x": "2025-01-02T03:04:05.678901"}',
+                      datetime_keys=frozenset(['x'])) == {'start': '2025-01-02T03:04:05.678901', 'x': DT}
+
+
+def test_gen_json_roundtrip_does_not_modify_input():
+    obj = {'info_dt': DT, 'archives': [{'start': DT, 'name': 'a'}], 'size': 1}
+    text = gen_json(obj)
+    assert obj['info_dt'] is DT and obj['archives'][0]['start'] is DT
+    assert parse_json(text) == obj
+
+
+def test_gen_json_falls_back_to_json():
+    # More than 64 bit, which orjson rejects
+    obj = {'size': 2 ** 70, 'start': DT}
+    assert parse_json(gen_json(obj)) == obj